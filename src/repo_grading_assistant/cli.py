@@ -8,5 +8,9 @@ def main() -> None:
     # Delegate all argument parsing to grade_assignments.py
     run_grader()
 
+def main_async() -> None:
+    # Same CLI, graded on the asyncio engine
+    run_grader(async_engine=True)
+
 if __name__ == "__main__":
     main()
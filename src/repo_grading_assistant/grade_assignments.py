@@ -12,6 +12,12 @@ See QUICKSTART.md and README.md for usage.
 __version__ = "0.1.0"
 
 import argparse
+import atexit
+import asyncio
+import contextlib
+import contextvars
+import functools
+import random
 import logging
 import os
 import sys
@@ -19,23 +25,38 @@ import time
 import threading
 import csv
 import json
+import hashlib
 from pathlib import Path
 import fnmatch
 import re
+import ast
+import io
+import tokenize
+import math
 import openai
 import difflib
 import requests
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as futures_wait
 from importlib import resources as importlib_resources
 from importlib.metadata import version, PackageNotFoundError
 
 
 # OpenAI Python SDK: support both old (<1.0) and new (>=1.0) exception locations
 try:
-    from openai import APIError, APITimeoutError, APIConnectionError
+    from openai import APIError, APITimeoutError, APIConnectionError, RateLimitError
+    from openai import InternalServerError as ServiceUnavailableError
+    from openai import AuthenticationError, PermissionDeniedError as APIPermissionError
 except Exception:  # openai<1.0 fallback
-    from openai.error import APIError, Timeout, APIConnectionError
+    from openai.error import APIError, Timeout, APIConnectionError, RateLimitError, ServiceUnavailableError
+    from openai.error import AuthenticationError, PermissionError as APIPermissionError
     APITimeoutError = Timeout
 
+try:
+    import aiohttp  # ships with openai<1.0; used by the async engine
+except ModuleNotFoundError:
+    aiohttp = None
+
 try:
     from dotenv import load_dotenv
     load_dotenv()
@@ -223,7 +244,7 @@ def find_file_anywhere(base_dir: Path, filename: str, exclusions: list[str]) ->
     
     target = filename.lower()
     candidates = [
-        p for p in base_dir.rglob("*")
+        p for p in sorted(base_dir.rglob("*"))
         if not is_excluded(p, exclusions, base_dir)
     ]
 
@@ -254,32 +275,49 @@ def find_file_anywhere(base_dir: Path, filename: str, exclusions: list[str]) ->
     return None
 
 
-def combine_submission_text(student_dir: Path, required_files: list[str], exclusions: list[str]) -> str:
+def combine_submission_text(
+    student_dir: Path,
+    required_files: list[str],
+    exclusions: list[str],
+    settings: dict | None = None
+) -> str:
     """
     Combines submission text with wildcard + cardinality + escalation support.
-    """
-    parts = []
 
-    for rule in required_files:
-        pattern, min_c, max_c = parse_rule(rule)
+    `settings` is the merged global + assignment config; it enables the
+    optional normalization stage (see resolve_normalization_modes).
+    """
+    settings = settings or {}
+    files = collect_submission_files(student_dir, required_files, exclusions, settings)
+    return format_submission_files(files, compact=bool(resolve_normalization_modes(settings)))
 
-        is_glob = any(ch in pattern for ch in ["*", "?"])
 
-        matches = []
-        escalation = "none"
+def collect_submission_files(
+    student_dir: Path,
+    required_files: list[str],
+    exclusions: list[str],
+    settings: dict | None = None,
+    summarize: bool = True
+) -> list[dict]:
+    """
+    Resolve every rule against the student folder and read the matched files.
+    With summarize=False the file_summaries stage is skipped, so planning
+    passes never trigger paid summary calls.
 
-        # ---------- Wildcard rules ----------
-        if is_glob:
-            matches = find_all_by_pattern(student_dir, pattern, exclusions)
+    Returns one record per file, in rule order:
+      {"path": <relative posix path>, "rule": ..., "match": <escalation>,
+       "view": "full" | "outline" | "notebook-cells", "text": ...}
+    """
+    settings = settings or {}
+    norm_modes = resolve_normalization_modes(settings)
+    summary_cfg = resolve_summary_settings(settings) if summarize else None
+    summary_cache = SummaryCache(summary_cfg["cache_dir"], summary_cfg["max_bytes"]) if summary_cfg else None
+    raw_bytes, sent_bytes = 0, 0
+    files = []
 
-        # ---------- Non-glob rules (filename expectations) ----------
-        else:
-            matches, escalation = find_with_escalation(
-                student_dir,
-                pattern,          # keep full relative path if provided
-                exclusions,
-                min_c
-            )
+    for entry in required_files:
+        rule, rule_opts = split_rule_entry(entry)
+        matches, escalation, min_c, max_c = match_rule(student_dir, rule, exclusions)
 
         found = len(matches)
         ok = (found >= min_c) and (found <= max_c)
@@ -295,33 +333,172 @@ def combine_submission_text(student_dir: Path, required_files: list[str], exclus
                 f"Rule violated: {rule} — expected {min_c}..{high}, found {found}"
             )
 
-        # Append contents
+        # Read contents
         for m in matches:
             try:
-                parts.append(
-                    f"\n\n### FILE START\n"
-                    f"### RULE: {rule}\n"
-                    f"### PATH: {m.relative_to(student_dir)}\n"
-                    f"### MATCH TYPE: {escalation}\n\n"
-                    f"{m.read_text(encoding='utf-8', errors='ignore')}"
-                )
+                text = m.read_text(encoding='utf-8', errors='ignore')
             except Exception as e:
                 logging.warning(f"Could not read {m}: {e}")
+                continue
+
+            raw_bytes += len(text.encode("utf-8"))
+            text, view = render_file_text(m, text, rule_opts, settings)
+
+            rel = m.relative_to(student_dir).as_posix()
+            if summary_cfg and view != "outline" and len(text.encode("utf-8")) > summary_cfg["threshold_bytes"]:
+                summary = summarize_file(text, rel, summary_cfg, summary_cache)
+                if summary is not None:
+                    text, view = summary, "summary"
+
+            mode = normalization_mode_for(m, norm_modes) if view != "summary" else None
+            if mode:
+                text = normalize_source(text, m.suffix.lower(), aggressive=(mode == "aggressive"))
+            sent_bytes += len(text.encode("utf-8"))
+
+            files.append({
+                "path": rel,
+                "rule": rule,
+                "match": escalation,
+                "view": view,
+                "text": text,
+            })
+
+    if norm_modes and raw_bytes:
+        saved = raw_bytes - sent_bytes
+        logging.info(
+            f"[NORMALIZE] {student_dir.name}: {raw_bytes} → {sent_bytes} bytes "
+            f"(saved {saved}, {saved / raw_bytes:.0%})"
+        )
+
+    return files
+
+
+def match_rule(student_dir: Path, rule: str, exclusions: list[str]):
+    """
+    Resolve one required_files rule against a student folder.
+    Returns (matches, escalation, min_count, max_count).
+    """
+    pattern, min_c, max_c = parse_rule(rule)
+
+    is_glob = any(ch in pattern for ch in ["*", "?"])
+
+    matches = []
+    escalation = "none"
+
+    # ---------- Wildcard rules ----------
+    if is_glob:
+        matches = find_all_by_pattern(student_dir, pattern, exclusions)
+
+    # ---------- Non-glob rules (filename expectations) ----------
+    else:
+        matches, escalation = find_with_escalation(
+            student_dir,
+            pattern,          # keep full relative path if provided
+            exclusions,
+            min_c
+        )
 
+    return matches, escalation, min_c, max_c
+
+
+def render_file_text(path: Path, text: str, rule_opts: dict, settings: dict) -> tuple[str, str]:
+    """
+    Pick the representation of a file for the prompt: notebooks become a cell
+    listing, outline-mode rules become a Python outline, everything else is
+    sent in full. Returns (text, view).
+    """
+    if path.suffix.lower() == ".ipynb":
+        cells = render_notebook(text, int(settings.get("notebook_output_chars", 0)))
+        if cells is not None:
+            return cells, "notebook-cells"
+        logging.warning(f"[NOTEBOOK] Could not parse {path.name}; sending raw JSON")
+    elif rule_opts.get("mode") == "outline":
+        outline = outline_python_source(text) if path.suffix.lower() == ".py" else None
+        if outline is not None:
+            return outline, "outline"
+        logging.info(f"[OUTLINE] Sending full text for {path.name} (not parseable Python)")
+    return text, "full"
+
+
+def format_submission_files(files: list[dict], compact: bool = False) -> str:
+    """
+    Render collected file records for the prompt. The compact form uses a
+    single header line per file (used when normalization is enabled).
+    """
+    parts = []
+    for f in files:
+        view = f.get("view", "full")
+        if compact:
+            view_tag = f" | view={view}" if view != "full" else ""
+            parts.append(f"\n### FILE {f['path']} | rule={f['rule']} | match={f['match']}{view_tag}\n{f['text']}")
+        else:
+            parts.append(
+                f"\n\n### FILE START\n"
+                f"### RULE: {f['rule']}\n"
+                f"### PATH: {Path(f['path'])}\n"
+                f"### MATCH TYPE: {f['match']}\n"
+                + (f"### VIEW: {view}\n" if view != "full" else "")
+                + f"\n{f['text']}"
+            )
     return "\n".join(parts)
 
 
 def write_grade_summary(student_dir: Path, result_text: str) -> None:
-    """Write detailed grade summary to grade_summary.txt inside the student folder."""
+    """
+    Write detailed grade summary to grade_summary.txt inside the student folder.
+    The text goes to grade_summary.txt.partial first and is renamed into place,
+    so readers never see a half-written summary.
+    """
     out_file = student_dir / "grade_summary.txt"
-    out_file.write_text(result_text, encoding="utf-8")
+    tmp = out_file.with_name(out_file.name + ".partial")
+    tmp.write_text(result_text, encoding="utf-8")
+    os.replace(tmp, out_file)
     logging.info(f"Wrote summary → {out_file}")
 
 
-def append_csv_row(csv_path: Path, student_name: str, result_text: str | None, status: str) -> None:
+CSV_COLUMNS = ["Timestamp", "version", "Student Directory", "Status", "Points Earned", "Points Possible", "First Deduction", "Model"]
+
+
+def upgrade_csv_header(csv_path: Path) -> None:
+    """
+    Create grading_summary.csv with the CSV_COLUMNS header, or replace the
+    header of a file written by an older version (the two-column placeholder
+    or the columns before "Model") so existing rows keep lining up.
+    """
+    if not csv_path.exists():
+        with csv_path.open("w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(CSV_COLUMNS)
+        return
+
+    with csv_path.open(newline="", encoding="utf-8") as f:
+        text = f.read()
+    first, _, rest = text.partition("\n")
+    header = next(csv.reader([first]), [])
+    if header == CSV_COLUMNS:
+        return
+    if header in ([], ["Student Directory", "Status"]) or header == CSV_COLUMNS[:len(header)]:
+        logging.info(f"Updating {csv_path.name} header to the current columns")
+        tmp = csv_path.with_suffix(".csv.tmp")
+        with tmp.open("w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow(CSV_COLUMNS)
+            f.write(rest)
+        os.replace(tmp, csv_path)
+
+
+def append_csv_row(
+    csv_path: Path,
+    student_name: str,
+    result_text: str | None,
+    status: str,
+    model: str = "",
+    fields: dict | None = None
+) -> None:
     """
     Append a detailed grading record to grading_summary.csv.
     Extracts total points, possible points, and first deduction sentence if available.
+    `model` is the model that graded the student (blank if no API call was made).
+    `fields` are parsed structured-output fields; when given they are used
+    directly instead of scanning result_text.
     """
     from datetime import datetime
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -329,7 +506,12 @@ def append_csv_row(csv_path: Path, student_name: str, result_text: str | None, s
     file_exists = csv_path.exists()
     total_points, possible_points, first_deduction = "", "", ""
 
-    if result_text:
+    if fields:
+        total_points, possible_points = str(fields["total"]), str(fields["max_score"])
+        if fields["deductions"]:
+            first = fields["deductions"][0]
+            first_deduction = f"{first['reason'].strip()} (-{first['points']} points)"
+    elif result_text:
         
         # Example matches: "Total: 85/100", "Score: 90 out of 100"
         match = re.search(r"(\b\d{1,3}\b)\s*(?:/|out of)\s*(\b\d{1,3}\b)", result_text, re.IGNORECASE)
@@ -346,9 +528,9 @@ def append_csv_row(csv_path: Path, student_name: str, result_text: str | None, s
     with csv_path.open("a", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         if not file_exists:
-            writer.writerow(["Timestamp", "version", "Student Directory", "Status", "Points Earned", "Points Possible", "First Deduction"])
+            writer.writerow(CSV_COLUMNS)
             
-        writer.writerow([timestamp, __version__, student_name, status, total_points, possible_points, first_deduction])
+        writer.writerow([timestamp, __version__, student_name, status, total_points, possible_points, first_deduction, model])
 
 def resolve_grading_key_path(cfg: dict, config_path: Path) -> Path:
     """
@@ -367,6 +549,686 @@ def resolve_grading_key_path(cfg: dict, config_path: Path) -> Path:
     p = Path(str(key_value)).expanduser()
     return p.resolve() if p.is_absolute() else (config_path.parent / p).resolve()
 
+
+# ---------------------------------------------------------------------------
+# Source Normalization (token trimming before prompt assembly)
+# ---------------------------------------------------------------------------
+
+# Language profile → file suffixes that the profile's normalization applies to.
+# Profile names match the keys in exclusions.json.
+NORMALIZATION_SUFFIXES = {
+    "python": {".py"},
+    "web": {".html", ".htm", ".css", ".js"},
+    "javascript": {".js", ".jsx", ".ts", ".tsx", ".mjs"},
+    "java": {".java"},
+    "dotnet": {".cs"},
+    "cpp": {".c", ".cc", ".cpp", ".h", ".hpp"},
+}
+
+# Suffix → line-comment prefixes. A line whose first non-blank characters
+# start with one of these is dropped. Python is handled by tokenize instead
+# (python_comment_lines), so "#" inside a string literal is never touched.
+LINE_COMMENT_PREFIXES = {
+    ".js": ("//",), ".jsx": ("//",), ".ts": ("//",), ".tsx": ("//",), ".mjs": ("//",),
+    ".java": ("//",), ".cs": ("//",),
+    ".c": ("//",), ".cc": ("//",), ".cpp": ("//",), ".h": ("//",), ".hpp": ("//",),
+}
+
+# Only these suffixes are affected by "aggressive" mode; indentation is
+# meaningless to the grader there, so it can be dropped entirely.
+AGGRESSIVE_SUFFIXES = {".html", ".htm", ".css", ".js"}
+
+# Suffix → block-comment pattern used by aggressive mode. String literals
+# (group 1) are matched first and kept, so comment markers inside strings
+# such as "src/**/*.js" survive.
+_HTML_COMMENTS = re.compile(r"()<!--.*?-->", re.DOTALL)
+_CSS_COMMENTS = re.compile(r"""("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|/\*.*?\*/""", re.DOTALL)
+_JS_COMMENTS = re.compile(
+    r"""("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|//[^\n]*)|/\*.*?\*/""",
+    re.DOTALL,
+)
+BLOCK_COMMENT_PATTERNS = {".html": _HTML_COMMENTS, ".htm": _HTML_COMMENTS, ".css": _CSS_COMMENTS, ".js": _JS_COMMENTS}
+
+NORMALIZATION_MODES = ("off", "standard", "aggressive")
+
+
+def resolve_normalization_modes(settings: dict) -> dict[str, str]:
+    """
+    Resolve the per-language normalization modes from config.
+
+    Accepted forms for settings["normalization"]:
+      - true   → "standard" for every language_profile entry, "aggressive" for web
+      - {"python": "standard", "web": "aggressive"}
+      - missing / false → {} (stage disabled, original output format)
+    """
+    raw = settings.get("normalization")
+    if not raw:
+        return {}
+
+    if raw is True:
+        profiles = list(settings.get("language_profile", [])) or ["python"]
+        return {p: ("aggressive" if p == "web" else "standard") for p in profiles}
+
+    if not isinstance(raw, dict):
+        logging.warning(f"[NORMALIZE] Ignoring invalid 'normalization' setting: {raw!r}")
+        return {}
+
+    modes = {}
+    for profile, mode in raw.items():
+        mode = str(mode).lower()
+        if mode not in NORMALIZATION_MODES:
+            logging.warning(f"[NORMALIZE] Unknown mode '{mode}' for '{profile}'; using 'standard'.")
+            mode = "standard"
+        if mode != "off":
+            modes[profile] = mode
+    return modes
+
+
+def normalization_mode_for(path: Path, modes: dict[str, str]) -> str | None:
+    """
+    Return the strongest configured mode whose profile covers this file's
+    suffix, or None if the file should be sent verbatim.
+    """
+    suffix = path.suffix.lower()
+    found = None
+    for profile, mode in modes.items():
+        if suffix in NORMALIZATION_SUFFIXES.get(profile, set()):
+            if mode == "aggressive" and suffix in AGGRESSIVE_SUFFIXES:
+                return "aggressive"
+            found = "standard"
+    return found
+
+
+def python_comment_lines(text: str) -> set[int]:
+    """
+    1-based numbers of the lines that tokenize reports as comment-only.
+    Empty when the source does not tokenize (nothing is dropped then).
+    """
+    comments, code = set(), set()
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+            if tok.type == tokenize.COMMENT:
+                comments.add(tok.start[0])
+            elif tok.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                code.update(range(tok.start[0], tok.end[0] + 1))
+    except (tokenize.TokenError, SyntaxError):
+        return set()
+    return comments - code
+
+
+# Comments and string literals of the "//" languages: template literals (JS/TS),
+# text blocks (Java), verbatim strings (C#) and raw strings (C++) can span lines.
+_C_STYLE_LITERALS = re.compile(
+    r"""//[^\n]*|/\*.*?\*/"""
+    r'''|"""(?:\\.|[^\\])*?"""|@"(?:""|[^"])*"|R"([^(\s]*)\(.*?\)\1"'''
+    r"""|`(?:\\.|[^`\\])*`|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'""",
+    re.DOTALL,
+)
+
+
+def string_continuation_lines(text: str) -> set[int]:
+    """
+    1-based numbers of the lines that start inside a multi-line string
+    literal of a "//" language; such lines are never treated as comments.
+    """
+    inside = set()
+    for m in _C_STYLE_LITERALS.finditer(text):
+        if m.group().startswith(("//", "/*")):
+            continue
+        first = text.count("\n", 0, m.start()) + 1
+        last = first + m.group().count("\n")
+        inside.update(range(first + 1, last + 1))
+    return inside
+
+
+def normalize_source(text: str, suffix: str, aggressive: bool = False) -> str:
+    """
+    Shrink source text without changing what the grader needs to see:
+      - drop comment-only lines (never lines inside a string literal)
+      - collapse runs of blank lines into one (drop them all when aggressive)
+      - reduce each indentation level to a single space (drop it when aggressive)
+
+    Aggressive mode also removes block comments (<!-- ... --> in HTML,
+    /* ... */ in CSS/JS, never inside string literals), and only applies to
+    web files (HTML/CSS/JS).
+    """
+    aggressive = aggressive and suffix in AGGRESSIVE_SUFFIXES
+
+    if aggressive:
+        text = BLOCK_COMMENT_PATTERNS[suffix].sub(lambda m: m.group(1) or "", text)
+
+    text = text.expandtabs(4).replace("\r\n", "\n").replace("\r", "\n")
+    prefixes = LINE_COMMENT_PREFIXES.get(suffix, ())
+    dropped = python_comment_lines(text) if suffix == ".py" else set()
+    kept = string_continuation_lines(text) if prefixes else set()
+    lines = []
+    for number, line in enumerate(text.split("\n"), start=1):
+        stripped = line.strip()
+        if number in dropped or (prefixes and number not in kept and stripped.startswith(prefixes)):
+            continue
+        lines.append(line.rstrip())
+
+    # Indentation unit = smallest non-zero indent (usually 2 or 4)
+    indents = [len(line) - len(line.lstrip(" ")) for line in lines if line.strip()]
+    unit = min((i for i in indents if i > 0), default=1)
+
+    out = []
+    blank = False
+    for line in lines:
+        if not line.strip():
+            if not aggressive and not blank and out:
+                out.append("")
+            blank = True
+            continue
+        blank = False
+        body = line.lstrip(" ")
+        if aggressive:
+            out.append(body)
+        else:
+            indent = len(line) - len(body)
+            out.append(" " * (indent // unit) + body)
+
+    return "\n".join(out).strip("\n") + "\n" if out else ""
+
+
+# ---------------------------------------------------------------------------
+# Jupyter Notebooks (.ipynb → compact cell listing)
+# ---------------------------------------------------------------------------
+
+def render_notebook(text: str, output_chars: int = 0) -> str | None:
+    """
+    Turn raw notebook JSON into a compact listing of code and markdown cells.
+
+    Images, widget state and all metadata are dropped. When output_chars > 0,
+    text outputs (streams, text/plain results, errors) are included and
+    truncated to that many characters per cell.
+
+    Returns None if the text is not a valid notebook (not JSON, or no list
+    of cells); malformed cells and outputs are skipped.
+    """
+    try:
+        nb = json.loads(text)
+    except ValueError:
+        return None
+    cells = nb.get("cells") if isinstance(nb, dict) else None
+    if not isinstance(cells, list):
+        return None
+
+    out = []
+    for i, cell in enumerate(cells, start=1):
+        if not isinstance(cell, dict):
+            continue
+        kind = cell.get("cell_type", "code")
+        if kind not in ("code", "markdown"):
+            continue
+
+        source = _notebook_text(cell.get("source", "")).strip()
+        if not source:
+            continue
+
+        label = f"[{i}] {kind}"
+        if kind == "code" and cell.get("execution_count") is not None:
+            label += f" (exec {cell['execution_count']})"
+        out.append(f"{label}\n{source}")
+
+        if kind == "code" and output_chars > 0:
+            outputs = _notebook_outputs_text(cell.get("outputs", [])).strip()
+            if outputs:
+                if len(outputs) > output_chars:
+                    outputs = outputs[:output_chars] + f"... [truncated {len(outputs) - output_chars} chars]"
+                out.append(f"--- output ---\n{outputs}")
+
+    return "\n\n".join(out) + "\n" if out else ""
+
+
+def _notebook_text(value) -> str:
+    """Notebook text fields are either a string or a list of lines."""
+    if isinstance(value, list):
+        return "".join(str(v) for v in value)
+    return str(value or "")
+
+
+def _notebook_outputs_text(outputs: list) -> str:
+    parts = []
+    for o in outputs if isinstance(outputs, list) else []:
+        if not isinstance(o, dict):
+            continue
+        otype = o.get("output_type")
+        if otype == "stream":
+            parts.append(_notebook_text(o.get("text", "")))
+        elif otype in ("execute_result", "display_data"):
+            data = o.get("data")
+            plain = data.get("text/plain") if isinstance(data, dict) else None
+            if plain:
+                parts.append(_notebook_text(plain))
+        elif otype == "error":
+            parts.append(f"{o.get('ename', 'Error')}: {o.get('evalue', '')}")
+    return "\n".join(p.rstrip("\n") for p in parts)
+
+
+# ---------------------------------------------------------------------------
+# Python Outline Mode (per-rule "mode": "outline")
+# ---------------------------------------------------------------------------
+
+def outline_python_source(text: str) -> str | None:
+    """
+    Reduce a Python module to its outline using `ast`:
+      - imports
+      - decorators and class / function signatures (bodies elided)
+      - class and module level assignments whose value is a call
+        (e.g. Django model fields: title = models.CharField(...))
+      - other assignments shown as `name = ...` with an item count for
+        lists/tuples (e.g. migration `operations = [...]  # 4 items`)
+
+    Returns None if the source does not parse, so callers can fall back to
+    the full text.
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+
+    lines = []
+    _outline_body(tree.body, 0, lines)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _outline_body(body: list, depth: int, lines: list[str]) -> None:
+    pad = "    " * depth
+
+    for node in body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(pad + ast.unparse(node))
+
+        elif isinstance(node, ast.ClassDef):
+            for dec in node.decorator_list:
+                lines.append(f"{pad}@{ast.unparse(dec)}")
+            bases = [ast.unparse(b) for b in node.bases + node.keywords]
+            head = f"class {node.name}({', '.join(bases)}):" if bases else f"class {node.name}:"
+            lines.append(pad + head)
+            before = len(lines)
+            _outline_body(node.body, depth + 1, lines)
+            if len(lines) == before:
+                lines.append(pad + "    ...")
+
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for dec in node.decorator_list:
+                lines.append(f"{pad}@{ast.unparse(dec)}")
+            prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+            returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+            lines.append(f"{pad}{prefix} {node.name}({ast.unparse(node.args)}){returns}: ...")
+
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            value = node.value
+            if value is None or isinstance(value, (ast.Call, ast.Constant, ast.Name, ast.Attribute)):
+                lines.append(pad + ast.unparse(node))
+                continue
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = " = ".join(ast.unparse(t) for t in targets)
+            if isinstance(value, (ast.List, ast.Tuple)):
+                lines.append(f"{pad}{names} = ...  # {len(value.elts)} items")
+            else:
+                lines.append(f"{pad}{names} = ...")
+
+
+# ---------------------------------------------------------------------------
+# Per-File Summaries (content-addressed cache shared across students/runs)
+# ---------------------------------------------------------------------------
+
+DEFAULT_SUMMARY_THRESHOLD_BYTES = 20000
+DEFAULT_SUMMARY_CACHE_MB = 50
+
+FILE_SUMMARY_PROMPT = (
+    "Summarize the following student source file for a grader who cannot see it. "
+    "List its classes, functions, routes, models and any notable logic, keeping "
+    "identifiers verbatim. Do not evaluate or score the work. Be concise (under 250 words)."
+)
+
+
+class SummaryCache:
+    """
+    On-disk store of file summaries keyed by sha256(summarizer model + content).
+
+    Entries are plain text files; access time is tracked via mtime so the
+    least recently used entries are evicted once the store exceeds max_bytes
+    (and, if max_age_seconds is set, once they go unused for that long).
+    """
+
+    suffix = ".txt"
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_age_seconds: float | None = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(content: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{content}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        path = self.cache_dir / f"{key}{self.suffix}"
+        try:
+            if self.max_age_seconds and time.time() - path.stat().st_mtime > self.max_age_seconds:
+                path.unlink(missing_ok=True)
+                return None
+            text = path.read_text(encoding="utf-8")
+            os.utime(path)  # mark as recently used
+        except OSError:     # includes an entry evicted by another worker mid-read
+            return None
+        return text
+
+    def put(self, key: str, summary: str) -> None:
+        path = self.cache_dir / f"{key}{self.suffix}"
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(summary, encoding="utf-8")
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        now = time.time()
+        for p in self.cache_dir.glob(f"*{self.suffix}"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            if self.max_age_seconds and now - st.st_mtime > self.max_age_seconds:
+                p.unlink(missing_ok=True)
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+def resolve_summary_settings(settings: dict) -> dict | None:
+    """
+    Settings for the per-file summary stage, or None when disabled:
+      "file_summaries": {
+        "threshold_bytes": 20000,   # files larger than this are summarized
+        "model": "gpt-5-mini",      # summarizer (defaults to the grading model)
+        "cache_dir": "~/.cache/repo-grading-assistant/summaries",
+        "max_cache_mb": 50
+      }
+    """
+    raw = settings.get("file_summaries")
+    if not raw:
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    cache_dir = raw.get("cache_dir") or Path.home() / ".cache" / "repo-grading-assistant" / "summaries"
+    return {
+        "threshold_bytes": int(raw.get("threshold_bytes", DEFAULT_SUMMARY_THRESHOLD_BYTES)),
+        "model": raw.get("model") or settings.get("model", "gpt-5-mini"),
+        "cache_dir": Path(cache_dir).expanduser(),
+        "max_bytes": int(float(raw.get("max_cache_mb", DEFAULT_SUMMARY_CACHE_MB)) * 1024 * 1024),
+    }
+
+
+def summarize_file(text: str, rel_path: str, summary_cfg: dict, cache: SummaryCache) -> str | None:
+    """
+    Return a cached or freshly generated summary of the file, or None if the
+    summarizer call fails (callers then send the full text). Summaries go
+    through request_completion, so they share the rate limits, retries and
+    circuit breaker of grading calls.
+    """
+    key = SummaryCache.key(text, summary_cfg["model"])
+    cached = cache.get(key)
+    if cached is not None:
+        logging.info(f"[SUMMARY] cache hit for {rel_path} ({key[:12]})")
+        return cached
+
+    try:
+        resp = request_completion(
+            summary_cfg["model"],
+            [
+                {"role": "system", "content": FILE_SUMMARY_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            rel_path,
+        )
+        if resp is None:
+            raise RuntimeError(f"no response ({LAST_REQUEST_FAILURE.get()} failure)")
+        summary = resp.choices[0].message["content"].strip()
+    except Exception as e:
+        logging.warning(f"[SUMMARY] Could not summarize {rel_path}: {e}; sending full text")
+        return None
+
+    cache.put(key, summary)
+    logging.info(f"[SUMMARY] summarized {rel_path} ({len(text)} → {len(summary)} chars, {key[:12]})")
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# Rubric-Driven Retrieval (offline BM25 over function/class chunks)
+# ---------------------------------------------------------------------------
+
+DEFAULT_RETRIEVAL_TOKEN_BUDGET = 6000
+
+SEARCH_STOPWORDS = {
+    "the", "and", "for", "should", "able", "users", "user", "with", "that", "this",
+    "are", "can", "will", "from", "points", "point", "bonus", "their", "they", "each",
+    "self", "return", "def", "class", "import", "none", "true", "false",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token); no tokenizer dependency."""
+    return (len(text) + 3) // 4
+
+
+def resolve_retrieval_budget(settings: dict) -> int | None:
+    """
+    Token budget for the retrieval stage, or None if retrieval is disabled.
+      "retrieval": true                     → default budget
+      "retrieval": {"token_budget": 4000}
+    """
+    raw = settings.get("retrieval")
+    if not raw:
+        return None
+    if isinstance(raw, dict):
+        if raw.get("enabled", True) is False:
+            return None
+        return int(raw.get("token_budget", DEFAULT_RETRIEVAL_TOKEN_BUDGET))
+    return DEFAULT_RETRIEVAL_TOKEN_BUDGET
+
+
+def extract_rubric_items(key_text: str) -> list[str]:
+    """
+    Split the grading key into rubric bullets ("- ..." or "1. ..." lines).
+    Point annotations ("*** +15 points ...") are attached to the bullet above.
+    Falls back to every non-empty line if the key has no bullets.
+    """
+    items = []
+    for line in key_text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith("***") and items:
+            items[-1] += " " + stripped.lstrip("* ")
+        elif re.match(r"^(?:[-•]|\d+[.)])\s+", stripped):
+            items.append(re.sub(r"^(?:[-•]|\d+[.)])\s+", "", stripped))
+
+    if not items:
+        items = [line.strip() for line in key_text.splitlines() if line.strip()]
+    return items
+
+
+def search_terms(text: str) -> list[str]:
+    """Lowercased identifier/word terms with snake_case and camelCase split apart."""
+    terms = []
+    for word in re.findall(r"[A-Za-z0-9]+", text):
+        for part in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", word):
+            t = part.lower()
+            if len(t) < 3 or t in SEARCH_STOPWORDS:
+                continue
+            for suffix in ("ing", "ed", "s"):
+                if t.endswith(suffix) and len(t) - len(suffix) >= 3 and not t.endswith("ss"):
+                    t = t[: -len(suffix)]
+                    break
+            terms.append(t)
+    return terms
+
+
+def bm25_scores(query: list[str], documents: list[list[str]], k1: float = 1.5, b: float = 0.75) -> list[float]:
+    """Okapi BM25 score of each tokenized document against the query terms."""
+    n = len(documents)
+    if not n:
+        return []
+
+    avg_len = sum(len(d) for d in documents) / n or 1.0
+    doc_freq: dict[str, int] = {}
+    for d in documents:
+        for t in set(d):
+            doc_freq[t] = doc_freq.get(t, 0) + 1
+
+    scores = []
+    for d in documents:
+        counts: dict[str, int] = {}
+        for t in d:
+            counts[t] = counts.get(t, 0) + 1
+        score = 0.0
+        for t in set(query):
+            tf = counts.get(t, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (n - doc_freq[t] + 0.5) / (doc_freq[t] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(d) / avg_len))
+        scores.append(score)
+    return scores
+
+
+def split_into_chunks(file_record: dict, max_lines: int = 60) -> list[dict]:
+    """
+    Split a collected file into retrieval chunks (1-based inclusive line ranges).
+    Python files are split per top-level function/class (large classes per
+    method); everything else is split on blank lines into blocks of up to
+    max_lines.
+    """
+    text = file_record["text"]
+    lines = text.splitlines()
+    if not lines:
+        return []
+
+    spans = None
+    if file_record["path"].lower().endswith(".py"):
+        spans = _python_chunk_spans(text, len(lines), max_lines)
+    if spans is None:
+        spans = _block_chunk_spans(lines, max_lines)
+
+    chunks = []
+    for start, end in spans:
+        body = "\n".join(lines[start - 1:end])
+        if body.strip():
+            chunks.append({**file_record, "start": start, "end": end, "text": body})
+    return chunks
+
+
+def _python_chunk_spans(text: str, total: int, max_lines: int) -> list[tuple[int, int]] | None:
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+
+    def first_line(node):
+        return min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+
+    spans = []
+    cursor = 1
+    for node in tree.body:
+        if not isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        start, end = first_line(node), node.end_lineno
+        if start > cursor:
+            spans.append((cursor, start - 1))      # module-level code in between
+
+        methods = [n for n in node.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        if isinstance(node, ast.ClassDef) and end - start + 1 > max_lines and methods:
+            inner = start
+            for meth in methods:
+                m_start = first_line(meth)
+                if m_start > inner:
+                    spans.append((inner, m_start - 1))
+                spans.append((m_start, meth.end_lineno))
+                inner = meth.end_lineno + 1
+            if inner <= end:
+                spans.append((inner, end))
+        else:
+            spans.append((start, end))
+        cursor = end + 1
+
+    if cursor <= total:
+        spans.append((cursor, total))
+    return spans
+
+
+def _block_chunk_spans(lines: list[str], max_lines: int) -> list[tuple[int, int]]:
+    spans = []
+    start = 1
+    for i, line in enumerate(lines, start=1):
+        at_break = not line.strip() and i - start + 1 >= max_lines // 2
+        if at_break or i - start + 1 >= max_lines:
+            spans.append((start, i))
+            start = i + 1
+    if start <= len(lines):
+        spans.append((start, len(lines)))
+    return spans
+
+
+def retrieve_relevant_chunks(files: list[dict], key_text: str, token_budget: int, compact: bool = False) -> str:
+    """
+    Build the submission text from the chunks that best match the rubric.
+
+    Every rubric bullet takes turns claiming its next best-scoring chunk until
+    the token budget is spent, so one heavily-matched requirement cannot crowd
+    out the others. Selected chunks are emitted in original file/line order.
+    """
+    chunks = [c for f in files for c in split_into_chunks(f)]
+    if not chunks:
+        return format_submission_files(files, compact)
+
+    documents = [search_terms(f"{c['path']} {c['text']}") for c in chunks]
+    rankings = []
+    for item in extract_rubric_items(key_text):
+        scores = bm25_scores(search_terms(item), documents)
+        ranked = [i for i in sorted(range(len(chunks)), key=lambda i: -scores[i]) if scores[i] > 0]
+        if ranked:
+            rankings.append(ranked)
+
+    selected: set[int] = set()
+    used = 0
+    depth = 0
+    while rankings and depth < len(chunks):
+        for ranked in rankings:
+            if depth >= len(ranked) or ranked[depth] in selected:
+                continue
+            cost = estimate_tokens(chunks[ranked[depth]]["text"]) + 20
+            if used + cost <= token_budget:
+                selected.add(ranked[depth])
+                used += cost
+        depth += 1
+
+    kept = [chunks[i] for i in sorted(selected)]
+    kept_paths = {c["path"] for c in kept}
+    omitted = [f["path"] for f in files if f["path"] not in kept_paths]
+
+    parts = [
+        f"### NOTE: Retrieval mode — showing {len(kept)} of {len(chunks)} code sections, "
+        f"selected by relevance to the grading key. Other code exists but is not shown."
+    ]
+    if omitted:
+        parts.append("### FILES NOT SHOWN: " + ", ".join(omitted))
+    parts.append(format_submission_files(
+        [{**c, "path": f"{c['path']} lines {c['start']}-{c['end']}"} for c in kept],
+        compact,
+    ))
+    return "\n".join(parts)
+
+
 # ---------------------------------------------------------------------------
 # Bonus Inference (Option C+ : behavior only, no points)
 # ---------------------------------------------------------------------------
@@ -491,6 +1353,22 @@ def parse_rule(rule: str):
 
     return pattern, min_count, max_count
 
+
+def split_rule_entry(entry) -> tuple[str, dict]:
+    """
+    A required_files entry is either a plain rule string or an object with
+    per-rule options:
+      "**/views.py(1..*)"
+      {"rule": "**/migrations/*.py(0..*)", "mode": "outline"}
+
+    Returns (rule, options).
+    """
+    if isinstance(entry, dict):
+        opts = dict(entry)
+        rule = str(opts.pop("rule", ""))
+        return rule, opts
+    return str(entry), {}
+
 # ---------------------------------------------------------------------------
 # Glob matcher (returns ALL)
 # ---------------------------------------------------------------------------
@@ -511,7 +1389,7 @@ def find_all_by_pattern(root: Path, pattern: str, exclusions: list[str]) -> list
     if normalized.startswith("**/"):
         patterns.append(normalized[3:])
 
-    for path in root.rglob("*"):
+    for path in sorted(root.rglob("*")):
         if is_excluded(path, exclusions, root):
             continue
 
@@ -546,7 +1424,7 @@ def find_with_escalation(base_dir: Path, pattern: str, exclusions: list[str], ne
 
     # ---------- Phase 1a: exact RELATIVE PATH ----------
     if has_path:
-        for p in base_dir.rglob("*"):
+        for p in sorted(base_dir.rglob("*")):
             if p.is_file() and not is_excluded(p, exclusions, base_dir):
                 rel = str(p.relative_to(base_dir)).replace("\\", "/").lower()
                 if rel == raw:
@@ -562,7 +1440,7 @@ def find_with_escalation(base_dir: Path, pattern: str, exclusions: list[str], ne
     filename = Path(raw).name
 
     # ---------- Phase 1b: exact BASENAME ----------
-    for p in base_dir.rglob("*"):
+    for p in sorted(base_dir.rglob("*")):
         if p.is_file() and not is_excluded(p, exclusions, base_dir):
             if p.name.lower() == filename:
                 # avoid duplicates if Phase 1a already added something
@@ -586,7 +1464,7 @@ def find_with_escalation(base_dir: Path, pattern: str, exclusions: list[str], ne
         return results[:needed], "pattern"
 
     # ---------- Phase 3: fuzzy filename ----------
-    for p in base_dir.rglob("*"):
+    for p in sorted(base_dir.rglob("*")):
         if p.is_file() and not is_excluded(p, exclusions, base_dir):
             score = difflib.SequenceMatcher(None, p.name.lower(), filename).ratio()
             if score >= 0.85 and p not in results:
@@ -665,122 +1543,2842 @@ def enforce_base_max(result_text: str, base_max: int) -> str:
     )
 
 # ---------------------------------------------------------------------------
-# Grading Logic (Prompt restored verbatim)
+# LLM Backends (OpenAI, OpenAI-compatible servers, in-process fake)
 # ---------------------------------------------------------------------------
 
-def grade_submission(
-    student_dir: Path,
-    grading_key_file: Path,
-    required_files: list[str],
-    model: str,
-    max_score: int,
-    exclusions: list[str],
-    system_prompt: str
-) -> str | None:  
-    
+class OpenAIBackend:
     """
-    Grade a single student submission using the stored 'Coding Exercise Scoring' logic.
-    Returns the plain-text feedback (or None on error).
+    Chat completions through the openai package. With base_url / api_key
+    set, requests go to that OpenAI-compatible server (vLLM, llama.cpp,
+    Ollama, a proxy, ...) instead of the global openai.api_base / api_key.
     """
-    try:
-        key_text = grading_key_file.read_text(encoding="utf-8", errors="ignore")
-    except Exception as e:
-        logging.error(f"Cannot read key file '{grading_key_file}': {e}")
-        return None
 
-    combined_text = combine_submission_text(student_dir, required_files, exclusions)
+    name = "openai"
 
-    # -----------------------------
-    # BUILD THE ACTUAL GRADING PROMPT (ORIGINAL)
-    # -----------------------------
-    prompt = f"""
+    def __init__(self, base_url: str | None = None, api_key: str | None = None, requires_api_key: bool = True):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.requires_api_key = requires_api_key
 
-{system_prompt}
+    def identity(self) -> dict:
+        """Where requests go, for the response cache key (never the key itself)."""
+        return {"type": self.name, "base_url": self.base_url or openai.api_base}
 
-Answer Key:
-{key_text}
+    def _target(self) -> dict:
+        target = {}
+        if self.base_url:
+            target["api_base"] = self.base_url
+        if self.api_key:
+            target["api_key"] = self.api_key
+        return target
 
-Student Submission:
-{combined_text}
+    def create(self, **kwargs):
+        return openai.ChatCompletion.create(**self._target(), **kwargs)
 
-Respond using the following format:
+    async def acreate(self, **kwargs):
+        return await openai.ChatCompletion.acreate(**self._target(), **kwargs)
 
-1. **Deductions**
-- List each deduction with brief explanation and points lost.
+
+DEFAULT_FAKE_REPORT = """1. **Deductions**
+- None.
 
 2. **Bonus Credit (if any)**
-- List each bonus feature that was found and why it qualifies, in plain language.
-- If no bonuses were earned, write "None".
+None
 
 3. **Strengths**
-- Two sentences about what was done well.
+The submission meets the requirements. The code is readable.
 
 4. **Areas for Improvement**
-- Two sentences about what to work on.
+Add more comments. Consider more tests.
 
 5. **Score Summary**
-- The base assignment maximum (DENOMINATOR) is {max_score}.
-- Bonus points are added to the final score and MAY exceed the denominator.
-- Format strictly as:
-  - "Total: <earned>/{max_score} points (includes <bonus> bonus)" if bonus exists
-  - Otherwise: "Total: <earned>/{max_score} points"
-  - "Total: 75/60 points (includes 15 bonus)" would be valid
+Total: {earned}/{max_score} points
 
 6. **Supportive Closing**
-- One encouraging sentence to the student.
-"""
+Keep up the good work!"""
 
-    # Progress dots
-    stop_event = threading.Event()
-    thread = threading.Thread(target=idle_marker, args=(stop_event,), daemon=True)
-    thread.start()
 
-    try:
-        max_attempts = 4
-        base_delay_seconds = 1.5
-        resp = None
+class FakeBackend:
+    """
+    In-process stand-in for load tests and offline runs: no network, no cost.
+
+    latency:     {"distribution": "lognormal", "median": 2.0, "sigma": 0.6}
+                 or {"distribution": "uniform", "min": 1, "max": 5}
+                 or {"distribution": "constant", "seconds": 0.5}
+    error_rates: fraction of calls failing per class, e.g.
+                 {"rate_limited": 0.02, "timeout": 0.01, "server": 0.01, "connection": 0.01}
+    reports:     canned report texts ({earned} / {max_score} are filled in);
+                 a generic six-section report when omitted. Requests with a
+                 response_format get a JSON report instead (structured_output)
+    max_score:   denominator used in the canned reports (default 60)
+    """
 
-        for attempt in range(1, max_attempts + 1):
-            try:
-                resp = openai.ChatCompletion.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": "You are a grading assistant."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    request_timeout=120,
-                )
-                break
-            except (APIConnectionError, APITimeoutError, requests.exceptions.RequestException) as e:
-                if attempt == max_attempts:
-                    logging.error(
-                        f"OpenAI transient error after {max_attempts} attempts for {student_dir.name}: {e}"
+    name = "fake"
+    requires_api_key = False
+
+    ERRORS = {
+        "rate_limited": lambda: RateLimitError("fake backend: rate limit reached"),
+        "timeout": lambda: APITimeoutError("fake backend: request timed out"),
+        "server": lambda: ServiceUnavailableError("fake backend: service unavailable"),
+        "connection": lambda: APIConnectionError("fake backend: connection reset"),
+    }
+
+    def __init__(
+        self,
+        latency: dict | None = None,
+        error_rates: dict | None = None,
+        reports: list[str] | None = None,
+        max_score: int = 60,
+        seed: int | None = None
+    ):
+        self.latency = latency or {"distribution": "constant", "seconds": 0.0}
+        self.error_rates = {k: float(v) for k, v in (error_rates or {}).items() if k in self.ERRORS}
+        self.reports = reports or [DEFAULT_FAKE_REPORT]
+        self.max_score = max_score
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def identity(self) -> dict:
+        return {"type": self.name}
+
+    def _draw(self, structured: bool = False) -> tuple[float, str | None, str]:
+        """Latency, error class to raise (or None) and report for one call."""
+        with self.lock:
+            self.calls += 1
+            dist = self.latency.get("distribution", "constant")
+            if dist == "lognormal":
+                delay = self.random.lognormvariate(math.log(float(self.latency.get("median", 1.0))),
+                                                   float(self.latency.get("sigma", 0.5)))
+            elif dist == "uniform":
+                delay = self.random.uniform(float(self.latency.get("min", 0)), float(self.latency.get("max", 1)))
+            else:
+                delay = float(self.latency.get("seconds", 0.0))
+
+            roll, error = self.random.random(), None
+            for kind, rate in self.error_rates.items():
+                if roll < rate:
+                    error = kind
+                    break
+                roll -= rate
+
+            earned = self.random.randint(self.max_score // 2, self.max_score)
+            if structured:
+                report = json.dumps({
+                    "deductions": [{"reason": "Minor issues", "points": self.max_score - earned}] if earned < self.max_score else [],
+                    "bonuses": [],
+                    "strengths": ["The submission meets the requirements.", "The code is readable."],
+                    "improvements": ["Add more comments.", "Consider more tests."],
+                    "earned": earned,
+                    "closing": "Keep up the good work!",
+                })
+            else:
+                report = self.random.choice(self.reports).format(earned=earned, max_score=self.max_score)
+            return delay, error, report
+
+    def _response(self, report: str, messages: list[dict], stream: bool):
+        prompt_tokens = estimate_message_tokens(messages)
+        completion_tokens = estimate_tokens(report)
+        if stream:
+            words = re.findall(r"\S+\s*", report)
+            return ({"choices": [{"delta": {"content": w}}]} for w in words)
+        return openai.util.convert_to_openai_object({
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": report}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def create(self, messages: list[dict], stream: bool = False, **kwargs):
+        delay, error, report = self._draw("response_format" in kwargs)
+        time.sleep(delay)
+        if error:
+            raise self.ERRORS[error]()
+        return self._response(report, messages, stream)
+
+    async def acreate(self, messages: list[dict], stream: bool = False, **kwargs):
+        delay, error, report = self._draw("response_format" in kwargs)
+        await asyncio.sleep(delay)
+        if error:
+            raise self.ERRORS[error]()
+        return self._response(report, messages, stream)
+
+
+# Backend used for every chat completion, set by configure_backend()
+BACKEND = OpenAIBackend()
+
+
+def configure_backend(settings: dict):
+    """
+    "backend": {"type": "openai"}                                   (default)
+    "backend": {"type": "openai-compatible", "base_url": "http://localhost:8000/v1",
+                "api_key_env": "LOCAL_LLM_API_KEY"}                 (key optional)
+    "backend": {"type": "fake", "latency": {...}, "error_rates": {...}, "reports": [...]}
+    An "api_pool" list (see build_key_pool) replaces the single key and endpoint.
+    """
+    global BACKEND
+    if settings.get("api_pool"):
+        BACKEND = build_key_pool(settings["api_pool"])
+        return BACKEND
+
+    raw = settings.get("backend") or {}
+    raw = raw if isinstance(raw, dict) else {"type": str(raw)}
+    kind = str(raw.get("type", "openai")).lower()
+
+    if kind == "fake":
+        BACKEND = FakeBackend(
+            latency=raw.get("latency"),
+            error_rates=raw.get("error_rates"),
+            reports=raw.get("reports"),
+            max_score=int(raw.get("max_score", settings.get("max_score", 60))),
+            seed=raw.get("seed"),
+        )
+    elif kind == "openai-compatible":
+        if not raw.get("base_url"):
+            raise ValueError('backend type "openai-compatible" needs a "base_url"')
+        key_env = raw.get("api_key_env")
+        BACKEND = OpenAIBackend(
+            base_url=raw["base_url"],
+            api_key=(os.getenv(key_env) if key_env else None) or "not-needed",
+            requires_api_key=False,
+        )
+    elif kind == "openai":
+        BACKEND = OpenAIBackend(base_url=raw.get("base_url"))
+    else:
+        raise ValueError(f"Unknown backend type: {kind!r} (expected openai, openai-compatible or fake)")
+
+    if kind != "openai":
+        logging.info(f"[BACKEND] Using {kind} backend{' at ' + raw['base_url'] if raw.get('base_url') else ''}")
+    return BACKEND
+
+
+# ---------------------------------------------------------------------------
+# Rate Limiting (per-model request and token buckets)
+# ---------------------------------------------------------------------------
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at per_minute / 60 per
+    second. reserve() deducts immediately (the level may go negative) and
+    returns how long the caller must wait, so concurrent callers queue up
+    behind each other instead of all retrying at once.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self.lock:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float) -> None:
+        """Return (or, if negative, additionally charge) capacity."""
+        with self.lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one model."""
+
+    def __init__(self, requests_per_minute: float | None, tokens_per_minute: float | None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.ledger: SharedRateLedger | None = None   # cross-process share, see configure_rate_limits
+
+    def reserve(self, tokens: int) -> float:
+        waits = [0.0]
+        with self.lock:
+            waits.append(self.paused_until - time.monotonic())
+        if self.requests:
+            waits.append(self.requests.reserve(1))
+        if self.tokens:
+            waits.append(self.tokens.reserve(tokens))
+        return max(waits)
+
+    def acquire(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        if self.ledger:
+            while (wait := self.ledger.try_reserve(tokens)) > 0:
+                time.sleep(wait)
+
+    async def acquire_async(self, tokens: int) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if self.ledger:
+            while (wait := self.ledger.try_reserve(tokens)) > 0:
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated: int, actual: int | None) -> None:
+        """Correct the up-front token charge once the real usage is known."""
+        if self.tokens and actual is not None:
+            self.tokens.refund(estimated - actual)
+        if self.ledger and actual is not None:
+            self.ledger.settle(estimated, actual)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back all dispatch on this model for the given time (Retry-After)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+@contextlib.contextmanager
+def locked_file(path: Path):
+    """Exclusive advisory lock on path (fcntl on POSIX, msvcrt on Windows)."""
+    with path.open("a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:   # LK_LOCK gives up after ~10 s; keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SharedRateLedger:
+    """
+    File-backed rate ledger shared by every grader process on this host.
+
+    The ledger file lists the runs currently active (refreshed on every
+    request, dropped after stale_seconds of silence) and the requests and
+    tokens each run dispatched in the last minute. A run may dispatch only
+    while it stays within limit / active runs, so concurrent runs split the
+    key's capacity fairly instead of each assuming it owns all of it.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(
+        self,
+        directory: Path,
+        name: str,
+        requests_per_minute: float | None,
+        tokens_per_minute: float | None,
+        stale_seconds: float = 90.0
+    ):
+        directory.mkdir(parents=True, exist_ok=True)
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        self.data_path = directory / f"{safe}.json"
+        self.lock_path = directory / f"{safe}.lock"
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.stale_seconds = stale_seconds
+        self.run_id = f"{os.getpid()}-{int(time.time() * 1000)}"
+
+    def _load(self) -> dict:
+        try:
+            state = json.loads(self.data_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault("runs", {})
+        state.setdefault("events", [])
+        return state
+
+    def _save(self, state: dict) -> None:
+        tmp = self.data_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(state), encoding="utf-8")
+        os.replace(tmp, self.data_path)
+
+    def try_reserve(self, tokens: int) -> float:
+        """Record one request if this run's share allows it; else return seconds to wait."""
+        with locked_file(self.lock_path):
+            state = self._load()
+            now = time.time()
+            state["events"] = [e for e in state["events"] if now - e[0] < self.WINDOW]
+            state["runs"] = {r: t for r, t in state["runs"].items() if now - t < self.stale_seconds}
+            state["runs"][self.run_id] = now
+            active = len(state["runs"])
+            mine = [e for e in state["events"] if e[1] == self.run_id]
+
+            wait = 0.0
+            for idx, limit, amount in ((2, self.rpm, 1), (3, self.tpm, tokens)):
+                if not limit:
+                    continue
+                share = limit / active
+                amount = min(amount, share)   # an oversized request still goes once the window is clear
+                if sum(e[idx] for e in mine) + amount > share:
+                    wait = max(wait, min(e[0] for e in mine) + self.WINDOW - now)
+                elif sum(e[idx] for e in state["events"]) + amount > limit:
+                    wait = max(wait, min(e[0] for e in state["events"]) + self.WINDOW - now)
+
+            if wait <= 0:
+                state["events"].append([now, self.run_id, 1, tokens])
+            self._save(state)
+            return max(0.05, wait) if wait > 0 else 0.0
+
+    def settle(self, estimated: int, actual: int) -> None:
+        """Record the difference between the estimated and reported token usage."""
+        if not self.tpm or actual == estimated:
+            return
+        with locked_file(self.lock_path):
+            state = self._load()
+            state["events"].append([time.time(), self.run_id, 0, actual - estimated])
+            self._save(state)
+
+    def close(self) -> None:
+        """Leave the ledger so the remaining runs get the capacity back."""
+        try:
+            with locked_file(self.lock_path):
+                state = self._load()
+                state["runs"].pop(self.run_id, None)
+                self._save(state)
+        except OSError:
+            pass
+
+
+# model name → RateLimiter, filled from config by configure_rate_limits()
+RATE_LIMITERS: dict[str, RateLimiter] = {}
+
+
+def configure_rate_limits(settings: dict) -> None:
+    """
+    Build per-model limiters from global_config.json:
+      "rate_limits": {
+        "gpt-5-mini": {"requests_per_minute": 500, "tokens_per_minute": 200000}
+      },
+      "shared_rate_ledger": {"directory": "~/.cache/repo-grading-assistant/ledger"}
+
+    With shared_rate_ledger set, the limits are shared with every other
+    grader process on this host using the same API key (SharedRateLedger).
+    """
+    RATE_LIMITERS.clear()
+    ledger_cfg = settings.get("shared_rate_ledger")
+    if ledger_cfg:
+        ledger_cfg = ledger_cfg if isinstance(ledger_cfg, dict) else {}
+        ledger_dir = Path(
+            ledger_cfg.get("directory") or Path.home() / ".cache" / "repo-grading-assistant" / "ledger"
+        ).expanduser()
+        # Runs share a ledger only when they spend the same key
+        key_scope = hashlib.sha256(os.getenv("OPENAI_API_KEY", "").encode("utf-8")).hexdigest()[:12]
+
+    for model_name, limits in (settings.get("rate_limits") or {}).items():
+        rpm = limits.get("requests_per_minute")
+        tpm = limits.get("tokens_per_minute")
+        if rpm or tpm:
+            limiter = RATE_LIMITERS[model_name] = RateLimiter(rpm, tpm)
+            logging.info(f"[RATE LIMIT] {model_name}: {rpm or '∞'} req/min, {tpm or '∞'} tokens/min")
+            if ledger_cfg:
+                limiter.ledger = SharedRateLedger(ledger_dir, f"{key_scope}-{model_name}", rpm, tpm)
+                atexit.register(limiter.ledger.close)
+                logging.info(f"[RATE LIMIT] {model_name}: sharing limits with other runs via {ledger_dir}")
+
+
+def estimate_message_tokens(messages: list[dict]) -> int:
+    """Estimated prompt tokens for a chat request (content plus per-message overhead)."""
+    return sum(estimate_tokens(str(m.get("content") or "")) + 4 for m in messages)
+
+
+def response_total_tokens(resp) -> int | None:
+    """usage.total_tokens from a chat completion response, if reported."""
+    try:
+        return int(resp["usage"]["total_tokens"])
+    except (KeyError, TypeError, ValueError):
+        usage = getattr(resp, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        return int(total) if total is not None else None
+
+
+def response_cached_tokens(resp) -> int | None:
+    """usage.prompt_tokens_details.cached_tokens (prompt tokens served from the provider's cache)."""
+    try:
+        return int(resp["usage"]["prompt_tokens_details"]["cached_tokens"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_reset_duration(value: str) -> float | None:
+    """Parse rate-limit reset durations such as '1s', '250ms' or '6m0s' into seconds."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", str(value))
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(n) * scale[unit] for n, unit in parts)
+
+
+def rate_limit_delay(error: Exception, fallback: float) -> float:
+    """
+    How long to back off after a 429: Retry-After(-ms) if the provider sent
+    it, else the longest x-ratelimit-reset-* header, else the fallback.
+    """
+    headers = {str(k).lower(): v for k, v in (getattr(error, "headers", None) or {}).items()}
+
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000.0
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+
+    resets = [
+        parse_reset_duration(headers[h])
+        for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if h in headers
+    ]
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else fallback
+
+
+# ---------------------------------------------------------------------------
+# API Key Pool (several keys / endpoints, least-loaded dispatch)
+# ---------------------------------------------------------------------------
+
+class PooledKey:
+    """One credential/endpoint in an API key pool, with its own rate accounting."""
+
+    def __init__(self, name: str, backend: OpenAIBackend, limiter: RateLimiter | None):
+        self.name = name
+        self.backend = backend
+        self.limiter = limiter
+        self.in_flight = 0
+        self.requests = 0
+        self.tokens = 0
+        self.removed: str | None = None
+
+    def load(self) -> tuple[float, int]:
+        """Sort key for least-loaded dispatch: seconds still paused, then requests in flight."""
+        paused = self.limiter.paused_until - time.monotonic() if self.limiter else 0.0
+        return max(0.0, paused), self.in_flight
+
+
+def is_key_unusable_error(error: BaseException) -> bool:
+    """Auth failures and exhausted quota: the key will not recover during this run."""
+    if isinstance(error, (AuthenticationError, APIPermissionError)):
+        return True
+    return isinstance(error, RateLimitError) and (
+        getattr(error, "code", None) == "insufficient_quota" or "quota" in str(error).lower()
+    )
+
+
+class KeyPoolBackend:
+    """
+    Spreads requests over several API keys / endpoints. Each request goes
+    to the least-loaded key (not paused by a 429, fewest requests in
+    flight) and is paced by that key's own request/token limits. A key that
+    returns an auth or quota error is removed from the pool and the request
+    moves to the next key; 429s pause only the key that received them.
+    """
+
+    name = "pool"
+    requires_api_key = False
+
+    def __init__(self, keys: list[PooledKey]):
+        if not keys:
+            raise ValueError("api_pool has no usable keys")
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    def identity(self) -> dict:
+        return {"type": self.name, "keys": [[k.name, k.backend.identity()["base_url"]] for k in self.keys]}
+
+    def _checkout(self) -> PooledKey:
+        with self.lock:
+            live = [k for k in self.keys if not k.removed]
+            if not live:
+                raise AuthenticationError("All pooled API keys were removed (auth or quota errors)")
+            key = min(live, key=PooledKey.load)
+            key.in_flight += 1
+            return key
+
+    def _checkin(self, key: PooledKey, estimate: int, resp=None, error: BaseException | None = None) -> bool:
+        """Release the key; returns True if the request should move to another key."""
+        with self.lock:
+            key.in_flight -= 1
+            key.requests += 1
+        if error is None:
+            actual = response_total_tokens(resp)
+            with self.lock:
+                key.tokens += actual if actual is not None else estimate
+            if key.limiter:
+                key.limiter.settle(estimate, actual)
+            return False
+        if is_key_unusable_error(error):
+            with self.lock:
+                key.removed = str(error)
+                remaining = sum(1 for k in self.keys if not k.removed)
+            logging.error(f"[KEYPOOL] Removed key {key.name}: {error} ({remaining} key(s) left)")
+            return True
+        if isinstance(error, RateLimitError) and key.limiter:
+            key.limiter.pause(rate_limit_delay(error, 5.0))
+        return False
+
+    def create(self, messages: list[dict], **kwargs):
+        estimate = estimate_message_tokens(messages)
+        while True:
+            key = self._checkout()
+            if key.limiter:
+                key.limiter.acquire(estimate)
+            try:
+                resp = key.backend.create(messages=messages, **kwargs)
+            except Exception as e:
+                if self._checkin(key, estimate, error=e):
+                    continue
+                raise
+            self._checkin(key, estimate, resp)
+            return resp
+
+    async def acreate(self, messages: list[dict], **kwargs):
+        estimate = estimate_message_tokens(messages)
+        while True:
+            key = self._checkout()
+            if key.limiter:
+                await key.limiter.acquire_async(estimate)
+            try:
+                resp = await key.backend.acreate(messages=messages, **kwargs)
+            except Exception as e:
+                if self._checkin(key, estimate, error=e):
+                    continue
+                raise
+            self._checkin(key, estimate, resp)
+            return resp
+
+    def log_usage(self) -> None:
+        for key in self.keys:
+            state = f"removed ({key.removed})" if key.removed else "active"
+            logging.info(f"[KEYPOOL] {key.name}: {key.requests} request(s), ~{key.tokens} tokens, {state}")
+
+
+def build_key_pool(entries: list[dict]) -> KeyPoolBackend:
+    """
+    "api_pool": [
+      {"name": "dept-a", "api_key_env": "OPENAI_KEY_A", "requests_per_minute": 500, "tokens_per_minute": 200000},
+      {"name": "lab-server", "base_url": "http://gpu01:8000/v1", "api_key_env": "LAB_KEY"}
+    ]
+    Entries whose api_key_env is unset are skipped.
+    """
+    keys = []
+    for i, entry in enumerate(entries):
+        name = entry.get("name") or f"key{i + 1}"
+        key_env = entry.get("api_key_env", "OPENAI_API_KEY")
+        api_key = os.getenv(key_env)
+        if not api_key:
+            logging.warning(f"[KEYPOOL] Skipping {name}: environment variable {key_env} is not set")
+            continue
+        rpm, tpm = entry.get("requests_per_minute"), entry.get("tokens_per_minute")
+        keys.append(PooledKey(
+            name,
+            OpenAIBackend(base_url=entry.get("base_url"), api_key=api_key),
+            RateLimiter(rpm, tpm) if (rpm or tpm) else None,
+        ))
+    logging.info(f"[KEYPOOL] {len(keys)} key(s): {', '.join(k.name for k in keys)}")
+    return KeyPoolBackend(keys)
+
+
+# ---------------------------------------------------------------------------
+# Adaptive Concurrency (AIMD limit on in-flight API requests)
+# ---------------------------------------------------------------------------
+
+class ConcurrencyController:
+    """
+    Additive-increase / multiplicative-decrease limit on in-flight requests.
+
+    Every healthy response raises the limit by step / limit (about +step per
+    full window of requests). A 429, a timeout, an error rate above
+    max_error_rate, or a p95 latency above p95_tolerance × the best p95 seen
+    so far multiplies the limit by decrease_factor, at most once per
+    cooldown period. The limit always stays within [floor, ceiling].
+    """
+
+    def __init__(
+        self,
+        floor: int = 1,
+        ceiling: int = 16,
+        initial: int | None = None,
+        step: float = 1.0,
+        decrease_factor: float = 0.5,
+        p95_tolerance: float = 1.5,
+        max_error_rate: float = 0.1,
+        window: int = 50,
+        cooldown_seconds: float = 5.0
+    ):
+        self.floor = max(1, int(floor))
+        self.ceiling = max(self.floor, int(ceiling))
+        self.limit = float(min(self.ceiling, max(self.floor, initial or self.floor)))
+        self.step = step
+        self.decrease_factor = decrease_factor
+        self.p95_tolerance = p95_tolerance
+        self.max_error_rate = max_error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.best_p95: float | None = None
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    # -- slot accounting ---------------------------------------------------
+
+    def try_acquire(self) -> bool:
+        with self.cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self) -> None:
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait(timeout=0.5)
+            self.in_flight += 1
+
+    async def acquire_async(self) -> None:
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self, latency: float, outcome: str) -> None:
+        with self.cond:
+            self.in_flight -= 1
+            if outcome != "cancelled":
+                self._record(latency, outcome)
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, acquired: bool = False):
+        """Hold a slot for the body; acquired=True takes over one from try_acquire()."""
+        if not acquired:
+            self.acquire()
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except BaseException as e:
+            outcome = classify_request_error(e)
+            raise
+        finally:
+            self.release(time.monotonic() - started, outcome)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, acquired: bool = False):
+        if not acquired:
+            await self.acquire_async()
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"          # e.g. the losing half of a hedged pair
+            raise
+        except BaseException as e:
+            outcome = classify_request_error(e)
+            raise
+        finally:
+            self.release(time.monotonic() - started, outcome)
+
+    # -- AIMD --------------------------------------------------------------
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < 10:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def _record(self, latency: float, outcome: str) -> None:
+        self.outcomes.append(outcome == "ok")
+        if outcome == "ok":
+            self.latencies.append(latency)
+
+        if outcome in ("rate_limited", "timeout"):
+            self._decrease(outcome)
+            return
+
+        errors = self.outcomes.count(False)
+        if len(self.outcomes) >= 10 and errors / len(self.outcomes) > self.max_error_rate:
+            self._decrease(f"error rate {errors}/{len(self.outcomes)}")
+            return
+
+        p95 = self.p95()
+        if p95 is not None:
+            if self.best_p95 is None or p95 < self.best_p95:
+                self.best_p95 = p95
+            elif p95 > self.best_p95 * self.p95_tolerance:
+                self._decrease(f"p95 {p95:.1f}s > {self.p95_tolerance}× {self.best_p95:.1f}s")
+                return
+
+        if outcome == "ok":
+            self._set_limit(self.limit + self.step / max(1.0, self.limit), "healthy")
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown_seconds:
+            return
+        self.last_decrease = now
+        self.latencies.clear()
+        self.outcomes.clear()
+        self._set_limit(self.limit * self.decrease_factor, reason)
+
+    def _set_limit(self, value: float, reason: str) -> None:
+        old = int(self.limit)
+        self.limit = min(float(self.ceiling), max(float(self.floor), value))
+        if int(self.limit) != old:
+            logging.info(f"[CONCURRENCY] limit {old} → {int(self.limit)} ({reason}, in flight {self.in_flight})")
+
+
+def classify_request_error(error: BaseException) -> str:
+    """
+    Classify a failed API call:
+      rate_limited  429
+      timeout       request timed out
+      connection    network / connection failure
+      server        5xx and service-unavailable errors
+      client        other 4xx (bad request, auth, content) — never retried
+    """
+    if isinstance(error, RateLimitError):
+        return "rate_limited"
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError, TimeoutError, requests.exceptions.Timeout)):
+        return "timeout"
+    if isinstance(error, (APIConnectionError, requests.exceptions.RequestException)):
+        return "connection"
+    if aiohttp is not None and isinstance(error, aiohttp.ClientError):
+        return "connection"
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    if isinstance(error, ServiceUnavailableError) or (status and int(status) >= 500):
+        return "server"
+    if isinstance(error, APIError) and not status:
+        return "server"
+    return "client"
+
+
+# Process-wide controller, set from config by configure_concurrency()
+CONCURRENCY: ConcurrencyController | None = None
+
+
+def configure_concurrency(settings: dict) -> ConcurrencyController | None:
+    """
+    Create the adaptive controller from config (None when not configured):
+      "adaptive_concurrency": {"floor": 2, "ceiling": 32, "initial": 4,
+                               "decrease_factor": 0.5, "p95_tolerance": 1.5}
+    """
+    global CONCURRENCY
+    raw = settings.get("adaptive_concurrency")
+    if not raw:
+        CONCURRENCY = None
+        return None
+
+    raw = raw if isinstance(raw, dict) else {}
+    allowed = {"floor", "ceiling", "initial", "step", "decrease_factor",
+               "p95_tolerance", "max_error_rate", "window", "cooldown_seconds"}
+    CONCURRENCY = ConcurrencyController(**{k: v for k, v in raw.items() if k in allowed})
+    logging.info(
+        f"[CONCURRENCY] adaptive limit {int(CONCURRENCY.limit)} "
+        f"(floor {CONCURRENCY.floor}, ceiling {CONCURRENCY.ceiling})"
+    )
+    return CONCURRENCY
+
+
+def concurrency_slot():
+    """Context manager holding an adaptive-concurrency slot (no-op if disabled)."""
+    return CONCURRENCY.slot() if CONCURRENCY else contextlib.nullcontext()
+
+
+def concurrency_slot_async():
+    return CONCURRENCY.slot_async() if CONCURRENCY else contextlib.nullcontext()
+
+
+def spare_concurrency_slot(asynchronous: bool = False):
+    """
+    Slot for a hedged duplicate if one is free right now, else None. A
+    duplicate never queues for a slot behind the request it duplicates.
+    """
+    if not CONCURRENCY:
+        return contextlib.nullcontext()
+    if not CONCURRENCY.try_acquire():
+        return None
+    return CONCURRENCY.slot_async(acquired=True) if asynchronous else CONCURRENCY.slot(acquired=True)
+
+
+# ---------------------------------------------------------------------------
+# Retry Policy, Circuit Breaker and Deferred Retries
+# ---------------------------------------------------------------------------
+
+# Attempts per request for each error class (1 = no retry). Students whose
+# request still fails with a retryable class are deferred to the end of the run.
+RETRY_ATTEMPTS = {
+    "rate_limited": 4,
+    "timeout": 2,
+    "connection": 3,
+    "server": 3,
+    "client": 1,
+}
+RETRYABLE_ERRORS = {"rate_limited", "timeout", "connection", "server"}
+
+# Error class of the last request that gave up, for the current thread / task.
+# grade_student uses it to decide whether a failed student is worth deferring.
+LAST_REQUEST_FAILURE: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "LAST_REQUEST_FAILURE", default=None
+)
+
+
+def backoff_delay(attempt: int, base: float = 1.5, cap: float = 10.0) -> float:
+    """Exponential backoff with jitter: a random delay in [d/2, d], d = base·2^(attempt-1)."""
+    d = min(cap, base * (2 ** (attempt - 1)))
+    return d / 2 + random.uniform(0, d / 2)
+
+
+class CircuitBreaker:
+    """
+    Per-run breaker for provider outages. After failure_threshold consecutive
+    server/connection/timeout failures it opens and all dispatch waits for
+    reset_seconds; then one probe request is let through. A successful probe
+    closes the breaker; a failed one re-opens it with a doubled wait. Any
+    other outcome (429, 4xx) just releases the probe slot for the next caller.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0, max_reset_seconds: float = 300.0):
+        self.failure_threshold = failure_threshold
+        self.base_reset = reset_seconds
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max_reset_seconds
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def _ready(self) -> tuple[float, bool]:
+        """(0, is_probe) if the caller may dispatch now, else (seconds to wait, False)."""
+        with self.lock:
+            now = time.monotonic()
+            if self.failures < self.failure_threshold:
+                return 0.0, False
+            if now < self.open_until:
+                return self.open_until - now, False
+            if self.probing:
+                return 0.5, False
+            self.probing = True           # half-open: this caller is the probe
+            logging.info("[CIRCUIT] half-open; sending a probe request")
+            return 0.0, True
+
+    def wait(self) -> bool:
+        """Block while open. Returns True if the caller is the half-open probe."""
+        while True:
+            delay, probe = self._ready()
+            if delay <= 0:
+                return probe
+            time.sleep(min(delay, 5.0))
+
+    async def wait_async(self) -> bool:
+        while True:
+            delay, probe = self._ready()
+            if delay <= 0:
+                return probe
+            await asyncio.sleep(min(delay, 5.0))
+
+    def release_probe(self) -> None:
+        """Free the probe slot; called after every probe attempt, whatever its outcome."""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.failures >= self.failure_threshold:
+                logging.info("[CIRCUIT] closed; provider is responding again")
+            self.failures = 0
+            self.probing = False
+            self.reset_seconds = self.base_reset
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                self.reset_seconds = min(self.max_reset_seconds, self.reset_seconds * 2)
+            if self.failures >= self.failure_threshold and (self.probing or time.monotonic() >= self.open_until):
+                self.open_until = time.monotonic() + self.reset_seconds
+                logging.warning(
+                    f"[CIRCUIT] open for {self.reset_seconds:.0f}s after {self.failures} consecutive failures; "
+                    "pausing all dispatch"
+                )
+            self.probing = False
+
+
+# Per-run breaker, set by configure_circuit_breaker()
+CIRCUIT_BREAKER: CircuitBreaker | None = None
+
+
+def configure_circuit_breaker(settings: dict) -> CircuitBreaker | None:
+    """
+    "circuit_breaker": {"failure_threshold": 5, "reset_seconds": 30}
+    Enabled with these defaults unless set to false.
+    """
+    global CIRCUIT_BREAKER
+    raw = settings.get("circuit_breaker", {})
+    if raw is False:
+        CIRCUIT_BREAKER = None
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    CIRCUIT_BREAKER = CircuitBreaker(
+        failure_threshold=int(raw.get("failure_threshold", 5)),
+        reset_seconds=float(raw.get("reset_seconds", 30)),
+    )
+    return CIRCUIT_BREAKER
+
+
+def retry_plan(error: Exception, attempt: int) -> tuple[str, float | None]:
+    """
+    Decide what to do after a failed attempt. Returns (error class, delay);
+    delay is None when the request should not be retried.
+    """
+    kind = classify_request_error(error)
+    if kind == "client" or attempt >= RETRY_ATTEMPTS[kind]:
+        return kind, None
+    if kind == "rate_limited":
+        return kind, rate_limit_delay(error, backoff_delay(attempt + 1, cap=30.0))
+    return kind, backoff_delay(attempt)
+
+
+# ---------------------------------------------------------------------------
+# Request Hedging (duplicate slow requests, first response wins)
+# ---------------------------------------------------------------------------
+
+class RequestHedger:
+    """
+    Sends a duplicate of any request still in flight after the learned
+    latency percentile; the first successful response wins and the other
+    is cancelled (async) or abandoned (threads cannot be interrupted: it
+    runs to completion, is billed, and its result is discarded).
+
+    The hedge delay is the given percentile of the last `window` winning
+    latencies, and only starts once min_samples requests have finished.
+    Hedges are capped at max_hedge_rate × requests sent so far, and each
+    duplicate holds its own concurrency slot (no hedge when none is free).
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        max_hedge_rate: float = 0.05,
+        min_samples: int = 20,
+        min_delay: float = 1.0,
+        window: int = 200
+    ):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def _start(self) -> float | None:
+        """Count a request and return its hedge delay (None = never hedge)."""
+        with self.lock:
+            self.requests += 1
+            if not self.latencies or len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+            index = min(len(ordered) - 1, int(self.percentile * len(ordered)))
+            return max(self.min_delay, ordered[index])
+
+    def _allow_hedge(self, asynchronous: bool = False):
+        """Concurrency slot for a duplicate, or None if the rate cap or the slots are used up."""
+        with self.lock:
+            if self.hedges + 1 > self.max_hedge_rate * self.requests:
+                return None
+            slot = spare_concurrency_slot(asynchronous)
+            if slot is not None:
+                self.hedges += 1
+            return slot
+
+    def _record(self, started: float) -> None:
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+
+    @staticmethod
+    def _spawn(fn) -> Future:
+        """
+        Run fn() on its own daemon thread. A shared pool would cap in-flight
+        requests at its size, below --workers / the concurrency ceiling.
+        """
+        future = Future()
+
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+
+        threading.Thread(target=run, name="hedge", daemon=True).start()
+        return future
+
+    @staticmethod
+    def _in_slot(slot, fn):
+        with slot:
+            return fn()
+
+    def call(self, fn, label: str = "", duplicate=None):
+        """
+        Run fn(), hedging it with a second call if it runs long: duplicate()
+        when given (e.g. to take its own rate-limit capacity), else fn().
+        """
+        delay = self._start()
+        started = time.monotonic()
+        if delay is None:
+            result = fn()
+            self._record(started)
+            return result
+
+        pending = {self._spawn(fn)}
+        done, _ = futures_wait(pending, timeout=delay)
+        slot = None if done else self._allow_hedge()
+        if slot is not None:
+            logging.info(f"[HEDGE] {label}: no response after {delay:.1f}s; sending duplicate request")
+            pending.add(self._spawn(functools.partial(self._in_slot, slot, duplicate or fn)))
+
+        while True:
+            done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+            if winner or not pending:
+                for f in pending:
+                    f.cancel()
+                self._record(started)
+                return (winner or done.pop()).result()
+
+    async def call_async(self, factory, label: str = "", duplicate=None):
+        """Async counterpart of call(); factory() and duplicate() return fresh coroutines."""
+        delay = self._start()
+        started = time.monotonic()
+        if delay is None:
+            result = await factory()
+            self._record(started)
+            return result
+
+        async def in_slot(slot):
+            async with slot:
+                return await (duplicate or factory)()
+
+        pending = {asyncio.ensure_future(factory())}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            slot = None if done else self._allow_hedge(asynchronous=True)
+            if slot is not None:
+                logging.info(f"[HEDGE] {label}: no response after {delay:.1f}s; sending duplicate request")
+                pending.add(asyncio.ensure_future(in_slot(slot)))
+
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((f for f in done if f.exception() is None), None)
+                if winner or not pending:
+                    self._record(started)
+                    return (winner or done.pop()).result()
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+# Per-run hedger, set by configure_hedging()
+HEDGER: RequestHedger | None = None
+
+
+def configure_hedging(settings: dict) -> RequestHedger | None:
+    """
+    "hedging": {"percentile": 0.95, "max_hedge_rate": 0.05, "min_samples": 20}
+    Off unless configured (true uses the defaults).
+    """
+    global HEDGER
+    raw = settings.get("hedging")
+    if not raw:
+        HEDGER = None
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    HEDGER = RequestHedger(
+        percentile=float(raw.get("percentile", 0.95)),
+        max_hedge_rate=float(raw.get("max_hedge_rate", 0.05)),
+        min_samples=int(raw.get("min_samples", 20)),
+        min_delay=float(raw.get("min_delay", 1.0)),
+    )
+    logging.info(
+        f"[HEDGE] enabled: duplicate requests slower than p{HEDGER.percentile * 100:.0f}, "
+        f"at most {HEDGER.max_hedge_rate:.0%} of requests"
+    )
+    return HEDGER
+
+
+# ---------------------------------------------------------------------------
+# Response Cache (content-addressed chat completions on disk)
+# ---------------------------------------------------------------------------
+
+DEFAULT_RESPONSE_CACHE_MB = 200
+DEFAULT_RESPONSE_CACHE_DAYS = 30
+
+
+class ResponseCache(SummaryCache):
+    """
+    Chat completion responses stored as JSON, keyed by
+    sha256(backend + model + messages + request parameters), so answers
+    from one server or key pool are never served to a run against another.
+
+    Identical requests made at the same time share one API call: the first
+    caller sends it, the others wait for its result (and, if it failed, its
+    LAST_REQUEST_FAILURE). hits counts responses served from disk or from a
+    shared in-flight request.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, cache_dir: Path, max_bytes: int, max_age_seconds: float | None = None):
+        super().__init__(cache_dir, max_bytes, max_age_seconds)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.in_flight: dict[str, object] = {}
+
+    @staticmethod
+    def request_key(model: str, messages: list[dict], params: dict) -> str:
+        payload = json.dumps(
+            {"backend": BACKEND.identity(), "model": model, "messages": messages, "params": params},
+            sort_keys=True, default=str, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def load(self, key: str):
+        text = self.get(key)
+        if text is None:
+            return None
+        try:
+            return openai.util.convert_to_openai_object(json.loads(text))
+        except ValueError:
+            return None
+
+    def store(self, key: str, resp) -> None:
+        # Only real API objects are stored; anything else is passed through uncached
+        to_dict = getattr(resp, "to_dict_recursive", None)
+        if to_dict is not None:
+            self.put(key, json.dumps(to_dict(), ensure_ascii=False))
+
+    def _claim(self, key: str, make_waiter):
+        """Return (owner, waiter): owner is True for the caller that must send the request."""
+        with self.lock:
+            waiter = self.in_flight.get(key)
+            if waiter is not None:
+                self.hits += 1
+                return False, waiter
+            cached = self.load(key)
+            if cached is not None:
+                self.hits += 1
+                return False, cached
+            self.misses += 1
+            waiter = self.in_flight[key] = make_waiter()
+            return True, waiter
+
+    @staticmethod
+    def _shared(outcome: tuple):
+        """Response from another caller's request, adopting its failure kind if it failed."""
+        resp, failure = outcome
+        if resp is None:
+            LAST_REQUEST_FAILURE.set(failure)
+        return resp
+
+    def through(self, model: str, messages: list[dict], params: dict, send):
+        """Serve the request from cache, or call send() and cache its response."""
+        key = self.request_key(model, messages, params)
+        owner, waiter = self._claim(key, Future)
+        if not owner:
+            return self._shared(waiter.result()) if isinstance(waiter, Future) else waiter
+
+        try:
+            resp = send()
+            if resp is not None:
+                self.store(key, resp)
+        except BaseException as e:
+            waiter.set_exception(e)
+            raise
+        else:
+            waiter.set_result((resp, LAST_REQUEST_FAILURE.get() if resp is None else None))
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+        return resp
+
+    async def through_async(self, model: str, messages: list[dict], params: dict, send):
+        """Async counterpart of through(); send() returns a coroutine."""
+        key = self.request_key(model, messages, params)
+        owner, waiter = self._claim(key, lambda: asyncio.get_running_loop().create_future())
+        if not owner:
+            return self._shared(await waiter) if isinstance(waiter, asyncio.Future) else waiter
+
+        try:
+            resp = await send()
+            if resp is not None:
+                await asyncio.to_thread(self.store, key, resp)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                waiter.cancel()
+            else:
+                waiter.set_exception(e)
+                waiter.exception()  # mark retrieved; waiters (if any) re-raise it
+            raise
+        else:
+            waiter.set_result((resp, LAST_REQUEST_FAILURE.get() if resp is None else None))
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+        return resp
+
+
+# Per-run cache, set by configure_response_cache()
+RESPONSE_CACHE: ResponseCache | None = None
+
+
+def configure_response_cache(settings: dict, default_dir: Path, enabled: bool = True) -> ResponseCache | None:
+    """
+    "response_cache": {"cache_dir": "logs/response_cache", "max_cache_mb": 200, "max_age_days": 30}
+    On by default; disabled with --no-cache or "response_cache": false.
+    Never used with the fake backend (see caching_responses).
+    """
+    global RESPONSE_CACHE
+    raw = settings.get("response_cache", {})
+    if not enabled or raw is False:
+        RESPONSE_CACHE = None
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    max_age_days = float(raw.get("max_age_days", DEFAULT_RESPONSE_CACHE_DAYS))
+    RESPONSE_CACHE = ResponseCache(
+        Path(raw.get("cache_dir") or default_dir).expanduser(),
+        int(float(raw.get("max_cache_mb", DEFAULT_RESPONSE_CACHE_MB)) * 1024 * 1024),
+        max_age_days * 86400 if max_age_days > 0 else None,
+    )
+    return RESPONSE_CACHE
+
+
+def caching_responses() -> bool:
+    """Canned fake-backend reports are not worth caching and must not mix with real ones."""
+    return RESPONSE_CACHE is not None and not isinstance(BACKEND, FakeBackend)
+
+
+# ---------------------------------------------------------------------------
+# Model Routing (submission size → model)
+# ---------------------------------------------------------------------------
+
+# Model that graded the current student, for the CSV (set by grade_submission)
+LAST_GRADING_MODEL: contextvars.ContextVar[str] = contextvars.ContextVar("LAST_GRADING_MODEL", default="")
+
+
+def resolve_model_routes(settings: dict) -> list[tuple[int | None, str]]:
+    """
+    Size-based routing rules, checked in order:
+      "model_routing": [
+        {"max_tokens": 6000, "model": "gpt-5-nano"},
+        {"max_tokens": 60000, "model": "gpt-5-mini"},
+        {"model": "gpt-4.1"}                      # no max_tokens: everything else
+      ]
+    Prompts larger than every rule keep the configured model.
+    """
+    routes = []
+    for rule in settings.get("model_routing") or []:
+        limit = rule.get("max_tokens")
+        routes.append((int(limit) if limit is not None else None, rule["model"]))
+    return routes
+
+
+def route_model(settings: dict, prompt_tokens: int, default_model: str, student_name: str = "") -> str:
+    """Pick the model for a prompt of the given size."""
+    for limit, routed in resolve_model_routes(settings):
+        if limit is None or prompt_tokens <= limit:
+            if routed != default_model:
+                logging.info(f"[ROUTE] {student_name}: ~{prompt_tokens} tokens → {routed}")
+            return routed
+    return default_model
+
+
+# ---------------------------------------------------------------------------
+# Model Cascade (cheap tier first, escalate on structural failures)
+# ---------------------------------------------------------------------------
+
+REPORT_SECTIONS = [
+    "Deductions",
+    "Bonus Credit",
+    "Strengths",
+    "Areas for Improvement",
+    "Score Summary",
+    "Supportive Closing",
+]
+
+# Students handled per cascade tier model, reported at the end of the run
+CASCADE_COUNTS: Counter = Counter()
+CASCADE_LOCK = threading.Lock()
+
+
+def report_problems(report: str, max_score: int) -> list[str]:
+    """
+    Structural checks on a raw model report. Returns the reasons it is not
+    usable as-is (empty list if it passes):
+      - no parseable "Total: X/Y" line
+      - any of the six sections missing
+      - bonus listed but not reflected in the Total (enforce_bonus_alignment)
+      - base score (Total minus bonus) outside 0..max_score
+    """
+    problems = []
+    total = re.search(r"Total:\s*(-?\d+)\s*/\s*(\d+)", report)
+    if not total:
+        problems.append("no parseable Total line")
+
+    missing = [name for name in REPORT_SECTIONS if not re.search(rf"\*\*{re.escape(name)}", report)]
+    if missing:
+        problems.append(f"missing section(s): {', '.join(missing)}")
+
+    if enforce_bonus_alignment(report) != report:
+        problems.append("bonus listed but not included in Total")
+
+    if total:
+        earned = int(total.group(1))
+        bonus = re.search(r"includes\s+(\d+)\s+bonus", report, re.IGNORECASE)
+        base = earned - (int(bonus.group(1)) if bonus else 0)
+        if earned < 0 or base > max_score:
+            problems.append(f"score {earned} outside 0..{max_score}")
+    return problems
+
+
+def resolve_cascade_tiers(settings: dict) -> list[str]:
+    """
+    "cascade": {"tiers": ["gpt-5-nano", "gpt-5-mini"]}
+    Models tried in order; a student moves to the next tier only when the
+    report fails report_problems(). Replaces model / model_routing.
+    """
+    raw = settings.get("cascade")
+    if not raw:
+        return []
+    tiers = raw.get("tiers") if isinstance(raw, dict) else raw
+    return [str(t) for t in tiers or []]
+
+
+def cascade_grade(
+    messages: list[dict],
+    tiers: list[str],
+    max_score: int,
+    student_dir: Path,
+    streaming: bool = False,
+    settings: dict | None = None
+) -> str | None:
+    """
+    Grade with each tier in turn until a report passes the structural
+    checks; the last tier's report is kept whatever its quality. A missing
+    Total line is first repaired in place (repair_report) before escalating.
+    A request that fails outright returns None without escalating, so the
+    student is deferred and retried like any other transport failure.
+    """
+    name = student_dir.name
+    report = None
+    for i, model in enumerate(tiers, start=1):
+        LAST_GRADING_MODEL.set(model)
+        if streaming:
+            report = stream_grading_report(model, messages, student_dir)
+        else:
+            resp = request_completion(model, messages, name)
+            report = resp.choices[0].message["content"] if resp is not None else None
+        if report is None:
+            return None
+        report = repair_report(report, model, max_score, name, settings)
+
+        problems = report_problems(report, max_score)
+        if not problems or i == len(tiers):
+            with CASCADE_LOCK:
+                CASCADE_COUNTS[model] += 1
+            if problems:
+                logging.warning(f"[CASCADE] {name}: last tier {model} report still has: {'; '.join(problems)}")
+            return report
+        logging.info(f"[CASCADE] {name}: escalating {model} → {tiers[i]} ({'; '.join(problems)})")
+    return report
+
+
+# ---------------------------------------------------------------------------
+# Report Repair (re-ask only for a missing / malformed Score Summary)
+# ---------------------------------------------------------------------------
+
+TOTAL_LINE = re.compile(r"Total:\s*\d+\s*/\s*\d+")
+
+REPAIR_PROMPT = """Below is a grading report you wrote. Its Score Summary section is missing or its Total line is not in the required format.
+Do not regrade and do not repeat the report. Using only the deductions and bonus credit already in the report, write just this one section:
+
+5. **Score Summary**
+- The base assignment maximum (DENOMINATOR) is {max_score}.
+- Format strictly as:
+  - "Total: <earned>/{max_score} points (includes <bonus> bonus)" if bonus exists
+  - Otherwise: "Total: <earned>/{max_score} points"
+
+Report:
+{report}"""
+
+
+def merge_score_summary(report: str, section: str) -> str:
+    """Replace the report's Score Summary section with `section`, or insert it before the closing."""
+    section = section.strip()
+    if not re.match(r"\s*(?:5\.\s*)?\*\*Score Summary", section):
+        section = f"5. **Score Summary**\n{section}"
+
+    lines = report.splitlines()
+    header = re.compile(r"^\s*(?:\d\.\s*)?\*\*(.+?)\*\*")
+    start = next((i for i, line in enumerate(lines) if re.match(r"^\s*(?:\d\.\s*)?\*\*Score Summary", line)), None)
+    if start is not None:
+        end = next((j for j in range(start + 1, len(lines)) if header.match(lines[j])), len(lines))
+        return "\n".join(lines[:start] + section.splitlines() + [""] + lines[end:]).strip()
+
+    closing = next((i for i, line in enumerate(lines) if re.match(r"^\s*(?:6\.\s*)?\*\*Supportive Closing", line)), None)
+    if closing is not None:
+        return "\n".join(lines[:closing] + section.splitlines() + [""] + lines[closing:]).strip()
+    return f"{report.rstrip()}\n\n{section}"
+
+
+def repair_report(report: str, model: str, max_score: int, student_name: str, settings: dict | None = None) -> str:
+    """
+    If the report has no parseable Total line, ask the model for just the
+    Score Summary, given only its own report (not the key or submission),
+    and merge the answer back in. Returns the report unchanged when it is
+    fine, repair is disabled ("repair": false), other sections are missing
+    too (a full regrade is needed), or the repair also fails.
+    """
+    if TOTAL_LINE.search(report) or (settings or {}).get("repair") is False:
+        return report
+    missing = [name for name in REPORT_SECTIONS[:4] if not re.search(rf"\*\*{re.escape(name)}", report)]
+    if missing:
+        logging.info(f"[REPAIR] {student_name}: report also lacks {', '.join(missing)}; not repairable")
+        return report
+
+    logging.info(f"[REPAIR] {student_name}: no parseable Total line; requesting the Score Summary only")
+    try:
+        resp = request_completion(
+            model,
+            [{"role": "user", "content": REPAIR_PROMPT.format(max_score=max_score, report=report)}],
+            student_name,
+        )
+    except Exception as e:
+        logging.warning(f"[REPAIR] {student_name}: repair request failed: {e}")
+        return report
+    section = resp.choices[0].message["content"] if resp is not None else ""
+    if not TOTAL_LINE.search(section or ""):
+        logging.warning(f"[REPAIR] {student_name}: repair response had no usable Total line; keeping the report")
+        return report
+
+    logging.info(f"[REPAIR] {student_name}: merged repaired Score Summary")
+    return merge_score_summary(report, section)
+
+
+# ---------------------------------------------------------------------------
+# Structured Output (JSON schema reports rendered locally)
+# ---------------------------------------------------------------------------
+
+# Parsed fields of the current student's structured report, for the CSV
+# (set by grade_submission when "structured_output" is on)
+LAST_REPORT_FIELDS: contextvars.ContextVar[dict | None] = contextvars.ContextVar("LAST_REPORT_FIELDS", default=None)
+
+_SCORED_ITEMS = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"reason": {"type": "string"}, "points": {"type": "integer"}},
+        "required": ["reason", "points"],
+        "additionalProperties": False,
+    },
+}
+
+GRADE_REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "deductions": _SCORED_ITEMS,
+        "bonuses": _SCORED_ITEMS,
+        "strengths": {"type": "array", "items": {"type": "string"}},
+        "improvements": {"type": "array", "items": {"type": "string"}},
+        "earned": {"type": "integer"},
+        "closing": {"type": "string"},
+    },
+    "required": ["deductions", "bonuses", "strengths", "improvements", "earned", "closing"],
+    "additionalProperties": False,
+}
+
+STRUCTURED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "grade_report", "strict": True, "schema": GRADE_REPORT_SCHEMA},
+}
+
+REPORT_TEMPLATE = """1. **Deductions**
+{deductions}
+
+2. **Bonus Credit (if any)**
+{bonuses}
+
+3. **Strengths**
+{strengths}
+
+4. **Areas for Improvement**
+{improvements}
+
+5. **Score Summary**
+{total}
+
+6. **Supportive Closing**
+{closing}"""
+
+
+def parse_structured_report(text: str, max_score: int, student_name: str = "") -> dict:
+    """
+    Validate a JSON grading report against GRADE_REPORT_SCHEMA and the
+    score rules. Returns the fields plus computed "bonus", "total" and
+    "max_score"; raises ValueError describing the first problem. An earned
+    score that disagrees with the listed deductions is replaced by
+    max(0, max_score - deductions) so the report and CSV stay consistent.
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"not valid JSON ({e})") from None
+    if not isinstance(data, dict):
+        raise ValueError("top level is not an object")
+
+    missing = [k for k in GRADE_REPORT_SCHEMA["required"] if k not in data]
+    if missing:
+        raise ValueError(f"missing field(s): {', '.join(missing)}")
+
+    for key in ("deductions", "bonuses"):
+        items = data[key]
+        if not isinstance(items, list) or not all(
+            isinstance(i, dict) and isinstance(i.get("reason"), str)
+            and isinstance(i.get("points"), int) and not isinstance(i.get("points"), bool)
+            and i["points"] >= 0
+            for i in items
+        ):
+            raise ValueError(f"{key} must be a list of {{reason, points >= 0}}")
+    for key in ("strengths", "improvements"):
+        if not isinstance(data[key], list) or not all(isinstance(i, str) for i in data[key]):
+            raise ValueError(f"{key} must be a list of strings")
+    if not isinstance(data["closing"], str):
+        raise ValueError("closing must be a string")
+
+    earned = data["earned"]
+    if not isinstance(earned, int) or isinstance(earned, bool) or not 0 <= earned <= max_score:
+        raise ValueError(f"earned {earned!r} outside 0..{max_score}")
+
+    expected = max(0, max_score - sum(d["points"] for d in data["deductions"]))
+    if earned != expected:
+        logging.warning(
+            f"[STRUCTURED] {student_name}: earned {earned} does not match deductions; "
+            f"using {expected}/{max_score}"
+        )
+        data["earned"] = earned = expected
+
+    bonus = sum(i["points"] for i in data["bonuses"])
+    return {**data, "bonus": bonus, "total": earned + bonus, "max_score": max_score}
+
+
+def render_structured_report(fields: dict) -> str:
+    """The six-section grade_summary.txt text for parsed structured fields."""
+    deductions = [f"- {d['reason'].strip()} (-{d['points']} points)" for d in fields["deductions"]]
+    bonuses = [f"- {b['reason'].strip()} (+{b['points']} bonus)" for b in fields["bonuses"]]
+    if fields["bonus"]:
+        total = f"Total: {fields['total']}/{fields['max_score']} points (includes {fields['bonus']} bonus)"
+    else:
+        total = f"Total: {fields['total']}/{fields['max_score']} points"
+    return REPORT_TEMPLATE.format(
+        deductions="\n".join(deductions) or "- None.",
+        bonuses="\n".join(bonuses) or "None",
+        strengths=" ".join(s.strip() for s in fields["strengths"]),
+        improvements=" ".join(s.strip() for s in fields["improvements"]),
+        total=total,
+        closing=fields["closing"].strip(),
+    )
+
+
+def finish_structured_report(text: str, max_score: int, student_name: str) -> str | None:
+    """Parse and render a structured reply, leaving its fields in LAST_REPORT_FIELDS; None if invalid."""
+    try:
+        fields = parse_structured_report(text, max_score, student_name)
+    except ValueError as e:
+        logging.error(f"[STRUCTURED] {student_name}: rejected report: {e}")
+        return None
+    LAST_REPORT_FIELDS.set(fields)
+    return render_structured_report(fields)
+
+
+# ---------------------------------------------------------------------------
+# Grading Logic
+# ---------------------------------------------------------------------------
+
+def build_grading_prefix(system_prompt: str, key_text: str, max_score: int, structured: bool = False) -> str:
+    """
+    The unchanging part of every grading request: system prompt, key and
+    response format. It is sent first, byte-for-byte identical for every
+    student, so the provider's prompt cache can reuse it. With structured=True
+    the format is the JSON fields of GRADE_REPORT_SCHEMA instead of Markdown.
+    """
+    if structured:
+        return f"""{system_prompt}
+
+Answer Key:
+{key_text}
+
+Respond with a JSON object with these fields, in plain sentences without Markdown:
+- deductions: each deduction, with a brief explanation (reason) and the points lost.
+- bonuses: each bonus feature that was found and why it qualifies, with its bonus points. Empty if none.
+- strengths: two sentences about what was done well.
+- improvements: two sentences about what to work on.
+- earned: the base maximum of {max_score} minus the deduction points (not below 0), before bonus points.
+- closing: one encouraging sentence to the student.
+
+The submission to grade follows in the next message.
+"""
+
+    return f"""{system_prompt}
+
+Answer Key:
+{key_text}
+
+Respond using the following format:
+
+1. **Deductions**
+- List each deduction with brief explanation and points lost.
+
+2. **Bonus Credit (if any)**
+- List each bonus feature that was found and why it qualifies, in plain language.
+- If no bonuses were earned, write "None".
+
+3. **Strengths**
+- Two sentences about what was done well.
+
+4. **Areas for Improvement**
+- Two sentences about what to work on.
+
+5. **Score Summary**
+- The base assignment maximum (DENOMINATOR) is {max_score}.
+- Bonus points are added to the final score and MAY exceed the denominator.
+- Format strictly as:
+  - "Total: <earned>/{max_score} points (includes <bonus> bonus)" if bonus exists
+  - Otherwise: "Total: <earned>/{max_score} points"
+  - "Total: 75/60 points (includes 15 bonus)" would be valid
+
+6. **Supportive Closing**
+- One encouraging sentence to the student.
+
+The submission to grade follows in the next message.
+"""
+
+
+def build_grading_messages(
+    system_prompt: str,
+    key_text: str,
+    combined_text: str,
+    max_score: int,
+    submission_label: str = "Student Submission",
+    structured: bool = False
+) -> list[dict]:
+    """Chat messages for a grading call: the shared prefix, then the submission."""
+    return [
+        {"role": "system", "content": build_grading_prefix(system_prompt, key_text, max_score, structured)},
+        {"role": "user", "content": f"{submission_label}:\n{combined_text}"},
+    ]
+
+
+def log_prompt_cache_usage(resp, student_name: str) -> None:
+    """Log how many prompt tokens the provider served from its prefix cache."""
+    cached = response_cached_tokens(resp)
+    if cached is None:
+        return
+    try:
+        prompt_tokens = int(resp["usage"]["prompt_tokens"])
+    except (KeyError, TypeError, ValueError):
+        prompt_tokens = 0
+    share = f" ({cached / prompt_tokens:.0%})" if prompt_tokens else ""
+    logging.info(f"[PROMPT-CACHE] {student_name}: {cached}/{prompt_tokens} prompt tokens cached{share}")
+
+
+def request_completion(model: str, messages: list[dict], student_name: str, **params):
+    """
+    Chat completion for one grading request, served from the response cache
+    when an identical request was already answered (see send_completion).
+    """
+    if caching_responses():
+        return RESPONSE_CACHE.through(
+            model, messages, params, lambda: send_completion(model, messages, student_name, **params)
+        )
+    return send_completion(model, messages, student_name, **params)
+
+
+def send_hedged(send, limiter: RateLimiter | None, estimate: int):
+    """A hedged duplicate is a real request: it waits for and settles its own rate-limit capacity."""
+    if limiter:
+        limiter.acquire(estimate)
+    resp = send()
+    if limiter:
+        limiter.settle(estimate, response_total_tokens(resp))
+    return resp
+
+
+async def send_hedged_async(send, limiter: RateLimiter | None, estimate: int):
+    """Async counterpart of send_hedged."""
+    if limiter:
+        await limiter.acquire_async(estimate)
+    resp = await send()
+    if limiter:
+        limiter.settle(estimate, response_total_tokens(resp))
+    return resp
+
+
+def send_completion(model: str, messages: list[dict], student_name: str, consume=None, **params):
+    """
+    Call the chat completion API with the classified retry policy
+    (RETRY_ATTEMPTS, jittered exponential backoff). Extra params (tools, ...)
+    are passed through.
+
+    consume(resp), if given, is run on each attempt's response inside the
+    concurrency slot and the retry loop, and its result is returned. Streamed
+    requests use it so the slot, latency sample, circuit breaker and retries
+    cover the whole stream rather than just its opening. Such requests are
+    never hedged.
+
+    If a rate limiter is configured for the model, each attempt first waits
+    for request/token capacity, and 429 responses pause the limiter for the
+    Retry-After time the provider asked for. While the circuit breaker is
+    open, dispatch waits.
+
+    Returns the response, or None once retries are exhausted (the error class
+    is left in LAST_REQUEST_FAILURE). Client errors propagate to the caller.
+    """
+    limiter = RATE_LIMITERS.get(model)
+    estimate = estimate_message_tokens(messages)
+    attempt = 0
+
+    while True:
+        attempt += 1
+        probe = CIRCUIT_BREAKER.wait() if CIRCUIT_BREAKER else False
+        if limiter:
+            limiter.acquire(estimate)
+        try:
+            with concurrency_slot():
+                send = functools.partial(
+                    BACKEND.create,
+                    model=model,
+                    messages=messages,
+                    request_timeout=120,
+                    **params,
+                )
+                if HEDGER and consume is None:
+                    resp = HEDGER.call(send, student_name, functools.partial(send_hedged, send, limiter, estimate))
+                else:
+                    resp = send()
+                if consume is not None:
+                    resp = consume(resp)
+        except Exception as e:
+            kind, delay = retry_plan(e, attempt)
+            if kind == "client":
+                raise
+            if kind != "rate_limited" and CIRCUIT_BREAKER:
+                CIRCUIT_BREAKER.record_failure()
+            if delay is None:
+                logging.error(f"OpenAI {kind} error after {attempt} attempt(s) for {student_name}: {e}")
+                LAST_REQUEST_FAILURE.set(kind)
+                return None
+
+            logging.warning(
+                f"OpenAI {kind} error for {student_name} (attempt {attempt}/{RETRY_ATTEMPTS[kind]}): {e}. "
+                f"Retrying in {delay:.1f}s..."
+            )
+            if kind == "rate_limited" and limiter:
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            continue
+        finally:
+            if probe:
+                CIRCUIT_BREAKER.release_probe()
+
+        if CIRCUIT_BREAKER:
+            CIRCUIT_BREAKER.record_success()
+        if limiter:
+            actual = response_total_tokens(resp)
+            if actual is None and isinstance(resp, str):
+                actual = estimate + estimate_tokens(resp)     # streamed text: usage is not reported
+            limiter.settle(estimate, actual)
+        log_prompt_cache_usage(resp, student_name)
+        return resp
+
+
+def postprocess_result(result_text: str, key_text: str, max_score: int, student_name: str) -> str:
+    """Apply the standard post-processing to a model report."""
+    result_text = result_text.strip()
+
+    # Infer bonus behavior if LLM implied it but did not apply it to Total
+    result_text = infer_bonus_if_needed(result_text, key_text, student_name)
+
+    # Enforce that Bonus section and Score Summary agree
+    result_text = enforce_bonus_alignment(result_text)
+
+    # Force denominator to remain base maximum
+    result_text = enforce_base_max(result_text, max_score)
+
+    return result_text
+
+
+def is_context_length_error(error: Exception) -> bool:
+    """True if the API rejected the request because the prompt is too long."""
+    text = str(error).lower()
+    return "context length" in text or "context_length_exceeded" in text or "too many tokens" in text
+
+
+def assemble_submission_text(
+    student_dir: Path,
+    key_text: str,
+    required_files: list,
+    exclusions: list[str],
+    settings: dict,
+    summarize: bool = True
+) -> tuple[list[dict], str, bool]:
+    """
+    Collect and format the submission for the prompt, applying the optional
+    retrieval stage to oversized submissions.
+    Returns (files, combined_text, compact).
+    """
+    files = collect_submission_files(student_dir, required_files, exclusions, settings, summarize)
+    compact = bool(resolve_normalization_modes(settings))
+    combined_text = format_submission_files(files, compact)
+
+    # Optional retrieval: keep only rubric-relevant chunks of oversized submissions
+    budget = resolve_retrieval_budget(settings)
+    if budget and estimate_tokens(combined_text) > budget:
+        before = estimate_tokens(combined_text)
+        combined_text = retrieve_relevant_chunks(files, key_text, budget, compact)
+        logging.info(
+            f"[RETRIEVAL] {student_dir.name}: ~{before} → ~{estimate_tokens(combined_text)} tokens "
+            f"(budget {budget})"
+        )
+
+    return files, combined_text, compact
+
+
+def grade_submission(
+    student_dir: Path,
+    grading_key_file: Path,
+    required_files: list[str],
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict | None = None
+) -> str | None:  
+    
+    """
+    Grade a single student submission using the stored 'Coding Exercise Scoring' logic.
+    Returns the plain-text feedback (or None on error).
+
+    `settings` is the merged global + assignment config used by the optional
+    prompt-size features (normalization, outline mode, ...).
+    """
+    try:
+        key_text = grading_key_file.read_text(encoding="utf-8", errors="ignore")
+    except Exception as e:
+        logging.error(f"Cannot read key file '{grading_key_file}': {e}")
+        return None
+
+    settings = settings or {}
+    lazy_cfg = resolve_lazy_fetch_settings(settings)
+    if lazy_cfg:
+        files, combined_text, compact = [], "", False   # files are fetched on demand
+    else:
+        files, combined_text, compact = assemble_submission_text(
+            student_dir, key_text, required_files, exclusions, settings
+        )
+
+    # -----------------------------
+    # BUILD THE GRADING PROMPT (shared prefix first, then the submission)
+    # -----------------------------
+    tiers = resolve_cascade_tiers(settings)
+    streaming = bool(settings.get("streaming"))
+    structured = bool(settings.get("structured_output")) and not tiers and not streaming
+    messages = build_grading_messages(system_prompt, key_text, combined_text, max_score, structured=structured)
+    prompt_tokens = estimate_message_tokens(messages)
+    if not lazy_cfg and not tiers:
+        model = route_model(settings, prompt_tokens, model, student_dir.name)
+    LAST_GRADING_MODEL.set(model)
+
+    # Progress dots (only for sequential runs; worker threads would interleave them,
+    # and a streamed report shows its own progress in grade_summary.txt.partial)
+    stop_event = threading.Event()
+    show_dots = threading.current_thread() is threading.main_thread() and not streaming
+    thread = threading.Thread(target=idle_marker, args=(stop_event,), daemon=True)
+    if show_dots:
+        thread.start()
+
+    try:
+        mr_cfg = resolve_map_reduce_settings(settings)
+        resp, report, structured_reply = None, None, False
+
+        if lazy_cfg:
+            resp = lazy_fetch_grade(
+                student_dir, key_text, required_files, exclusions,
+                system_prompt, model, max_score, settings, lazy_cfg,
+            )
+        elif mr_cfg["max_prompt_tokens"] and prompt_tokens > mr_cfg["max_prompt_tokens"]:
+            logging.info(
+                f"[MAP-REDUCE] {student_dir.name}: prompt ~{prompt_tokens} tokens exceeds "
+                f"max_prompt_tokens={mr_cfg['max_prompt_tokens']}"
+            )
+            resp = map_reduce_grade(files, key_text, system_prompt, model, max_score, compact, mr_cfg, student_dir.name)
+        else:
+            try:
+                if tiers:
+                    report = cascade_grade(messages, tiers, max_score, student_dir, streaming, settings)
+                elif streaming:
+                    report = stream_grading_report(model, messages, student_dir)
+                elif structured:
+                    resp = request_completion(
+                        model, messages, student_dir.name, response_format=STRUCTURED_RESPONSE_FORMAT
                     )
-                    return None
+                    structured_reply = True
+                else:
+                    resp = request_completion(model, messages, student_dir.name)
+            except Exception as e:
+                if not is_context_length_error(e):
+                    raise
+                logging.warning(f"[MAP-REDUCE] {student_dir.name}: prompt too long for {model}; switching to map-reduce")
+                resp = map_reduce_grade(files, key_text, system_prompt, model, max_score, compact, mr_cfg, student_dir.name)
+
+        if report is None and resp is not None:
+            report = resp.choices[0].message["content"]
+        if report is None:
+            logging.error(f"No response received from OpenAI for {student_dir.name}.")
+            return None
+
+        if structured_reply:
+            # Rendered from validated fields, so the regex post-processing is not needed
+            result_text = finish_structured_report(report, max_score, student_dir.name)
+        else:
+            if not tiers:
+                report = repair_report(report, model, max_score, student_dir.name, settings)
+            result_text = postprocess_result(report, key_text, max_score, student_dir.name)
+        if result_text:
+            write_grade_summary(student_dir, result_text)
+        return result_text
+
+    except APIError as e:
+        logging.error(f"API error: {e}")
+        return None
+    except Exception as e:
+        logging.exception(f"Error during grading for {student_dir.name}: {e}")
+        return None
+    finally:
+        stop_event.set()
+        if show_dots:
+            thread.join(timeout=1)
+            print("")  # newline after dots
+
+
+# ---------------------------------------------------------------------------
+# Streaming Completions (report written to disk as it arrives)
+# ---------------------------------------------------------------------------
+
+def stream_grading_report(model: str, messages: list[dict], student_dir: Path) -> str | None:
+    """
+    Request the report with stream=True, appending tokens to
+    grade_summary.txt.partial as they arrive (write_grade_summary later
+    replaces it with the post-processed report) and logging time to first
+    token.
+
+    The stream is read inside send_completion (consume=), so a failure
+    mid-stream is retried like any other request, starting a fresh partial
+    file. If the connection drops after the Total line has arrived, the
+    partial report is kept instead. Returns None if the request failed or too
+    little of the report arrived.
+    """
+    name = student_dir.name
+    partial = student_dir / "grade_summary.txt.partial"
+
+    def consume(stream) -> str:
+        started = time.monotonic()
+        parts = []
+        try:
+            with partial.open("w", encoding="utf-8") as out:
+                for chunk in stream:
+                    delta = chunk["choices"][0].get("delta", {}).get("content")
+                    if not delta:
+                        continue
+                    if not parts:
+                        logging.info(f"[STREAM] {name}: first token after {time.monotonic() - started:.2f}s")
+                    parts.append(delta)
+                    out.write(delta)
+                    out.flush()
+        except Exception as e:
+            text = "".join(parts)
+            if re.search(r"Total:\s*\d+\s*/\s*\d+", text):
+                logging.warning(
+                    f"[STREAM] {name}: connection dropped after {len(text)} chars ({e}); keeping the partial report"
+                )
+                return text
+            logging.warning(f"[STREAM] {name}: stream failed after {len(text)} chars: {e}")
+            raise
+
+        text = "".join(parts)
+        logging.info(f"[STREAM] {name}: {len(text)} chars in {time.monotonic() - started:.1f}s")
+        return text
+
+    text = send_completion(model, messages, name, consume=consume, stream=True)
+    if text is None:
+        partial.unlink(missing_ok=True)
+    return text
+
+
+# ---------------------------------------------------------------------------
+# Map-Reduce Grading (submissions too large for one request)
+# ---------------------------------------------------------------------------
+
+DEFAULT_MAP_CHUNK_TOKENS = 30000
+DEFAULT_MAP_WORKERS = 4
+
+MAP_FINDINGS_PROMPT = (
+    "You are helping grade a student submission that is too large to review in one pass. "
+    "You are shown PART {part} of {parts} together with the grading key. For every rubric "
+    "item in the key that this part is relevant to, list concise findings: what is "
+    "implemented, what is missing or incorrect, and the file paths involved. Include "
+    "evidence for any bonus features. Do not assign points or a total score; other parts "
+    "are reviewed separately."
+)
+
+
+def resolve_map_reduce_settings(settings: dict) -> dict:
+    """
+    Map-reduce settings:
+      "map_reduce": {
+        "max_prompt_tokens": 120000,  # above this, grade via map-reduce (default: only
+                                      # when the API reports a context-length error)
+        "chunk_tokens": 30000,        # submission tokens per map call
+        "max_workers": 4              # map calls in flight at once
+      }
+    """
+    raw = settings.get("map_reduce") or {}
+    max_prompt = raw.get("max_prompt_tokens")
+    return {
+        "max_prompt_tokens": int(max_prompt) if max_prompt else None,
+        "chunk_tokens": int(raw.get("chunk_tokens", DEFAULT_MAP_CHUNK_TOKENS)),
+        "max_workers": int(raw.get("max_workers", DEFAULT_MAP_WORKERS)),
+    }
+
+
+def split_files_for_map(files: list[dict], chunk_tokens: int) -> list[list[dict]]:
+    """
+    Pack file records into map chunks of at most ~chunk_tokens, keeping all
+    files of a rule together where possible. A single file larger than the
+    chunk size is split by lines into consecutive parts.
+    """
+    pieces = []
+    for f in files:
+        if estimate_tokens(f["text"]) <= chunk_tokens:
+            pieces.append(f)
+            continue
+        lines = f["text"].splitlines()
+        start, size = 0, 0
+        for i, line in enumerate(lines):
+            size += estimate_tokens(line) + 1
+            if size >= chunk_tokens or i == len(lines) - 1:
+                pieces.append({**f, "path": f"{f['path']} lines {start + 1}-{i + 1}", "text": "\n".join(lines[start:i + 1])})
+                start, size = i + 1, 0
+
+    chunks: list[list[dict]] = []
+    current: list[dict] = []
+    used = 0
+    for i, piece in enumerate(pieces):
+        cost = estimate_tokens(piece["text"])
+        new_rule = i > 0 and piece["rule"] != pieces[i - 1]["rule"]
+        # Close the chunk when full; prefer closing on a rule boundary
+        if current and (used + cost > chunk_tokens or (new_rule and used >= chunk_tokens // 2)):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(piece)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def map_reduce_grade(
+    files: list[dict],
+    key_text: str,
+    system_prompt: str,
+    model: str,
+    max_score: int,
+    compact: bool,
+    mr_cfg: dict,
+    student_name: str
+):
+    """
+    Grade an oversized submission in two stages:
+      map:    one findings call per rule-aligned chunk, run in parallel
+      reduce: one standard grading call over the combined findings
+    Returns the reduce response (or None if any stage failed).
+    """
+    chunks = split_files_for_map(files, mr_cfg["chunk_tokens"])
+    logging.info(f"[MAP-REDUCE] {student_name}: {len(chunks)} map call(s)")
+
+    def run_map(index: int, chunk: list[dict]) -> str | None:
+        messages = [
+            {"role": "system", "content": MAP_FINDINGS_PROMPT.format(part=index, parts=len(chunks))},
+            {"role": "user", "content": f"Answer Key:\n{key_text}\n\nSubmission Part {index}:\n{format_submission_files(chunk, compact)}"},
+        ]
+        resp = request_completion(model, messages, f"{student_name} (part {index}/{len(chunks)})")
+        return resp.choices[0].message["content"].strip() if resp else None
+
+    # Each map call runs in a copy of this context, so its LAST_REQUEST_FAILURE can be read back
+    contexts = [contextvars.copy_context() for _ in chunks]
+    workers = max(1, min(mr_cfg["max_workers"], len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        findings = list(pool.map(
+            lambda ctx, index, chunk: ctx.run(run_map, index, chunk),
+            contexts, range(1, len(chunks) + 1), chunks,
+        ))
+
+    if any(f is None for f in findings):
+        LAST_REQUEST_FAILURE.set(next(ctx.get(LAST_REQUEST_FAILURE) for ctx, f in zip(contexts, findings) if f is None))
+        logging.error(f"[MAP-REDUCE] {student_name}: a map call failed; not grading from partial findings")
+        return None
+
+    combined_findings = "\n\n".join(
+        f"### PART {i} ({', '.join(p['path'] for p in chunk)})\n{text}"
+        for i, (chunk, text) in enumerate(zip(chunks, findings), start=1)
+    )
+    messages = build_grading_messages(
+        system_prompt,
+        key_text,
+        combined_findings,
+        max_score,
+        submission_label=(
+            f"Reviewer Findings (the submission was too large to show in full; "
+            f"these findings were extracted from all {len(chunks)} parts)"
+        ),
+    )
+    return request_completion(model, messages, student_name)
+
+
+# ---------------------------------------------------------------------------
+# Lazy File Fetching (model requests files through tool calls)
+# ---------------------------------------------------------------------------
+
+DEFAULT_LAZY_MAX_FETCHES = 12
+DEFAULT_LAZY_MAX_FILE_BYTES = 60000
+
+READ_FILE_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "read_file",
+        "description": "Return the contents of one file from the student's submission.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "path": {"type": "string", "description": "Relative path exactly as shown in the directory tree."}
+            },
+            "required": ["path"],
+        },
+    },
+}
+
+
+def resolve_lazy_fetch_settings(settings: dict) -> dict | None:
+    """
+    Settings for lazy fetching, or None when disabled:
+      "lazy_fetch": {"max_fetches": 12, "max_file_bytes": 60000}
+    """
+    raw = settings.get("lazy_fetch")
+    if not raw:
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    if raw.get("enabled", True) is False:
+        return None
+    return {
+        "max_fetches": int(raw.get("max_fetches", DEFAULT_LAZY_MAX_FETCHES)),
+        "max_file_bytes": int(raw.get("max_file_bytes", DEFAULT_LAZY_MAX_FILE_BYTES)),
+    }
+
+
+def build_directory_tree(student_dir: Path, exclusions: list[str]) -> str:
+    """One line per non-excluded file: relative path and size, sorted by path."""
+    lines = []
+    for p in student_dir.rglob("*"):
+        if p.is_file() and not is_excluded(p, exclusions, student_dir):
+            rel = p.relative_to(student_dir).as_posix()
+            lines.append((rel.lower(), f"{rel} ({p.stat().st_size} bytes)"))
+    return "\n".join(line for _, line in sorted(lines))
+
+
+def build_required_files_manifest(student_dir: Path, required_files: list, exclusions: list[str]) -> str:
+    """Each rule with its expected count and the files it matched."""
+    lines = []
+    for entry in required_files:
+        rule, _ = split_rule_entry(entry)
+        matches, escalation, min_c, max_c = match_rule(student_dir, rule, exclusions)
+        high = "*" if max_c == float("inf") else max_c
+        found = ", ".join(m.relative_to(student_dir).as_posix() for m in matches) or "(none)"
+        lines.append(f"- {rule}: expected {min_c}..{high}, matched [{escalation}] {found}")
+    return "\n".join(lines)
+
+
+def fetch_submission_file(
+    student_dir: Path,
+    rel_path: str,
+    exclusions: list[str],
+    settings: dict,
+    max_bytes: int
+) -> str:
+    """
+    Serve one file for a read_file tool call. Paths outside the student
+    folder or matching an exclusion are refused.
+    """
+    root = student_dir.resolve()
+    target = (root / str(rel_path).lstrip("/\\")).resolve()
+    if not target.is_relative_to(root) or not target.is_file() or is_excluded(target, exclusions, root):
+        return f"ERROR: '{rel_path}' is not a readable file in this submission."
+
+    text = target.read_text(encoding="utf-8", errors="ignore")
+    text, _ = render_file_text(target, text, {}, settings)
+    mode = normalization_mode_for(target, resolve_normalization_modes(settings))
+    if mode:
+        text = normalize_source(text, target.suffix.lower(), aggressive=(mode == "aggressive"))
+    if len(text) > max_bytes:
+        text = text[:max_bytes] + f"\n... [truncated, {len(text) - max_bytes} more characters]"
+    return text
+
+
+def lazy_fetch_grade(
+    student_dir: Path,
+    key_text: str,
+    required_files: list,
+    exclusions: list[str],
+    system_prompt: str,
+    model: str,
+    max_score: int,
+    settings: dict,
+    lazy_cfg: dict
+):
+    """
+    Grade by sending only the key, a directory tree and the required_files
+    manifest; the model pulls the files it needs through read_file tool
+    calls (up to max_fetches). Returns the final response or None.
+    """
+    name = student_dir.name
+    limit = lazy_cfg["max_fetches"]
+    overview = (
+        f"Directory tree:\n{build_directory_tree(student_dir, exclusions)}\n\n"
+        f"Required files manifest:\n{build_required_files_manifest(student_dir, required_files, exclusions)}\n\n"
+        f"File contents are not included. Call read_file for each file you need to grade "
+        f"against the key (at most {limit} files), then write the report."
+    )
+    messages = build_grading_messages(
+        system_prompt, key_text, overview, max_score,
+        submission_label="Student Submission Overview",
+    )
+    logging.info(f"[LAZY] {name}: initial prompt ~{estimate_message_tokens(messages)} tokens")
+
+    fetched, fetched_bytes = 0, 0
+    tool_choice = "auto"
+    while True:
+        resp = request_completion(model, messages, name, tools=[READ_FILE_TOOL], tool_choice=tool_choice)
+        if resp is None:
+            return None
+
+        message = resp.choices[0].message
+        calls = message.get("tool_calls") or []
+        if not calls or tool_choice == "none":
+            logging.info(f"[LAZY] {name}: {fetched} file(s) fetched, {fetched_bytes} bytes")
+            return resp
+
+        messages.append({"role": "assistant", "content": message.get("content"), "tool_calls": calls})
+        for call in calls:
+            try:
+                path = json.loads(call["function"]["arguments"]).get("path", "")
+            except (ValueError, KeyError, TypeError, AttributeError):
+                path = ""
+
+            if fetched >= limit:
+                content = f"ERROR: fetch limit of {limit} files reached. Write the report now."
+            else:
+                content = fetch_submission_file(student_dir, path, exclusions, settings, lazy_cfg["max_file_bytes"])
+                fetched += 1
+                fetched_bytes += len(content.encode("utf-8"))
+                logging.info(f"[LAZY] {name}: read_file {path} ({len(content)} chars) [{fetched}/{limit}]")
+
+            messages.append({"role": "tool", "tool_call_id": call["id"], "content": content})
+
+        if fetched >= limit:
+            tool_choice = "none"
+
+
+# ---------------------------------------------------------------------------
+# Per-Student Runner (shared by sequential and concurrent grading)
+# ---------------------------------------------------------------------------
+
+# Serializes CSV appends so rows stay intact when students are graded concurrently
+CSV_LOCK = threading.Lock()
+
+
+def record_csv_row(
+    csv_path: Path,
+    student_name: str,
+    result_text: str | None,
+    status: str,
+    model: str = "",
+    fields: dict | None = None
+) -> None:
+    """Thread-safe wrapper around append_csv_row."""
+    with CSV_LOCK:
+        append_csv_row(csv_path, student_name, result_text, status, model, fields)
+
+
+def grade_student(
+    sdir: Path,
+    csv_path: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    defer: bool = False
+) -> str:
+    """
+    Scan, grade, post-process and record one student folder.
+    Returns the CSV status. Safe to run from worker threads.
+
+    With defer=True, a student whose API requests ran out of retries on a
+    transient error (timeout, connection, 429, 5xx) is not recorded; the
+    status "Deferred" tells the caller to retry it at the end of the run.
+    """
+    LAST_REQUEST_FAILURE.set(None)
+    LAST_GRADING_MODEL.set(model)
+    LAST_REPORT_FIELDS.set(None)
+    try:
+        # Skip empty or README-only submissions
+        if is_effectively_empty(sdir, exclusions):
+            logging.info(f"Skipping empty/README-only directory: {sdir.name}")
 
-                delay = min(10.0, base_delay_seconds * (2 ** (attempt - 1)))
-                logging.warning(
-                    f"Transient OpenAI error for {student_dir.name} (attempt {attempt}/{max_attempts}): {e}. "
-                    f"Retrying in {delay:.1f}s..."
+            # Optional: write a minimal grade_summary.txt so it’s auditable
+            summary = (
+                "Submission not graded.\n"
+                "Reason: folder is empty or contains only README.md.\n"
+            )
+            write_grade_summary(sdir, summary)
+
+            # Also record in CSV
+            record_csv_row(csv_path, sdir.name, None, "Empty/README-only")
+            return "Empty/README-only"
+
+        logging.info(f"Grading {sdir.name} ...")
+        result_text = grade_submission(
+            sdir, 
+            grading_key_file,
+            required_files, 
+            model,
+            max_score,
+            exclusions, 
+            system_prompt,
+            settings
+        )
+    except Exception as e:
+        logging.exception(f"Unexpected error for {sdir.name}: {e}")
+        result_text = None
+
+    if not result_text and defer and LAST_REQUEST_FAILURE.get() in RETRYABLE_ERRORS:
+        logging.warning(f"[DEFER] {sdir.name}: {LAST_REQUEST_FAILURE.get()} failure; will retry at end of run")
+        return "Deferred"
+
+    status = "Graded" if result_text else "Error"
+    record_csv_row(csv_path, sdir.name, result_text, status, LAST_GRADING_MODEL.get(), LAST_REPORT_FIELDS.get())
+    return status
+
+
+def resolve_deferred_rounds(settings: dict) -> int:
+    """
+    "deferred_retry_rounds": 1
+    How many end-of-run passes retry students deferred after transient
+    failures. 0 records them as Error immediately.
+    """
+    return max(0, int(settings.get("deferred_retry_rounds", 1)))
+
+
+# ---------------------------------------------------------------------------
+# Packed Grading (several small submissions per request)
+# ---------------------------------------------------------------------------
+
+DEFAULT_PACK_TOKEN_BUDGET = 12000
+DEFAULT_PACK_STUDENT_TOKENS = 3000
+DEFAULT_PACK_MAX_STUDENTS = 6
+
+PACK_INSTRUCTIONS = (
+    "This message contains {count} separate student submissions, each between "
+    "=== SUBMISSION: <name> === and === END SUBMISSION: <name> === lines. Grade each one "
+    "independently against the key; never let one submission affect another's score. "
+    "Write one complete report per student in the required format, starting with the line "
+    "=== REPORT: <name> === and ending with the line === END REPORT: <name> ===, using the "
+    "exact names given."
+)
+
+
+def resolve_packing_settings(settings: dict) -> dict | None:
+    """
+    Settings for packing small submissions, or None when disabled:
+      "packing": {
+        "token_budget": 12000,      # submission tokens per packed request
+        "max_student_tokens": 3000, # larger submissions are graded on their own
+        "max_students": 6
+      }
+    """
+    raw = settings.get("packing")
+    if not raw:
+        return None
+    raw = raw if isinstance(raw, dict) else {}
+    return {
+        "token_budget": int(raw.get("token_budget", DEFAULT_PACK_TOKEN_BUDGET)),
+        "max_student_tokens": int(raw.get("max_student_tokens", DEFAULT_PACK_STUDENT_TOKENS)),
+        "max_students": max(2, int(raw.get("max_students", DEFAULT_PACK_MAX_STUDENTS))),
+    }
+
+
+def build_packed_messages(
+    system_prompt: str,
+    key_text: str,
+    submissions: list[tuple[str, str]],
+    max_score: int
+) -> list[dict]:
+    """Grading messages with several (name, submission text) sections in one user message."""
+    sections = "\n\n".join(
+        f"=== SUBMISSION: {name} ===\n{text}\n=== END SUBMISSION: {name} ==="
+        for name, text in submissions
+    )
+    return build_grading_messages(
+        system_prompt, key_text,
+        f"{PACK_INSTRUCTIONS.format(count=len(submissions))}\n\n{sections}",
+        max_score,
+        submission_label="Student Submissions",
+    )
+
+
+def split_packed_response(text: str, names: list[str]) -> dict[str, str]:
+    """Per-student reports from a packed response; students without a usable report are omitted."""
+    reports = {}
+    for name in names:
+        m = re.search(
+            rf"===\s*REPORT:\s*{re.escape(name)}\s*===\s*\n(.*?)\n\s*===\s*END REPORT:\s*{re.escape(name)}\s*===",
+            text,
+            re.DOTALL,
+        )
+        if m and re.search(r"Total:\s*\d+\s*/\s*\d+", m.group(1)):
+            reports[name] = m.group(1).strip()
+    return reports
+
+
+def plan_packs(
+    student_dirs: list[Path],
+    key_text: str,
+    required_files: list,
+    exclusions: list[str],
+    settings: dict,
+    pack_cfg: dict
+) -> tuple[list[list[tuple[Path, str]]], list[Path]]:
+    """
+    Greedily group small submissions (in folder order) up to the token
+    budget. Returns the packs of (folder, submission text) and the folders
+    to grade on their own.
+    """
+    packs, single, current, used = [], [], [], 0
+
+    def close_pack():
+        nonlocal current, used
+        if len(current) > 1:
+            packs.append(current)
+        else:
+            single.extend(sdir for sdir, _ in current)
+        current, used = [], 0
+
+    for sdir in student_dirs:
+        if is_effectively_empty(sdir, exclusions):
+            single.append(sdir)
+            continue
+        # No summaries while planning: packs carry full text, and students too big
+        # to pack are summarized when graded on their own
+        _, text, _ = assemble_submission_text(sdir, key_text, required_files, exclusions, settings, summarize=False)
+        tokens = estimate_tokens(text)
+        if tokens > pack_cfg["max_student_tokens"]:
+            single.append(sdir)
+            continue
+        if current and (used + tokens > pack_cfg["token_budget"] or len(current) >= pack_cfg["max_students"]):
+            close_pack()
+        current.append((sdir, text))
+        used += tokens
+    close_pack()
+    return packs, single
+
+
+def grade_pack(
+    pack: list[tuple[Path, str]],
+    csv_path: Path,
+    key_text: str,
+    model: str,
+    max_score: int,
+    system_prompt: str,
+    settings: dict | None = None
+) -> list[Path]:
+    """
+    Grade one pack with a single request, then post-process, write and
+    record each student's report. Returns the folders whose section was
+    missing or unparseable, to be regraded individually.
+    """
+    names = [sdir.name for sdir, _ in pack]
+    label = f"pack[{', '.join(names)}]"
+    logging.info(f"[PACK] Grading {len(pack)} students in one request: {', '.join(names)}")
+    messages = build_packed_messages(system_prompt, key_text, [(sdir.name, text) for sdir, text in pack], max_score)
+    model = route_model(settings or {}, estimate_message_tokens(messages), model, label)
+    try:
+        resp = request_completion(model, messages, label)
+    except Exception as e:
+        logging.error(f"[PACK] {label} failed: {e}")
+        resp = None
+    reports = split_packed_response(resp.choices[0].message["content"], names) if resp else {}
+
+    failed = []
+    for sdir, _ in pack:
+        report = reports.get(sdir.name)
+        if report is None:
+            logging.warning(f"[PACK] No usable report for {sdir.name}; regrading individually")
+            failed.append(sdir)
+            continue
+        result_text = postprocess_result(report, key_text, max_score, sdir.name)
+        write_grade_summary(sdir, result_text)
+        record_csv_row(csv_path, sdir.name, result_text, "Graded", model)
+    return failed
+
+
+def grade_packed(
+    student_dirs: list[Path],
+    csv_path: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    workers: int = 1
+) -> list[Path]:
+    """
+    Grade all packable students in packs. Returns the folders still to be
+    graded one by one (large, empty, or failed sections).
+    """
+    pack_cfg = resolve_packing_settings(settings)
+    if not pack_cfg or resolve_lazy_fetch_settings(settings):
+        return student_dirs
+
+    key_text = grading_key_file.read_text(encoding="utf-8", errors="ignore")
+    packs, single = plan_packs(student_dirs, key_text, required_files, exclusions, settings, pack_cfg)
+    logging.info(f"[PACK] {sum(len(p) for p in packs)} student(s) in {len(packs)} pack(s); {len(single)} graded alone")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pack") as pool:
+        failed = pool.map(
+            lambda pack: grade_pack(pack, csv_path, key_text, model, max_score, system_prompt, settings), packs
+        )
+        retry = [sdir for group in failed for sdir in group]
+
+    # Keep the original folder order for the individual pass
+    remaining = set(single) | set(retry)
+    return [sdir for sdir in student_dirs if sdir in remaining]
+
+
+# ---------------------------------------------------------------------------
+# Async Engine (asyncio + one pooled HTTP session)
+# ---------------------------------------------------------------------------
+
+DEFAULT_MAX_IN_FLIGHT = 64
+
+
+async def request_completion_async(model: str, messages: list[dict], student_name: str, **params):
+    """Async counterpart of request_completion."""
+    if caching_responses():
+        return await RESPONSE_CACHE.through_async(
+            model, messages, params, lambda: send_completion_async(model, messages, student_name, **params)
+        )
+    return await send_completion_async(model, messages, student_name, **params)
+
+
+async def send_completion_async(model: str, messages: list[dict], student_name: str, **params):
+    """
+    Async counterpart of send_completion. Requests go through the shared
+    aiohttp session installed by grade_all_async (openai.aiosession), so TCP
+    connections and TLS sessions are reused across requests.
+    """
+    limiter = RATE_LIMITERS.get(model)
+    estimate = estimate_message_tokens(messages)
+    attempt = 0
+
+    while True:
+        attempt += 1
+        probe = await CIRCUIT_BREAKER.wait_async() if CIRCUIT_BREAKER else False
+        if limiter:
+            await limiter.acquire_async(estimate)
+        try:
+            async with concurrency_slot_async():
+                send = functools.partial(
+                    BACKEND.acreate,
+                    model=model,
+                    messages=messages,
+                    request_timeout=120,
+                    **params,
                 )
-                time.sleep(delay)
+                if HEDGER:
+                    resp = await HEDGER.call_async(
+                        send, student_name, functools.partial(send_hedged_async, send, limiter, estimate)
+                    )
+                else:
+                    resp = await send()
+        except Exception as e:
+            kind, delay = retry_plan(e, attempt)
+            if kind == "client":
+                raise
+            if kind != "rate_limited" and CIRCUIT_BREAKER:
+                CIRCUIT_BREAKER.record_failure()
+            if delay is None:
+                logging.error(f"OpenAI {kind} error after {attempt} attempt(s) for {student_name}: {e}")
+                LAST_REQUEST_FAILURE.set(kind)
+                return None
 
-        if resp is None:
-            logging.error(f"No response received from OpenAI for {student_dir.name}.")
-            return None
+            logging.warning(
+                f"OpenAI {kind} error for {student_name} (attempt {attempt}/{RETRY_ATTEMPTS[kind]}): {e}. "
+                f"Retrying in {delay:.1f}s..."
+            )
+            if kind == "rate_limited" and limiter:
+                limiter.pause(delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+        finally:
+            if probe:
+                CIRCUIT_BREAKER.release_probe()
+
+        if CIRCUIT_BREAKER:
+            CIRCUIT_BREAKER.record_success()
+        if limiter:
+            limiter.settle(estimate, response_total_tokens(resp))
+        log_prompt_cache_usage(resp, student_name)
+        return resp
+
+
+async def to_thread_with_context(func, *args):
+    """
+    asyncio.to_thread, but context variables set by func (LAST_GRADING_MODEL,
+    LAST_REQUEST_FAILURE, LAST_REPORT_FIELDS) are copied back to the calling task.
+    """
+    ctx = contextvars.copy_context()
+    result = await asyncio.to_thread(ctx.run, func, *args)
+    for var in (LAST_GRADING_MODEL, LAST_REQUEST_FAILURE, LAST_REPORT_FIELDS):
+        var.set(ctx.get(var))
+    return result
 
-        result_text = resp.choices[0].message["content"].strip()
 
-        # Infer bonus behavior if LLM implied it but did not apply it to Total
-        result_text = infer_bonus_if_needed(result_text, key_text, student_dir.name)
+async def grade_submission_async(
+    student_dir: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict | None = None
+) -> str | None:
+    """
+    Async grade_submission: scanning and file reads run in worker threads,
+    the API call runs on the event loop. lazy_fetch, streaming and the model
+    cascade are delegated to the threaded grade_submission; prompts that
+    exceed map_reduce.max_prompt_tokens (or the model's context) are graded
+    by map_reduce_grade in a worker thread.
+    """
+    settings = settings or {}
+    if (
+        resolve_lazy_fetch_settings(settings)
+        or settings.get("streaming")
+        or resolve_cascade_tiers(settings)
+    ):
+        return await to_thread_with_context(
+            grade_submission, student_dir, grading_key_file, required_files,
+            model, max_score, exclusions, system_prompt, settings,
+        )
+
+    try:
+        key_text = await asyncio.to_thread(grading_key_file.read_text, encoding="utf-8", errors="ignore")
+    except Exception as e:
+        logging.error(f"Cannot read key file '{grading_key_file}': {e}")
+        return None
 
-        # Enforce that Bonus section and Score Summary agree
-        result_text = enforce_bonus_alignment(result_text)
+    try:
+        files, combined_text, compact = await asyncio.to_thread(
+            assemble_submission_text, student_dir, key_text, required_files, exclusions, settings
+        )
+        structured = bool(settings.get("structured_output"))
+        messages = build_grading_messages(system_prompt, key_text, combined_text, max_score, structured=structured)
+        prompt_tokens = estimate_message_tokens(messages)
+        model = route_model(settings, prompt_tokens, model, student_dir.name)
+        LAST_GRADING_MODEL.set(model)
+        mr_cfg = resolve_map_reduce_settings(settings)
+        map_reduce = functools.partial(
+            to_thread_with_context, map_reduce_grade,
+            files, key_text, system_prompt, model, max_score, compact, mr_cfg, student_dir.name,
+        )
 
-        # Force denominator to remain base maximum
-        result_text = enforce_base_max(result_text, max_score)
+        if mr_cfg["max_prompt_tokens"] and prompt_tokens > mr_cfg["max_prompt_tokens"]:
+            logging.info(
+                f"[MAP-REDUCE] {student_dir.name}: prompt ~{prompt_tokens} tokens exceeds "
+                f"max_prompt_tokens={mr_cfg['max_prompt_tokens']}"
+            )
+            resp, structured = await map_reduce(), False
+        else:
+            params = {"response_format": STRUCTURED_RESPONSE_FORMAT} if structured else {}
+            try:
+                resp = await request_completion_async(model, messages, student_dir.name, **params)
+            except Exception as e:
+                if not is_context_length_error(e):
+                    raise
+                logging.warning(f"[MAP-REDUCE] {student_dir.name}: prompt too long for {model}; switching to map-reduce")
+                resp, structured = await map_reduce(), False
+        if resp is None:
+            logging.error(f"No response received from OpenAI for {student_dir.name}.")
+            return None
 
-        write_grade_summary(student_dir, result_text)
+        if structured:
+            result_text = finish_structured_report(resp.choices[0].message["content"], max_score, student_dir.name)
+        else:
+            report = await to_thread_with_context(
+                repair_report, resp.choices[0].message["content"], model, max_score, student_dir.name, settings
+            )
+            result_text = postprocess_result(report, key_text, max_score, student_dir.name)
+        if result_text:
+            await asyncio.to_thread(write_grade_summary, student_dir, result_text)
         return result_text
 
     except APIError as e:
@@ -789,17 +4387,318 @@ Respond using the following format:
     except Exception as e:
         logging.exception(f"Error during grading for {student_dir.name}: {e}")
         return None
-    finally:
-        stop_event.set()
-        thread.join(timeout=1)
-        print("")  # newline after dots
+
+
+async def grade_student_async(
+    sdir: Path,
+    csv_path: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    defer: bool = False
+) -> str:
+    """Async counterpart of grade_student."""
+    if await asyncio.to_thread(is_effectively_empty, sdir, exclusions):
+        return await asyncio.to_thread(
+            grade_student, sdir, csv_path, grading_key_file, required_files,
+            model, max_score, exclusions, system_prompt, settings,
+        )
+
+    LAST_REQUEST_FAILURE.set(None)
+    LAST_GRADING_MODEL.set(model)
+    LAST_REPORT_FIELDS.set(None)
+
+    logging.info(f"Grading {sdir.name} ...")
+    result_text = await grade_submission_async(
+        sdir, grading_key_file, required_files, model, max_score, exclusions, system_prompt, settings
+    )
+    if not result_text and defer and LAST_REQUEST_FAILURE.get() in RETRYABLE_ERRORS:
+        logging.warning(f"[DEFER] {sdir.name}: {LAST_REQUEST_FAILURE.get()} failure; will retry at end of run")
+        return "Deferred"
+
+    status = "Graded" if result_text else "Error"
+    await asyncio.to_thread(
+        record_csv_row, csv_path, sdir.name, result_text, status, LAST_GRADING_MODEL.get(), LAST_REPORT_FIELDS.get()
+    )
+    return status
+
+
+async def grade_all_async(
+    student_dirs: list[Path],
+    csv_path: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    defer: bool = False
+) -> list[str]:
+    """
+    Grade every student on one event loop with at most max_in_flight
+    requests outstanding, all sharing one keep-alive connection pool.
+    """
+    if aiohttp is None:
+        raise RuntimeError("The async engine requires aiohttp (installed with openai<1.0).")
+
+    connector = aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = openai.aiosession.set(session)
+        try:
+            semaphore = asyncio.Semaphore(max_in_flight)
+
+            async def run(sdir: Path) -> str:
+                async with semaphore:
+                    return await grade_student_async(
+                        sdir, csv_path, grading_key_file, required_files,
+                        model, max_score, exclusions, system_prompt, settings, defer,
+                    )
+
+            return await asyncio.gather(*(run(s) for s in student_dirs))
+        finally:
+            openai.aiosession.reset(token)
+
+
+# ---------------------------------------------------------------------------
+# Batch Mode (provider batch endpoint for whole cohorts)
+# ---------------------------------------------------------------------------
+
+DEFAULT_BATCH_POLL_SECONDS = 30
+BATCH_FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchClient:
+    """Minimal client for the OpenAI-compatible /files and /batches endpoints."""
+
+    def __init__(self, base_url: str, api_key: str, timeout: float = 120):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = timeout
+
+    def _call(self, method: str, path: str, **kwargs) -> requests.Response:
+        resp = self.session.request(method, f"{self.base_url}/{path}", timeout=self.timeout, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def upload(self, path: Path) -> str:
+        with path.open("rb") as f:
+            resp = self._call("POST", "files", data={"purpose": "batch"}, files={"file": (path.name, f)})
+        return resp.json()["id"]
+
+    def create(self, input_file_id: str) -> dict:
+        return self._call("POST", "batches", json={
+            "input_file_id": input_file_id,
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        }).json()
+
+    def retrieve(self, batch_id: str) -> dict:
+        return self._call("GET", f"batches/{batch_id}").json()
+
+    def content(self, file_id: str) -> str:
+        return self._call("GET", f"files/{file_id}/content").text
+
+
+def resolve_batch_settings(settings: dict) -> dict:
+    """
+    "batch": {
+      "base_url": "https://api.openai.com/v1",   # defaults to the backend's base_url
+      "poll_seconds": 30,
+      "state_dir": "logs/batches"                 # batch input files and resume state
+    }
+    """
+    raw = settings.get("batch")
+    raw = raw if isinstance(raw, dict) else {}
+    return {
+        "base_url": raw.get("base_url") or getattr(BACKEND, "base_url", None) or openai.api_base,
+        "poll_seconds": float(raw.get("poll_seconds", DEFAULT_BATCH_POLL_SECONDS)),
+        "state_dir": Path(raw.get("state_dir") or Path("logs") / "batches"),
+    }
+
+
+def submit_batch(
+    client: BatchClient,
+    student_dirs: list[Path],
+    key_text: str,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    state_dir: Path
+) -> tuple[list[dict], list[Path]]:
+    """
+    Write one chat completion request per student to a JSONL file, upload
+    it and create the batch (one batch per routed model, since a batch
+    serves a single model). Returns the saved resume states and the students
+    that need live grading instead (empty folders, lazy/map-reduce sized prompts).
+    Batch prompts carry full file text (no file_summaries), so submitting
+    makes no live summary calls.
+    """
+    mr_cfg = resolve_map_reduce_settings(settings)
+    live, groups = [], {}
+    for sdir in student_dirs:
+        if is_effectively_empty(sdir, exclusions) or resolve_lazy_fetch_settings(settings):
+            live.append(sdir)
+            continue
+        _, combined_text, _ = assemble_submission_text(
+            sdir, key_text, required_files, exclusions, settings, summarize=False
+        )
+        messages = build_grading_messages(system_prompt, key_text, combined_text, max_score)
+        if mr_cfg["max_prompt_tokens"] and estimate_message_tokens(messages) > mr_cfg["max_prompt_tokens"]:
+            live.append(sdir)
+            continue
+        routed = route_model(settings, estimate_message_tokens(messages), model, sdir.name)
+        students, lines = groups.setdefault(routed, ({}, []))
+        students[sdir.name] = str(sdir)
+        lines.append(json.dumps({
+            "custom_id": sdir.name,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": routed, "messages": messages},
+        }, ensure_ascii=False))
+
+    states = []
+    for routed, (students, lines) in groups.items():
+        state_dir.mkdir(parents=True, exist_ok=True)
+        safe = re.sub(r"[^A-Za-z0-9._-]", "_", routed)
+        input_path = state_dir / f"batch_input_{time.strftime('%Y%m%d_%H%M%S')}_{safe}.jsonl"
+        input_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        file_id = client.upload(input_path)
+        batch = client.create(file_id)
+        state = {"batch_id": batch["id"], "input_file_id": file_id, "model": routed, "students": students}
+        (state_dir / f"{batch['id']}.json").write_text(json.dumps(state, indent=2), encoding="utf-8")
+        logging.info(
+            f"[BATCH] Submitted {batch['id']} ({routed}) with {len(lines)} request(s); "
+            f"resume with --batch-id {batch['id']}"
+        )
+        states.append(state)
+    return states, live
+
+
+def wait_for_batch(client: BatchClient, batch_id: str, poll_seconds: float) -> dict:
+    """Poll until the batch reaches a final state."""
+    last = None
+    while True:
+        batch = client.retrieve(batch_id)
+        status = batch.get("status")
+        if status != last:
+            counts = batch.get("request_counts") or {}
+            logging.info(
+                f"[BATCH] {batch_id}: {status} "
+                f"({counts.get('completed', 0)}/{counts.get('total', '?')} done, {counts.get('failed', 0)} failed)"
+            )
+            last = status
+        if status in BATCH_FINAL_STATES:
+            return batch
+        time.sleep(poll_seconds)
+
+
+def run_batch(
+    student_dirs: list[Path],
+    csv_path: Path,
+    grading_key_file: Path,
+    required_files: list,
+    model: str,
+    max_score: int,
+    exclusions: list[str],
+    system_prompt: str,
+    settings: dict,
+    batch_id: str | None = None
+) -> dict[str, str]:
+    """
+    Grade a cohort through the batch endpoint: submit (or resume batch_id),
+    poll, then post-process each result, write grade_summary.txt and record
+    CSV rows exactly as live grading does. Returns student name → status.
+    """
+    batch_cfg = resolve_batch_settings(settings)
+    client = BatchClient(batch_cfg["base_url"], getattr(BACKEND, "api_key", None) or openai.api_key or "")
+    key_text = grading_key_file.read_text(encoding="utf-8", errors="ignore")
+    statuses = {}
+
+    if batch_id:
+        state_file = batch_cfg["state_dir"] / f"{batch_id}.json"
+        if not state_file.exists():
+            raise FileNotFoundError(f"No saved state for batch {batch_id} in {batch_cfg['state_dir']}")
+        states = [json.loads(state_file.read_text(encoding="utf-8"))]
+        logging.info(f"[BATCH] Resuming {batch_id} ({len(states[0]['students'])} student(s))")
+    else:
+        states, live = submit_batch(
+            client, student_dirs, key_text, required_files, model,
+            max_score, exclusions, system_prompt, settings, batch_cfg["state_dir"],
+        )
+        if live:
+            logging.info(f"[BATCH] Grading {len(live)} folder(s) live (empty or too large for one request)")
+        for sdir in live:
+            statuses[sdir.name] = grade_student(
+                sdir, csv_path, grading_key_file, required_files,
+                model, max_score, exclusions, system_prompt, settings,
+            )
+
+    for state in states:
+        statuses.update(record_batch_results(client, state, csv_path, key_text, max_score, batch_cfg["poll_seconds"], settings))
+    return statuses
+
+
+def record_batch_results(
+    client: BatchClient,
+    state: dict,
+    csv_path: Path,
+    key_text: str,
+    max_score: int,
+    poll_seconds: float,
+    settings: dict | None = None
+) -> dict[str, str]:
+    """Wait for one batch, then post-process, write and record each student's result."""
+    batch = wait_for_batch(client, state["batch_id"], poll_seconds)
+
+    results = {}
+    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+        if not file_id:
+            continue
+        for line in client.content(file_id).splitlines():
+            if line.strip():
+                record = json.loads(line)
+                results.setdefault(record.get("custom_id"), record)
+
+    statuses = {}
+    for name, path in state["students"].items():
+        sdir = Path(path)
+        response = (results.get(name) or {}).get("response") or {}
+        result_text = None
+        if response.get("status_code") == 200:
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                content = repair_report(content, state["model"], max_score, name, settings)
+                result_text = postprocess_result(content, key_text, max_score, name)
+                write_grade_summary(sdir, result_text)
+            except Exception as e:
+                logging.exception(f"[BATCH] Could not process result for {name}: {e}")
+                result_text = None
+        else:
+            error = (results.get(name) or {}).get("error") or response.get("body") or f"batch {batch.get('status')}"
+            logging.error(f"[BATCH] No result for {name}: {error}")
+
+        statuses[name] = "Graded" if result_text else "Error"
+        record_csv_row(csv_path, name, result_text, statuses[name], state["model"])
+
+    return statuses
 
 
 # ---------------------------------------------------------------------------
 # Main (Validate restored verbatim + exclusions applied)
 # ---------------------------------------------------------------------------
 
-def main() -> None:
+def main(async_engine: bool = False) -> None:
 
     parser = argparse.ArgumentParser(description="Automated grader for coding assignments.")
 
@@ -808,6 +4707,38 @@ def main() -> None:
     parser.add_argument("--config", required=True, help="Path to configuration JSON.")
     parser.add_argument("--student", help="Only grade this specific student directory. Exact directory name match (case-insensitive).")
     parser.add_argument("--dry-run", action="store_true", help="List/check without API calls.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Grade up to N students concurrently (default: 1, sequential)."
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_engine",
+        action="store_true",
+        help="Use the asyncio engine (one pooled HTTP session, no thread per request)."
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit all prompts to the provider's batch endpoint (cheaper, results within 24h)."
+    )
+    parser.add_argument(
+        "--batch-id",
+        help="Resume polling a previously submitted batch and record its results."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call the API instead of reusing cached responses for identical requests."
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT,
+        help=f"Async engine only: maximum concurrent API requests (default: {DEFAULT_MAX_IN_FLIGHT})."
+    )
    
     parser.add_argument(
         "--validate",
@@ -911,11 +4842,25 @@ def main() -> None:
     # gpt-5-mini is the backup value in case nothing is specified in global config,
     model = cfg.get("model") or global_cfg.get("model", "gpt-5-mini")
 
+    # Merged view of both configs for optional features (assignment overrides global)
+    settings = {**global_cfg, **cfg}
+    configure_rate_limits(settings)
+    controller = configure_concurrency(settings)
+    try:
+        backend = configure_backend(settings)
+    except ValueError as e:
+        logging.error(f"[CONFIG] {e}")
+        sys.exit(1)
+    configure_circuit_breaker(settings)
+    configure_hedging(settings)
+    CASCADE_COUNTS.clear()
+    configure_response_cache(settings, (logs_dir / "response_cache").resolve(), enabled=not args.no_cache)
+
     dry_run = args.dry_run 
 
     # Environment setup
     api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    if not api_key and backend.requires_api_key:
         logging.error("Missing OPENAI_API_KEY environment variable.")
         sys.exit(1)
 
@@ -969,7 +4914,8 @@ def main() -> None:
         logging.info(f"Model configured: {model}")
         logging.info(f"First matching folder: {first.name}")
 
-        for rule in required_files:
+        for entry in required_files:
+            rule, _ = split_rule_entry(entry)
             pattern, min_c, max_c = parse_rule(rule)
 
             is_glob = any(ch in pattern for ch in ["*", "?"])
@@ -995,6 +4941,7 @@ def main() -> None:
                 logging.warning(f"[VALIDATE] Missing required file: {rule}")
 
         csv_path = logs_dir / "grading_summary.csv"
+        upgrade_csv_header(csv_path)
         if dry_run:
             logging.info("[VALIDATE] Dry-run is enabled; skipping API call.")
             append_csv_row(csv_path, first.name, "Validated (dry-run)", "Validate run")
@@ -1002,6 +4949,8 @@ def main() -> None:
             return
 
         logging.info(f"[VALIDATE] Grading ONLY: {first.name} ...")
+        LAST_GRADING_MODEL.set(model)
+        LAST_REPORT_FIELDS.set(None)
         result_text = grade_submission(
             first, 
             grading_key_file,
@@ -1009,10 +4958,14 @@ def main() -> None:
             model,
             max_score,
             exclusions, 
-            system_prompt
+            system_prompt,
+            settings
         )
         status = "Graded" if result_text else "Error"
-        append_csv_row(csv_path, first.name, result_text, f"Validate run: {status}")
+        append_csv_row(
+            csv_path, first.name, result_text, f"Validate run: {status}",
+            LAST_GRADING_MODEL.get(), LAST_REPORT_FIELDS.get(),
+        )
         logging.info("---- VALIDATION COMPLETE ----")
         return
 
@@ -1021,51 +4974,75 @@ def main() -> None:
         logging.info("Dry run mode: listing directories only (no API calls).")
         for s in student_dirs:
             print(s)
-        csv_path = logs_dir / "grading_summary.csv"
-        if not csv_path.exists():
-            with csv_path.open("w", newline="", encoding="utf-8") as f:
-                csv.writer(f).writerow(["Student Directory", "Status"])
+        upgrade_csv_header(logs_dir / "grading_summary.csv")
         return
 
     # Full grading
     logging.info(f"Found {len(student_dirs)} student directories for pattern '{assignment_pattern}'.")
     csv_path = logs_dir / "grading_summary.csv"
-    if not csv_path.exists():
-        with csv_path.open("w", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow(["Student Directory", "Status"])
-
-    for sdir in student_dirs:
-
-        # Skip empty or README-only submissions
-        if is_effectively_empty(sdir, exclusions):
-            logging.info(f"Skipping empty/README-only directory: {sdir.name}")
-
-            # Optional: write a minimal grade_summary.txt so it’s auditable
-            summary = (
-                "Submission not graded.\n"
-                "Reason: folder is empty or contains only README.md.\n"
-            )
-            write_grade_summary(sdir, summary)
+    upgrade_csv_header(csv_path)
+
+    workers = max(1, args.workers)
+    if controller and workers < controller.ceiling:
+        # The controller decides how many requests run; the pool only needs room for its ceiling
+        workers = controller.ceiling
+    use_async = args.async_engine or async_engine
+    if use_async:
+        logging.info(f"Async engine: up to {args.max_in_flight} requests in flight.")
+    elif workers > 1:
+        logging.info(f"Grading with up to {workers} concurrent workers.")
+
+    def grading_pass(dirs: list[Path], defer: bool) -> list[str]:
+        if use_async:
+            return asyncio.run(grade_all_async(
+                dirs, csv_path, grading_key_file, required_files, model,
+                max_score, exclusions, system_prompt, settings, max(1, args.max_in_flight), defer,
+            ))
+        if workers == 1:
+            return [
+                grade_student(sdir, csv_path, grading_key_file, required_files, model,
+                              max_score, exclusions, system_prompt, settings, defer)
+                for sdir in dirs
+            ]
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grader") as pool:
+            futures = [
+                pool.submit(grade_student, sdir, csv_path, grading_key_file, required_files,
+                            model, max_score, exclusions, system_prompt, settings, defer)
+                for sdir in dirs
+            ]
+            return [future.result() for future in futures]
+
+    if args.batch or args.batch_id:
+        run_batch(student_dirs, csv_path, grading_key_file, required_files, model,
+                  max_score, exclusions, system_prompt, settings, args.batch_id)
+    else:
+        pending = grade_packed(
+            student_dirs, csv_path, grading_key_file, required_files, model,
+            max_score, exclusions, system_prompt, settings, workers,
+        )
 
-            # Also record in CSV
-            append_csv_row(logs_dir / "grading_summary.csv", sdir.name, None, "Empty/README-only")
-            continue
+        # Students that failed on transient API errors are retried after everyone
+        # else, instead of holding a worker while backing off.
+        rounds = resolve_deferred_rounds(settings)
+        for round_no in range(rounds + 1 if pending else 0):
+            statuses = grading_pass(pending, defer=round_no < rounds)
+            pending = [s for s, status in zip(pending, statuses) if status == "Deferred"]
+            if not pending:
+                break
+            logging.info(f"[DEFER] Retrying {len(pending)} deferred student(s) (round {round_no + 1}/{rounds})")
 
-        logging.info(f"Grading {sdir.name} ...")
-        result_text = grade_submission(
-            sdir, 
-            grading_key_file,
-            required_files, 
-            model,
-            max_score,
-            exclusions, 
-            system_prompt
+    if caching_responses():
+        logging.info(
+            f"Grading completed. Response cache: {RESPONSE_CACHE.hits} hit(s), {RESPONSE_CACHE.misses} miss(es)."
         )
-        
-        status = "Graded" if result_text else "Error"
-        append_csv_row(csv_path, sdir.name, result_text, status)
-
-    logging.info("Grading completed.")
+    else:
+        logging.info("Grading completed.")
+    if CASCADE_COUNTS:
+        logging.info("[CASCADE] Students per tier: " + ", ".join(
+            f"{model}: {CASCADE_COUNTS[model]}" for model in resolve_cascade_tiers(settings)
+        ))
+    if isinstance(backend, KeyPoolBackend):
+        backend.log_usage()
     logging.info(f"Results consolidated → {csv_path}")
 
 if __name__ == "__main__":
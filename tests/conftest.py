@@ -23,6 +23,16 @@ def test_run_logger():
     logger.info("=== Test session finished ===")
 
 
+@pytest.fixture(autouse=True)
+def reset_run_state(monkeypatch):
+    """main() configures per-run module state; keep it from leaking between tests."""
+    from src.repo_grading_assistant import grade_assignments as ga
+    for name in ("CONCURRENCY", "CIRCUIT_BREAKER", "HEDGER", "RESPONSE_CACHE"):
+        monkeypatch.setattr(ga, name, None)
+    monkeypatch.setattr(ga, "RATE_LIMITERS", {})
+    monkeypatch.setattr(ga, "BACKEND", ga.OpenAIBackend())
+
+
 @pytest.fixture
 def temp_project(tmp_path):
     """Creates a fake homework folder with a config, logs, and a dummy key."""
@@ -1,7 +1,12 @@
 # tests/test_grade_assignments.py
 
 import sys
+import threading
+import time
+import asyncio
 import csv
+import json
+import re
 import pytest
 import os
 
@@ -10,6 +15,8 @@ from src.repo_grading_assistant.grade_assignments import (
     combine_submission_text,
     append_csv_row,
     write_grade_summary,
+    upgrade_csv_header,
+    CSV_COLUMNS,
     grade_submission,
     parse_rule,
     find_all_by_pattern,
@@ -19,6 +26,53 @@ from src.repo_grading_assistant.grade_assignments import (
     resolve_configs_dir,
     resolve_grading_key_path,
     extract_bonus_behaviors_from_key,
+    normalize_source,
+    resolve_normalization_modes,
+    outline_python_source,
+    split_rule_entry,
+    render_notebook,
+    extract_rubric_items,
+    search_terms,
+    bm25_scores,
+    split_into_chunks,
+    retrieve_relevant_chunks,
+    SummaryCache,
+    plan_packs,
+    split_files_for_map,
+    fetch_submission_file,
+    build_directory_tree,
+    TokenBucket,
+    RateLimiter,
+    rate_limit_delay,
+    configure_rate_limits,
+    request_completion,
+    ConcurrencyController,
+    classify_request_error,
+    CircuitBreaker,
+    send_completion,
+    grade_student,
+    RETRY_ATTEMPTS,
+    RequestHedger,
+    ResponseCache,
+    run_batch,
+    build_grading_messages,
+    split_packed_response,
+    grade_packed,
+    stream_grading_report,
+    FakeBackend,
+    configure_backend,
+    KeyPoolBackend,
+    PooledKey,
+    build_key_pool,
+    SharedRateLedger,
+    route_model,
+    report_problems,
+    CASCADE_COUNTS,
+    repair_report,
+    merge_score_summary,
+    parse_structured_report,
+    render_structured_report,
+    STRUCTURED_RESPONSE_FORMAT,
 )
 
 # OpenAI Python SDK: support both old (<1.0) and new (>=1.0) exception locations
@@ -102,6 +156,23 @@ def test_append_csv_row_creates_and_appends(temp_project):
 # Grade Summary Writing
 # --------------------------------------------------------------------
 
+def test_upgrade_csv_header_creates_and_upgrades(tmp_path):
+    fresh = tmp_path / "fresh.csv"
+    upgrade_csv_header(fresh)
+    append_csv_row(fresh, "alice", "Total: 50/60 points", "Graded", "gpt-5-mini")
+    rows = list(csv.reader(fresh.open()))
+    assert rows[0] == CSV_COLUMNS and len(rows[1]) == len(CSV_COLUMNS)
+
+    for old_header in (["Student Directory", "Status"], CSV_COLUMNS[:7]):
+        old = tmp_path / "old.csv"
+        with old.open("w", newline="") as f:
+            csv.writer(f).writerows([old_header, ["2025-01-01", "1.0", "bob", "Graded", "40", "60", "-"]])
+        upgrade_csv_header(old)
+        rows = list(csv.reader(old.open()))
+        assert rows[0] == CSV_COLUMNS
+        assert rows[1][2] == "bob"
+
+
 def test_write_grade_summary_overwrites(temp_project):
     student_dir = temp_project["student_dir"]
     summary = student_dir / "grade_summary.txt"
@@ -237,6 +308,11 @@ def test_main_validate(monkeypatch, temp_project, fake_env, fake_openai):
 
     grade_assignments.main()
     assert (temp_project["student_dir"] / "grade_summary.txt").exists()
+    csv_path = next(temp_project["root"].rglob("grading_summary.csv"))
+    with csv_path.open(newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert list(rows[0]) == CSV_COLUMNS
+    assert rows[-1]["Status"].startswith("Validate run") and rows[-1]["Model"]
 
 
 def test_skip_scored(temp_project, monkeypatch, fake_env):
@@ -941,6 +1017,1632 @@ def test_cardinality_unbounded_any_count(tmp_path):
     assert min_count <= len(matches)
     assert max_count == float("inf")
 
+# --------------------------------------------------------------------
+# Source Normalization Tests
+# --------------------------------------------------------------------
+
+def test_normalize_source_python_strips_comments_and_indent():
+    text = (
+        "# Generated by Django\n"
+        "\n\n\n"
+        "class Post(models.Model):\n"
+        "    # title field\n"
+        "    title = models.CharField(max_length=100)\n"
+        "\n\n"
+        "    def __str__(self):\n"
+        "        return self.title\n"
+    )
+    out = normalize_source(text, ".py")
+
+    assert "Generated by Django" not in out
+    assert "title field" not in out
+    assert "\n\n\n" not in out
+    assert " title = models.CharField(max_length=100)" in out
+    assert "  return self.title" in out
+
+
+def test_normalize_source_aggressive_only_for_web(tmp_path):
+    css = "/* theme */\nbody {\n    color: red;\n}\n\n\np { margin: 0; }\n"
+    out = normalize_source(css, ".css", aggressive=True)
+    assert out == "body {\ncolor: red;\n}\np { margin: 0; }\n"
+
+    # Aggressive is ignored for Python: indentation must survive
+    py = "def f():\n    return 1\n"
+    assert normalize_source(py, ".py", aggressive=True) == "def f():\n return 1\n"
+
+
+def test_normalize_source_keeps_comment_markers_inside_strings():
+    py = (
+        "HELP = \"\"\"\n"
+        "# Usage\n"
+        "run the app\n"
+        "\"\"\"\n"
+        "# real comment\n"
+        "x = 1  # trailing\n"
+    )
+    out = normalize_source(py, ".py")
+    assert "# Usage" in out
+    assert "real comment" not in out
+    assert "x = 1  # trailing" in out
+
+    js = 'const glob = "src/**/*.js"; /* note */\nconst tag = "<!-- hi -->";\n// old code\n'
+    out = normalize_source(js, ".js", aggressive=True)
+    assert 'const glob = "src/**/*.js";' in out
+    assert "note" not in out
+    assert 'const tag = "<!-- hi -->";' in out
+    assert "old code" not in out
+
+    css = 'a::after { content: "/* not a comment */"; }\n/* theme */\n'
+    assert normalize_source(css, ".css", aggressive=True) == 'a::after { content: "/* not a comment */"; }\n'
+
+
+def test_normalize_source_keeps_slash_lines_inside_multiline_strings():
+    js = "const tpl = `<script src=\"\n//cdn.example.com/lib.js\"></script>`;\n// real comment\nlet url = '//x';\n"
+    out = normalize_source(js, ".js")
+    assert "//cdn.example.com/lib.js" in out
+    assert "real comment" not in out
+    assert "let url = '//x';" in out
+
+    java = 'String sql = """\n    // not a comment\n    SELECT 1\n    """;\n// comment\n'
+    out = normalize_source(java, ".java")
+    assert "// not a comment" in out
+    assert "\n// comment" not in out
+
+
+def test_resolve_normalization_modes_shortcut_and_dict():
+    assert resolve_normalization_modes({}) == {}
+    assert resolve_normalization_modes(
+        {"normalization": True, "language_profile": ["python", "web"]}
+    ) == {"python": "standard", "web": "aggressive"}
+    assert resolve_normalization_modes(
+        {"normalization": {"python": "off", "web": "standard"}}
+    ) == {"web": "standard"}
+
+
+def test_combine_submission_text_normalized_uses_compact_header(tmp_path, sample_log):
+    (tmp_path / "views.py").write_text("# comment\n\n\n\ndef index():\n    return 1\n")
+
+    combined = combine_submission_text(
+        tmp_path, ["views.py"], exclusions=[],
+        settings={"normalization": {"python": "standard"}}
+    )
+
+    assert "### FILE views.py | rule=views.py | match=exact-name" in combined
+    assert "### FILE START" not in combined
+    assert "# comment" not in combined
+    assert "[NORMALIZE]" in sample_log.text
+
+# --------------------------------------------------------------------
+# Outline Mode Tests
+# --------------------------------------------------------------------
+
+def test_outline_python_source_keeps_signatures_and_fields():
+    source = (
+        "from django.db import models\n"
+        "\n"
+        "class Post(models.Model):\n"
+        "    \"\"\"A blog post.\"\"\"\n"
+        "    title = models.CharField(max_length=100)\n"
+        "\n"
+        "    @property\n"
+        "    def slug(self) -> str:\n"
+        "        value = self.title.lower()\n"
+        "        return value.replace(' ', '-')\n"
+        "\n"
+        "class Migration(migrations.Migration):\n"
+        "    operations = [migrations.CreateModel(name='Post'), migrations.DeleteModel(name='Contact')]\n"
+    )
+    outline = outline_python_source(source)
+
+    assert "from django.db import models" in outline
+    assert "class Post(models.Model):" in outline
+    assert "    title = models.CharField(max_length=100)" in outline
+    assert "    @property" in outline
+    assert "    def slug(self) -> str: ..." in outline
+    assert "replace" not in outline
+    assert "A blog post" not in outline
+    assert "    operations = ...  # 2 items" in outline
+
+
+def test_outline_python_source_unparseable_returns_none():
+    assert outline_python_source("def broken(:\n    pass\n") is None
+
+
+def test_combine_submission_text_outline_rule_falls_back_to_full_text(tmp_path):
+    (tmp_path / "admin.py").write_text("def register(site):\n    site.register(Post)\n")
+    (tmp_path / "apps.py").write_text("def broken(:\n    pass\n")
+
+    combined = combine_submission_text(
+        tmp_path,
+        [{"rule": "admin.py", "mode": "outline"}, {"rule": "apps.py", "mode": "outline"}],
+        exclusions=[],
+    )
+
+    assert "def register(site): ..." in combined
+    assert "site.register(Post)" not in combined
+    assert "### VIEW: outline" in combined
+    assert "def broken(:" in combined
+
+
+def test_split_rule_entry_string_and_object():
+    assert split_rule_entry("urls.py(2)") == ("urls.py(2)", {})
+    assert split_rule_entry({"rule": "**/admin.py", "mode": "outline"}) == ("**/admin.py", {"mode": "outline"})
+
+# --------------------------------------------------------------------
+# Notebook Rendering Tests
+# --------------------------------------------------------------------
+
+NOTEBOOK_JSON = json.dumps({
+    "metadata": {"kernelspec": {"name": "python3"}, "widgets": {"state": {"x": 1}}},
+    "nbformat": 4,
+    "cells": [
+        {"cell_type": "markdown", "metadata": {}, "source": ["# Lab 3\n", "Load the data"]},
+        {
+            "cell_type": "code",
+            "execution_count": 2,
+            "metadata": {"scrolled": True},
+            "source": "df = load()\ndf.head()",
+            "outputs": [
+                {"output_type": "stream", "name": "stdout", "text": ["x" * 50]},
+                {"output_type": "display_data", "data": {"image/png": "iVBORw0KGgo" * 100, "text/plain": ["<Figure>"]}},
+            ],
+        },
+        {"cell_type": "raw", "metadata": {}, "source": "ignored"},
+    ],
+})
+
+
+def test_render_notebook_drops_images_and_metadata():
+    out = render_notebook(NOTEBOOK_JSON)
+
+    assert "[1] markdown\n# Lab 3\nLoad the data" in out
+    assert "[2] code (exec 2)\ndf = load()\ndf.head()" in out
+    assert "iVBORw0KGgo" not in out
+    assert "kernelspec" not in out
+    assert "--- output ---" not in out
+    assert "ignored" not in out
+
+
+def test_render_notebook_rejects_or_skips_wrong_shapes():
+    assert render_notebook('{"cells": null}') is None
+    assert render_notebook("[1, 2]") is None
+    assert render_notebook("not json") is None
+
+    nb = json.dumps({"cells": [
+        "stray string",
+        {"cell_type": "code", "source": "print(1)", "outputs": ["bad", {"output_type": "stream", "text": "1\n"}]},
+        {"cell_type": "code", "source": "x", "outputs": {"oops": True}},
+        {"cell_type": "code", "source": "y", "outputs": [{"output_type": "execute_result", "data": None}]},
+    ]})
+    out = render_notebook(nb, output_chars=50)
+    assert "[2] code\nprint(1)" in out
+    assert "--- output ---\n1" in out
+    assert "[3] code\nx" in out and "[4] code\ny" in out
+
+
+def test_render_notebook_truncates_text_outputs():
+    out = render_notebook(NOTEBOOK_JSON, output_chars=20)
+
+    assert "--- output ---\n" + "x" * 20 + "... [truncated" in out
+    assert "iVBORw0KGgo" not in out
+
+
+def test_combine_submission_text_notebook_invalid_json_sent_raw(tmp_path):
+    (tmp_path / "good.ipynb").write_text(NOTEBOOK_JSON)
+    (tmp_path / "bad.ipynb").write_text("not json")
+
+    combined = combine_submission_text(tmp_path, ["*.ipynb(0..*)"], exclusions=[])
+
+    assert "### VIEW: notebook-cells" in combined
+    assert "kernelspec" not in combined
+    assert "not json" in combined
+
+# --------------------------------------------------------------------
+# Retrieval Tests
+# --------------------------------------------------------------------
+
+def test_extract_rubric_items_attaches_point_lines():
+    key = "Intro text\n\n- Search: find posts by title.\n*** +15 points\n- Commenting: comment on posts.\n"
+    items = extract_rubric_items(key)
+
+    assert items == ["Search: find posts by title. +15 points", "Commenting: comment on posts."]
+
+
+def test_search_terms_split_identifiers_and_stem():
+    assert search_terms("def searchPosts(query_text):") == ["search", "post", "query", "text"]
+
+
+def test_bm25_scores_prefers_matching_document():
+    docs = [search_terms("def search_posts(query): ..."), search_terms("def render_footer(): ...")]
+    scores = bm25_scores(search_terms("search for blog posts"), docs)
+
+    assert scores[0] > 0
+    assert scores[1] == 0
+
+
+def test_split_into_chunks_python_functions():
+    text = "import os\n\ndef a():\n    return 1\n\n@login_required\ndef b():\n    return 2\n"
+    chunks = split_into_chunks({"path": "views.py", "rule": "views.py", "match": "exact-name", "view": "full", "text": text})
+
+    spans = [(c["start"], c["end"]) for c in chunks]
+    assert spans == [(1, 2), (3, 4), (6, 8)]
+    assert chunks[-1]["text"].startswith("@login_required")
+
+
+def test_retrieve_relevant_chunks_keeps_rubric_code_within_budget():
+    filler = "\n".join(f"    x{i} = compute_layout_value({i})" for i in range(40))
+    views = (
+        "def search_posts(request):\n    query = request.GET['q']\n    return Post.objects.filter(title__icontains=query)\n\n"
+        f"def render_layout(request):\n{filler}\n    return None\n\n"
+        "def add_comment(request, pk):\n    return Comment.objects.create(post_id=pk)\n"
+    )
+    files = [{"path": "blog/views.py", "rule": "**/views.py", "match": "none", "view": "full", "text": views}]
+    key = "- Search: users can search blog posts by title.\n- Commenting: users can comment on posts.\n"
+
+    out = retrieve_relevant_chunks(files, key, token_budget=150)
+
+    assert "search_posts" in out
+    assert "add_comment" in out
+    assert "compute_layout_value" not in out
+    assert "### NOTE: Retrieval mode" in out
+
+# --------------------------------------------------------------------
+# File Summary Cache Tests
+# --------------------------------------------------------------------
+
+def test_large_identical_files_summarized_once(tmp_path, monkeypatch):
+    calls = {"count": 0}
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": "Helper module with parse() and render()."}})]
+
+    def fake_create(*args, **kwargs):
+        calls["count"] += 1
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+
+    big = "def helper():\n    pass\n" * 200
+    settings = {"model": "gpt-5-mini", "file_summaries": {"threshold_bytes": 1000, "cache_dir": str(tmp_path / "cache")}}
+
+    for name in ("student_a", "student_b"):
+        sdir = tmp_path / name
+        sdir.mkdir()
+        (sdir / "helpers.py").write_text(big)
+        (sdir / "views.py").write_text("def index():\n    return 1\n")
+        combined = combine_submission_text(sdir, ["helpers.py", "views.py"], exclusions=[], settings=settings)
+
+        assert "Helper module with parse() and render()." in combined
+        assert "### VIEW: summary" in combined
+        assert "def index():" in combined
+
+    assert calls["count"] == 1
+
+
+def test_summaries_use_request_pipeline_and_skip_planning(tmp_path, monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+    sent = []
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": "Summary."}})]
+
+    def fake_send(model, messages, student_name, **params):
+        sent.append((model, student_name))
+        return FakeResponse()
+
+    monkeypatch.setattr(ga, "send_completion", fake_send)
+    settings = {"model": "gpt-5-mini", "file_summaries": {"threshold_bytes": 100, "cache_dir": str(tmp_path / "cache")}}
+    sdir = tmp_path / "student_a"
+    sdir.mkdir()
+    (sdir / "helpers.py").write_text("def helper():\n    pass\n" * 20)
+
+    packs, single = plan_packs([sdir], "key", ["helpers.py"], [], settings,
+                               {"token_budget": 10000, "max_student_tokens": 5000, "max_students": 4})
+    assert sent == [] and single == [sdir]
+
+    files = ga.collect_submission_files(sdir, ["helpers.py"], [], settings)
+    assert files[0]["view"] == "summary"
+    assert sent == [("gpt-5-mini", "helpers.py")]
+
+
+def test_summary_cache_get_survives_concurrent_eviction(tmp_path, monkeypatch):
+    cache = SummaryCache(tmp_path, max_bytes=1000)
+    cache.put("a", "text")
+
+    def evicted(path, *args):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr("os.utime", evicted)
+    assert cache.get("a") is None
+
+
+def test_summary_cache_evicts_least_recently_used(tmp_path):
+    cache = SummaryCache(tmp_path, max_bytes=250)
+    cache.put("a", "x" * 100)
+    os.utime(tmp_path / "a.txt", (1, 1))
+    cache.put("b", "y" * 100)
+    os.utime(tmp_path / "b.txt", (2, 2))
+    assert cache.get("a") == "x" * 100    # touch "a" so "b" is now oldest
+
+    cache.put("c", "z" * 100)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+# --------------------------------------------------------------------
+# Map-Reduce Grading Tests
+# --------------------------------------------------------------------
+
+def test_split_files_for_map_keeps_rules_together_and_splits_large_files():
+    files = [
+        {"path": "a/views.py", "rule": "**/views.py", "match": "none", "view": "full", "text": "v" * 400},
+        {"path": "b/views.py", "rule": "**/views.py", "match": "none", "view": "full", "text": "v" * 400},
+        {"path": "models.py", "rule": "models.py", "match": "exact-name", "view": "full", "text": "m\n" * 600},
+    ]
+    chunks = split_files_for_map(files, chunk_tokens=250)
+
+    assert [p["path"] for p in chunks[0]] == ["a/views.py", "b/views.py"]
+    rest = [p["path"] for c in chunks[1:] for p in c]
+    assert all(p.startswith("models.py lines ") for p in rest)
+    assert len(rest) > 1
+
+
+def test_grade_submission_map_reduce_when_prompt_too_large(temp_project, fake_env, monkeypatch):
+    student_dir = temp_project["student_dir"]
+    (student_dir / "main.py").write_text("print('x')\n" * 400)
+    calls = []
+
+    def fake_create(*args, **kwargs):
+        content = kwargs["messages"][-1]["content"]
+        calls.append(content)
+        text = "Findings: prints output." if "Submission Part" in content else "Total: 50/60 points"
+        return type("R", (), {"choices": [type("obj", (), {"message": {"content": text}})]})()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+
+    result = grade_submission(
+        student_dir,
+        temp_project["grading_key_file"],
+        ["main.py", "readme.txt"],
+        "gpt-4o-mini",
+        60,
+        [],
+        SYSTEM_PROMPT,
+        {"map_reduce": {"max_prompt_tokens": 500, "chunk_tokens": 400}},
+    )
+
+    map_calls = [c for c in calls if "Submission Part" in c]
+    assert len(map_calls) >= 2
+    assert "Reviewer Findings" in calls[-1]
+    assert "Findings: prints output." in calls[-1]
+    assert "Total: 50/60" in result
+
+
+def test_grade_submission_async_falls_back_to_map_reduce(temp_project, fake_env, monkeypatch):
+    import openai.error as oe
+    from src.repo_grading_assistant.grade_assignments import grade_submission_async
+    student_dir = temp_project["student_dir"]
+    (student_dir / "main.py").write_text("print('x')\n" * 400)
+    calls = []
+
+    async def fake_acreate(*args, **kwargs):
+        raise oe.InvalidRequestError("This model's maximum context length is 128 tokens", param=None)
+
+    def fake_create(*args, **kwargs):
+        content = kwargs["messages"][-1]["content"]
+        calls.append(content)
+        text = "Findings: prints output." if "Submission Part" in content else "Total: 50/60 points"
+        return type("R", (), {"choices": [type("obj", (), {"message": {"content": text}})]})()
+
+    monkeypatch.setattr("openai.ChatCompletion.acreate", fake_acreate)
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+
+    result = asyncio.run(grade_submission_async(
+        student_dir,
+        temp_project["grading_key_file"],
+        ["main.py", "readme.txt"],
+        "gpt-4o-mini",
+        60,
+        [],
+        SYSTEM_PROMPT,
+        {"map_reduce": {"max_prompt_tokens": 100_000, "chunk_tokens": 400}},
+    ))
+
+    assert any("Submission Part" in c for c in calls)
+    assert "Reviewer Findings" in calls[-1]
+    assert "Total: 50/60" in result
+
+
+def test_map_reduce_reports_map_call_failure(monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+
+    def failing_request(model, messages, student_name, **params):
+        if "part 2/" in student_name:
+            ga.LAST_REQUEST_FAILURE.set("timeout")
+            return None
+        return type("R", (), {"choices": [type("obj", (), {"message": {"content": "Findings."}})]})()
+
+    monkeypatch.setattr(ga, "request_completion", failing_request)
+    files = [
+        {"path": f"f{i}.py", "rule": f"f{i}.py", "match": "exact", "view": "full", "text": "x = 1\n" * 200}
+        for i in range(3)
+    ]
+    mr_cfg = {"chunk_tokens": 400, "max_workers": 3, "max_prompt_tokens": 500}
+
+    assert ga.map_reduce_grade(files, "key", "system", "gpt-5-mini", 60, False, mr_cfg, "alice") is None
+    assert ga.LAST_REQUEST_FAILURE.get() == "timeout"
+
+# --------------------------------------------------------------------
+# Lazy File Fetching Tests
+# --------------------------------------------------------------------
+
+def test_fetch_submission_file_refuses_outside_and_excluded(tmp_path):
+    sdir = tmp_path / "student"
+    (sdir / "app").mkdir(parents=True)
+    (sdir / "app" / "views.py").write_text("def index(): pass\n")
+    (sdir / "secret.pyc").write_text("bytes")
+    (tmp_path / "other.txt").write_text("not yours")
+
+    assert "def index()" in fetch_submission_file(sdir, "app/views.py", [], {}, 1000)
+    assert fetch_submission_file(sdir, "../other.txt", [], {}, 1000).startswith("ERROR")
+    assert fetch_submission_file(sdir, "secret.pyc", ["*.pyc"], {}, 1000).startswith("ERROR")
+    assert "secret.pyc" not in build_directory_tree(sdir, ["*.pyc"])
+
+
+def test_grade_submission_lazy_fetch_serves_requested_files(temp_project, fake_env, monkeypatch, sample_log):
+    student_dir = temp_project["student_dir"]
+    requests_seen = []
+
+    def tool_call(call_id, path):
+        return {"id": call_id, "type": "function", "function": {"name": "read_file", "arguments": json.dumps({"path": path})}}
+
+    def fake_create(*args, **kwargs):
+        requests_seen.append({**kwargs, "messages": list(kwargs["messages"])})
+        if len(requests_seen) == 1:
+            message = {"content": None, "tool_calls": [tool_call("c1", "main.py"), tool_call("c2", "readme.txt")]}
+        else:
+            message = {"content": "Total: 58/60 points"}
+        return type("R", (), {"choices": [type("obj", (), {"message": message})]})()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+
+    result = grade_submission(
+        student_dir,
+        temp_project["grading_key_file"],
+        ["main.py", "readme.txt"],
+        "gpt-4o-mini",
+        60,
+        [],
+        SYSTEM_PROMPT,
+        {"lazy_fetch": {"max_fetches": 1}},
+    )
+
+    first_prompt = requests_seen[0]["messages"][-1]["content"]
+    assert "main.py (" in first_prompt
+    assert "Hello world" not in first_prompt
+
+    tool_messages = [m for m in requests_seen[1]["messages"] if m["role"] == "tool"]
+    assert "Hello world" in tool_messages[0]["content"]
+    assert "fetch limit" in tool_messages[1]["content"]
+    assert requests_seen[1]["tool_choice"] == "none"
+    assert "[LAZY]" in sample_log.text
+    assert "Total: 58/60" in result
+
+# --------------------------------------------------------------------
+# Concurrent Grading Tests
+# --------------------------------------------------------------------
+
+def test_main_workers_grades_all_students_with_intact_csv(monkeypatch, temp_project, fake_env):
+    import time as time_module
+    import src.repo_grading_assistant.grade_assignments as grade_assignments
+
+    root = temp_project["root"]
+    for i in range(6):
+        sdir = root / f"homework-student_{i}"
+        sdir.mkdir()
+        (sdir / "main.py").write_text(f"print({i})")
+        (sdir / "readme.txt").write_text("hi")
+
+    def slow_create(*args, **kwargs):
+        time_module.sleep(0.05)
+        return type("R", (), {"choices": [type("obj", (), {"message": {"content": "Total: 50/60 points\n- Missing docs, with, commas"}})]})()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", slow_create)
+    monkeypatch.setattr(sys, "argv", [
+        "prog",
+        "--config", str(temp_project["config_file"]),
+        "--repo-root", str(root),
+        "--workers", "4",
+    ])
+    monkeypatch.chdir(root)
+
+    grade_assignments.main()
+
+    rows = list(csv.reader(open(root / "logs" / "grading_summary.csv", encoding="utf-8")))
+    graded = [r for r in rows[1:] if r[3] == "Graded"]
+    assert len(graded) == 7
+    assert all(len(r) == 8 for r in rows[1:])
+    assert all(r[7] == "gpt-5-mini" for r in graded)
+    assert all((d / "grade_summary.txt").exists() for d in root.glob("homework-*"))
+
+# --------------------------------------------------------------------
+# Async Engine Tests
+# --------------------------------------------------------------------
+
+def test_main_async_engine_uses_shared_session(monkeypatch, temp_project, fake_env):
+    import openai
+    import src.repo_grading_assistant.grade_assignments as grade_assignments
+
+    root = temp_project["root"]
+    for i in range(5):
+        sdir = root / f"homework-student_{i}"
+        sdir.mkdir()
+        (sdir / "main.py").write_text(f"print({i})")
+        (sdir / "readme.txt").write_text("hi")
+
+    sessions = set()
+    in_flight = {"now": 0, "peak": 0}
+
+    async def fake_acreate(*args, **kwargs):
+        import asyncio
+        sessions.add(id(openai.aiosession.get()))
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(0.02)
+        in_flight["now"] -= 1
+        return type("R", (), {"choices": [type("obj", (), {"message": {"content": "Total: 40/60 points"}})]})()
+
+    monkeypatch.setattr("openai.ChatCompletion.acreate", fake_acreate)
+    monkeypatch.setattr(sys, "argv", [
+        "prog",
+        "--config", str(temp_project["config_file"]),
+        "--repo-root", str(root),
+        "--async",
+        "--max-in-flight", "3",
+    ])
+    monkeypatch.chdir(root)
+
+    grade_assignments.main()
+
+    rows = list(csv.reader(open(root / "logs" / "grading_summary.csv", encoding="utf-8")))
+    assert len([r for r in rows[1:] if r[3] == "Graded"]) == 6
+    assert len(sessions) == 1
+    assert 1 < in_flight["peak"] <= 3
+    assert openai.aiosession.get() is None
+
+# --------------------------------------------------------------------
+# Rate Limiter Tests
+# --------------------------------------------------------------------
+
+def test_token_bucket_reserve_returns_wait_when_empty():
+    bucket = TokenBucket(per_minute=60)   # 1 per second
+
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(2) == pytest.approx(2.0, abs=0.05)
+
+
+def test_rate_limiter_settle_refunds_overestimate():
+    limiter = RateLimiter(requests_per_minute=None, tokens_per_minute=600)
+
+    limiter.reserve(600)
+    limiter.settle(estimated=600, actual=100)
+
+    assert limiter.reserve(500) == pytest.approx(0.0, abs=0.05)
+
+
+def test_rate_limit_delay_prefers_retry_after_headers():
+    from openai.error import RateLimitError
+
+    e = RateLimitError("slow down", headers={"Retry-After": "7"})
+    assert rate_limit_delay(e, fallback=1.0) == 7.0
+
+    e = RateLimitError("slow down", headers={"x-ratelimit-reset-requests": "250ms", "x-ratelimit-reset-tokens": "1m3s"})
+    assert rate_limit_delay(e, fallback=1.0) == 63.0
+
+    assert rate_limit_delay(RateLimitError("slow down"), fallback=1.5) == 1.5
+
+
+def test_request_completion_retries_429_after_retry_after(monkeypatch):
+    from openai.error import RateLimitError
+
+    sleeps = []
+    calls = {"count": 0}
+
+    def fake_create(*args, **kwargs):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise RateLimitError("Rate limit reached", headers={"retry-after-ms": "1200"})
+        return {"choices": [{"message": {"content": "ok"}}], "usage": {"total_tokens": 10}}
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    monkeypatch.setattr("time.sleep", lambda s: sleeps.append(s))
+
+    configure_rate_limits({"rate_limits": {"m": {"requests_per_minute": 600, "tokens_per_minute": 100000}}})
+    try:
+        resp = request_completion("m", [{"role": "user", "content": "hi"}], "student_x")
+    finally:
+        configure_rate_limits({})
+
+    assert resp is not None
+    assert calls["count"] == 2
+    assert max(sleeps) == pytest.approx(1.2, abs=0.05)
+
+# --------------------------------------------------------------------
+# Adaptive Concurrency Tests
+# --------------------------------------------------------------------
+
+def test_concurrency_controller_additive_increase_and_sharp_decrease(sample_log):
+    ctl = ConcurrencyController(floor=2, ceiling=8, initial=4, cooldown_seconds=0)
+
+    for _ in range(40):
+        ctl.acquire()
+        ctl.release(1.0, "ok")
+    assert int(ctl.limit) == 8                      # capped at ceiling
+
+    ctl.acquire()
+    ctl.release(1.0, "rate_limited")
+    assert int(ctl.limit) == 4
+
+    ctl.acquire()
+    ctl.release(120.0, "timeout")
+    ctl.acquire()
+    ctl.release(120.0, "timeout")
+    assert int(ctl.limit) == 2                      # never below floor
+    assert "[CONCURRENCY] limit 8 → 4" in sample_log.text
+
+
+def test_concurrency_controller_cuts_on_rising_p95():
+    ctl = ConcurrencyController(floor=1, ceiling=20, initial=10, step=0, cooldown_seconds=0)
+
+    for latency in [2.0] * 20 + [10.0] * 20:
+        ctl.acquire()
+        ctl.release(latency, "ok")
+        if latency == 2.0:
+            assert int(ctl.limit) == 10
+
+    assert int(ctl.limit) < 10
+
+
+def test_concurrency_controller_slot_blocks_at_limit():
+    ctl = ConcurrencyController(floor=1, ceiling=1, initial=1)
+
+    with ctl.slot():
+        assert not ctl.try_acquire()
+    assert ctl.try_acquire()
+
+# --------------------------------------------------------------------
+# Retry Policy, Circuit Breaker and Deferred Retries
+# --------------------------------------------------------------------
+
+def test_classify_request_error_buckets():
+    import openai.error as oe
+    assert classify_request_error(oe.RateLimitError("slow down")) == "rate_limited"
+    assert classify_request_error(oe.Timeout("late")) == "timeout"
+    assert classify_request_error(oe.APIConnectionError("reset")) == "connection"
+    assert classify_request_error(oe.ServiceUnavailableError("down")) == "server"
+    assert classify_request_error(oe.APIError("boom", http_status=502)) == "server"
+    assert classify_request_error(oe.InvalidRequestError("bad", param=None)) == "client"
+
+
+def test_circuit_breaker_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker._ready() == (0, False)
+    breaker.record_failure()
+    assert breaker._ready()[0] > 0       # open: dispatch paused
+    assert breaker.wait()                # half-open after reset_seconds: this caller probes
+    assert breaker.probing
+    breaker.record_success()
+    assert breaker.failures == 0 and breaker._ready() == (0, False)
+
+
+def _half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    return breaker
+
+
+def _run_with_timeout(func, timeout=3.0):
+    result = {}
+
+    def target():
+        try:
+            result["value"] = func()
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "request still blocked by the circuit breaker"
+    return result
+
+
+def test_circuit_breaker_probe_released_on_client_error(monkeypatch):
+    import openai.error as oe
+    from src.repo_grading_assistant import grade_assignments as ga
+
+    monkeypatch.setattr(ga, "CIRCUIT_BREAKER", _half_open_breaker())
+    outcomes = [oe.InvalidRequestError("bad request", param=None), None]
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": "Total: 50/60 points"}})]
+
+    def fake_create(**kwargs):
+        error = outcomes.pop(0)
+        if error:
+            raise error
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    first = _run_with_timeout(lambda: send_completion("gpt-5-mini", [{"role": "user", "content": "x"}], "alice"))
+    assert isinstance(first["error"], oe.InvalidRequestError)
+    assert not ga.CIRCUIT_BREAKER.probing
+
+    second = _run_with_timeout(lambda: send_completion("gpt-5-mini", [{"role": "user", "content": "x"}], "bob"))
+    assert second["value"] is not None
+    assert ga.CIRCUIT_BREAKER.failures == 0
+
+
+def test_circuit_breaker_probe_released_on_rate_limit(monkeypatch):
+    from openai.error import RateLimitError
+    from src.repo_grading_assistant import grade_assignments as ga
+
+    monkeypatch.setattr(ga, "CIRCUIT_BREAKER", _half_open_breaker())
+    monkeypatch.setattr(ga, "rate_limit_delay", lambda error, fallback: 0.01)
+    outcomes = [RateLimitError("slow down"), None]
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": "Total: 50/60 points"}})]
+
+    def fake_create(**kwargs):
+        error = outcomes.pop(0)
+        if error:
+            raise error
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    result = _run_with_timeout(lambda: send_completion("gpt-5-mini", [{"role": "user", "content": "x"}], "alice"))
+    assert result["value"] is not None
+    assert not ga.CIRCUIT_BREAKER.probing and ga.CIRCUIT_BREAKER.failures == 0
+
+
+def test_grade_student_defers_transient_failures(temp_project, fake_env, monkeypatch):
+    csv_path = temp_project["logs"] / "grading_summary.csv"
+    calls = {"count": 0}
+
+    def down(*args, **kwargs):
+        calls["count"] += 1
+        raise APIConnectionError("connection refused")
+
+    monkeypatch.setattr("openai.ChatCompletion.create", down)
+    monkeypatch.setattr("time.sleep", lambda *_: None)
+    monkeypatch.setattr("src.repo_grading_assistant.grade_assignments.CIRCUIT_BREAKER", None)
+
+    args = (temp_project["student_dir"], csv_path, temp_project["grading_key_file"],
+            ["main.py", "readme.txt"], "gpt-4o-mini", 60, [], SYSTEM_PROMPT, {})
+
+    assert grade_student(*args, defer=True) == "Deferred"
+    assert calls["count"] == RETRY_ATTEMPTS["connection"]
+    assert not csv_path.exists()
+
+    assert grade_student(*args) == "Error"
+    assert "Error" in csv_path.read_text()
+
+# --------------------------------------------------------------------
+# Request Hedging
+# --------------------------------------------------------------------
+
+def _warm_hedger(**kwargs):
+    hedger = RequestHedger(min_samples=3, min_delay=0.01, **kwargs)
+    for _ in range(3):
+        hedger.call(lambda: "ok")
+    return hedger
+
+
+def test_hedger_sends_duplicate_for_straggler():
+    hedger = _warm_hedger(max_hedge_rate=1.0)
+    calls = {"count": 0}
+
+    def send():
+        calls["count"] += 1
+        if calls["count"] == 1:
+            time.sleep(1.0)          # straggler
+            return "slow"
+        return "fast"
+
+    start = time.monotonic()
+    assert hedger.call(send, "jdoe") == "fast"
+    assert time.monotonic() - start < 0.9
+    assert hedger.hedges == 1
+
+
+def test_hedger_respects_hedge_rate_cap():
+    hedger = _warm_hedger(max_hedge_rate=0.0)
+
+    def send():
+        time.sleep(0.05)
+        return "only"
+
+    assert hedger.call(send) == "only"
+    assert hedger.hedges == 0
+
+
+def test_hedger_duplicate_needs_free_concurrency_slot(monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+    hedger = _warm_hedger(max_hedge_rate=1.0)
+
+    def send():
+        time.sleep(0.1)
+        return "slow"
+
+    monkeypatch.setattr(ga, "CONCURRENCY", ga.ConcurrencyController(floor=1, ceiling=1))
+    with ga.CONCURRENCY.slot():
+        assert hedger.call(send, "full") == "slow"
+    assert hedger.hedges == 0
+
+    hedger = _warm_hedger(max_hedge_rate=1.0)
+    monkeypatch.setattr(ga, "CONCURRENCY", ga.ConcurrencyController(floor=2, ceiling=2))
+    seen = []
+    with ga.CONCURRENCY.slot():
+        hedger.call(send, "spare", lambda: seen.append(ga.CONCURRENCY.in_flight) or "dup")
+    assert hedger.hedges == 1
+    assert seen == [2]
+
+
+def test_hedger_keeps_caller_concurrency():
+    hedger = _warm_hedger(max_hedge_rate=0.0)
+    callers = 48                     # above a default thread pool's size
+    state = {"active": 0, "peak": 0}
+    lock = threading.Lock()
+    all_started = threading.Barrier(callers, timeout=5)
+
+    def send():
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        try:
+            all_started.wait()
+        except threading.BrokenBarrierError:
+            pass
+        with lock:
+            state["active"] -= 1
+        return "ok"
+
+    threads = [threading.Thread(target=hedger.call, args=(send,)) for _ in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+
+    assert state["peak"] == callers
+
+
+def test_hedger_async_cancels_loser():
+    hedger = RequestHedger(min_samples=1, min_delay=0.01, max_hedge_rate=1.0)
+    hedger.latencies.append(0.01)
+    state = {"count": 0, "cancelled": False}
+
+    async def send():
+        state["count"] += 1
+        if state["count"] == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                state["cancelled"] = True
+                raise
+        return "fast"
+
+    async def run():
+        result = await hedger.call_async(send, "jdoe")
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "fast"
+    assert state["cancelled"]
+
+# --------------------------------------------------------------------
+# Response Cache
+# --------------------------------------------------------------------
+
+def _api_response(text):
+    import openai.util
+    return openai.util.convert_to_openai_object(
+        {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": {"total_tokens": 10}}
+    )
+
+
+def test_response_cache_serves_identical_requests_from_disk(tmp_path):
+    cache = ResponseCache(tmp_path / "responses", 10_000_000)
+    messages = [{"role": "user", "content": "grade this"}]
+    calls = {"count": 0}
+
+    def send():
+        calls["count"] += 1
+        return _api_response("Total: 50/60")
+
+    first = cache.through("gpt-5-mini", messages, {}, send)
+    again = ResponseCache(tmp_path / "responses", 10_000_000).through("gpt-5-mini", messages, {}, send)
+    other = cache.through("gpt-5-mini", messages, {"temperature": 0}, send)
+
+    assert first.choices[0].message["content"] == again.choices[0].message["content"] == "Total: 50/60"
+    assert other is not None
+    assert calls["count"] == 2            # different params → different key
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_response_cache_shares_in_flight_requests(tmp_path):
+    import threading
+    cache = ResponseCache(tmp_path / "responses", 10_000_000)
+    messages = [{"role": "user", "content": "same prompt"}]
+    release = threading.Event()
+    calls = {"count": 0}
+
+    def send():
+        calls["count"] += 1
+        release.wait(2)
+        return _api_response("shared")
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.through("m", messages, {}, send)))
+        for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert calls["count"] == 1
+    assert [r.choices[0].message["content"] for r in results] == ["shared"] * 3
+    assert cache.hits == 2
+
+
+def test_response_cache_waiters_adopt_owner_failure(tmp_path):
+    import contextvars
+    from src.repo_grading_assistant.grade_assignments import LAST_REQUEST_FAILURE
+    cache = ResponseCache(tmp_path / "responses", 10_000_000)
+    release = threading.Event()
+
+    def send():
+        release.wait(2)
+        LAST_REQUEST_FAILURE.set("rate_limited")
+        return None
+
+    contexts = [contextvars.copy_context() for _ in range(2)]
+    threads = [
+        threading.Thread(target=ctx.run, args=(cache.through, "m", [], {}, send)) for ctx in contexts
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert [ctx.get(LAST_REQUEST_FAILURE) for ctx in contexts] == ["rate_limited"] * 2
+
+
+def test_response_cache_expires_old_entries(tmp_path):
+    cache = ResponseCache(tmp_path / "responses", 10_000_000, max_age_seconds=60)
+    key = ResponseCache.request_key("m", [], {})
+    cache.store(key, _api_response("old"))
+    path = tmp_path / "responses" / f"{key}.json"
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert cache.load(key) is None
+    assert not path.exists()
+
+
+def test_response_cache_key_depends_on_backend(monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+    default = ResponseCache.request_key("m", [], {})
+    monkeypatch.setattr(ga, "BACKEND", ga.OpenAIBackend(base_url="http://localhost:8000/v1"))
+    assert ResponseCache.request_key("m", [], {}) != default
+
+    monkeypatch.setattr(ga, "RESPONSE_CACHE", object())
+    assert ga.caching_responses()
+    monkeypatch.setattr(ga, "BACKEND", ga.FakeBackend())
+    assert not ga.caching_responses()
+
+# --------------------------------------------------------------------
+# Batch Mode (against a local stand-in for the batch endpoints)
+# --------------------------------------------------------------------
+
+@pytest.fixture
+def batch_server():
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {"uploads": [], "polls": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, payload, text=None):
+            body = (text if text is not None else json.dumps(payload)).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+            if self.path == "/v1/files":
+                state["uploads"].append([json.loads(line) for line in body.splitlines() if line.startswith('{"custom_id"')])
+                return self._json({"id": "file_in"})
+            return self._json({"id": "batch_1", "status": "validating"})
+
+        def do_GET(self):
+            if self.path == "/v1/batches/batch_1":
+                state["polls"] += 1
+                status = "completed" if state["polls"] > 1 else "in_progress"
+                return self._json({"id": "batch_1", "status": status, "output_file_id": "file_out"})
+            lines = [
+                json.dumps({"custom_id": req["custom_id"], "response": {"status_code": 200, "body": {
+                    "choices": [{"message": {"content": "Deductions: none\nTotal: 58/60 points"}}]}}})
+                for req in state["uploads"][-1]
+            ]
+            return self._json(None, "\n".join(lines))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state["base_url"] = f"http://127.0.0.1:{server.server_port}/v1"
+    yield state
+    server.shutdown()
+
+
+def test_run_batch_submits_polls_and_records(temp_project, fake_env, batch_server, tmp_path):
+    student_dir = temp_project["student_dir"]
+    csv_path = tmp_path / "grading_summary.csv"
+    settings = {"batch": {"base_url": batch_server["base_url"], "poll_seconds": 0, "state_dir": str(tmp_path / "batches")}}
+    args = ([student_dir], csv_path, temp_project["grading_key_file"], ["main.py", "readme.txt"],
+            "gpt-5-mini", 60, [], SYSTEM_PROMPT, settings)
+
+    statuses = run_batch(*args)
+
+    assert statuses == {student_dir.name: "Graded"}
+    request = batch_server["uploads"][0][0]
+    assert request["custom_id"] == student_dir.name
+    assert request["body"]["model"] == "gpt-5-mini"
+    assert "Total: 58/60 points" in (student_dir / "grade_summary.txt").read_text(encoding="utf-8")
+    assert (tmp_path / "batches" / "batch_1.json").exists()
+
+    # Resuming by id re-downloads the results without submitting again
+    (student_dir / "grade_summary.txt").unlink()
+    assert run_batch(*args, batch_id="batch_1") == {student_dir.name: "Graded"}
+    assert len(batch_server["uploads"]) == 1
+    assert (student_dir / "grade_summary.txt").exists()
+
+# --------------------------------------------------------------------
+# Prefix-Cache-Friendly Prompt Layout
+# --------------------------------------------------------------------
+
+def test_grading_messages_share_a_byte_stable_prefix():
+    a = build_grading_messages("Grade carefully.", "KEY", "student A code", 60)
+    b = build_grading_messages("Grade carefully.", "KEY", "student B code", 60)
+
+    assert a[0] == b[0]
+    assert a[0]["role"] == "system"
+    assert a[0]["content"].startswith("Grade carefully.")
+    assert "KEY" in a[0]["content"] and "Total: <earned>/60 points" in a[0]["content"]
+    assert a[1]["content"] == "Student Submission:\nstudent A code"
+
+
+def test_find_all_by_pattern_returns_sorted_paths(tmp_path):
+    for name in ["zeta.py", "alpha.py", "mid.py"]:
+        (tmp_path / name).write_text("x")
+    matches = find_all_by_pattern(tmp_path, "*.py", [])
+    assert [p.name for p in matches] == ["alpha.py", "mid.py", "zeta.py"]
+
+
+def test_send_completion_logs_cached_prompt_tokens(monkeypatch, caplog):
+    import logging
+    import openai.util
+
+    resp = openai.util.convert_to_openai_object({
+        "choices": [{"message": {"content": "Total: 50/60"}}],
+        "usage": {"prompt_tokens": 2000, "total_tokens": 2100, "prompt_tokens_details": {"cached_tokens": 1536}},
+    })
+    monkeypatch.setattr("openai.ChatCompletion.create", lambda **kw: resp)
+    with caplog.at_level(logging.INFO):
+        request_completion("m", [{"role": "user", "content": "hi"}], "jdoe")
+    assert "[PROMPT-CACHE] jdoe: 1536/2000 prompt tokens cached (77%)" in caplog.text
+
+# --------------------------------------------------------------------
+# Packed Grading
+# --------------------------------------------------------------------
+
+def test_split_packed_response_extracts_valid_reports():
+    text = (
+        "=== REPORT: homework-a ===\n1. **Deductions**\nNone\nTotal: 58/60 points\n=== END REPORT: homework-a ===\n"
+        "=== REPORT: homework-b ===\nno score here\n=== END REPORT: homework-b ===\n"
+    )
+    reports = split_packed_response(text, ["homework-a", "homework-b", "homework-c"])
+    assert list(reports) == ["homework-a"]
+    assert reports["homework-a"].endswith("Total: 58/60 points")
+
+
+def test_grade_packed_grades_pack_and_returns_failures(temp_project, fake_env, monkeypatch, tmp_path):
+    root = temp_project["root"]
+    dirs = []
+    for name in ["homework-a", "homework-b", "homework-c"]:
+        d = root / name
+        d.mkdir()
+        (d / "main.py").write_text(f"print('{name}')")
+        (d / "readme.txt").write_text("notes")
+        dirs.append(d)
+    calls = []
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": (
+            "=== REPORT: homework-a ===\nGood work.\nTotal: 55/60 points\n=== END REPORT: homework-a ===\n"
+            "=== REPORT: homework-c ===\nTotal: 40/60 points\n=== END REPORT: homework-c ==="
+        )}})]
+
+    def fake_create(**kwargs):
+        calls.append(kwargs["messages"])
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    csv_path = tmp_path / "grading_summary.csv"
+
+    remaining = grade_packed(
+        dirs, csv_path, temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5-mini", 60, [], SYSTEM_PROMPT, {"packing": {"token_budget": 1000}},
+    )
+
+    assert len(calls) == 1
+    assert "=== SUBMISSION: homework-b ===" in calls[0][1]["content"]
+    assert remaining == [dirs[1]]
+    assert "Total: 55/60 points" in (dirs[0] / "grade_summary.txt").read_text(encoding="utf-8")
+    assert not (dirs[1] / "grade_summary.txt").exists()
+    assert csv_path.read_text(encoding="utf-8").count("Graded") == 2
+
+# --------------------------------------------------------------------
+# Streaming Completions
+# --------------------------------------------------------------------
+
+def _chunks(*pieces, fail_after=None):
+    for i, piece in enumerate(pieces):
+        if fail_after is not None and i == fail_after:
+            raise APIConnectionError("connection reset by peer")
+        yield {"choices": [{"delta": {"content": piece}}]}
+
+
+def test_grade_submission_streams_and_swaps_summary(temp_project, fake_env, monkeypatch):
+    student_dir = temp_project["student_dir"]
+    seen = {}
+
+    def fake_create(**kwargs):
+        seen["stream"] = kwargs.get("stream")
+        return _chunks("1. **Deductions**\nNone\n", "5. **Score Summary**\n", "Total: 57/60 points\n")
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    result = grade_submission(
+        student_dir, temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5-mini", 60, [], SYSTEM_PROMPT, {"streaming": True},
+    )
+
+    assert seen["stream"] is True
+    assert "Total: 57/60 points" in result
+    assert (student_dir / "grade_summary.txt").read_text(encoding="utf-8") == result
+    assert not (student_dir / "grade_summary.txt.partial").exists()
+
+
+def test_stream_grading_report_recovers_after_dropped_connection(temp_project, monkeypatch):
+    student_dir = temp_project["student_dir"]
+    monkeypatch.setattr(
+        "openai.ChatCompletion.create",
+        lambda **kw: _chunks("Deductions: none\n", "Total: 50/60 points\n", "6. **Supportive", fail_after=2),
+    )
+    text = stream_grading_report("gpt-5-mini", [{"role": "user", "content": "x"}], student_dir)
+    assert text.endswith("Total: 50/60 points\n")
+
+
+def test_stream_grading_report_discards_early_drop(temp_project, monkeypatch):
+    student_dir = temp_project["student_dir"]
+    monkeypatch.setattr("openai.ChatCompletion.create", lambda **kw: _chunks("Deductions", "...", fail_after=1))
+    monkeypatch.setattr("time.sleep", lambda *_: None)
+    assert stream_grading_report("gpt-5-mini", [{"role": "user", "content": "x"}], student_dir) is None
+    assert not (student_dir / "grade_summary.txt.partial").exists()
+
+
+def test_stream_grading_report_retries_mid_stream_failure(temp_project, monkeypatch):
+    student_dir = temp_project["student_dir"]
+    calls = {"count": 0}
+
+    def fake_create(**kwargs):
+        calls["count"] += 1
+        if calls["count"] == 1:
+            return _chunks("Deductions: lots of text", "...", fail_after=1)
+        return _chunks("Deductions: none\n", "Total: 50/60 points\n")
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    monkeypatch.setattr("time.sleep", lambda *_: None)
+    text = stream_grading_report("gpt-5-mini", [{"role": "user", "content": "x"}], student_dir)
+
+    assert calls["count"] == 2
+    assert text == "Deductions: none\nTotal: 50/60 points\n"
+    assert (student_dir / "grade_summary.txt.partial").read_text() == text
+
+
+def test_stream_holds_concurrency_slot_until_consumed(temp_project, monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+
+    controller = ga.ConcurrencyController(floor=1, ceiling=4, initial=2)
+    monkeypatch.setattr(ga, "CONCURRENCY", controller)
+    seen = {}
+
+    def slow_chunks():
+        yield {"choices": [{"delta": {"content": "Total: 50/60 points\n"}}]}
+        seen["in_flight"] = controller.in_flight
+        time.sleep(0.2)
+        yield {"choices": [{"delta": {"content": "Done"}}]}
+
+    monkeypatch.setattr("openai.ChatCompletion.create", lambda **kw: slow_chunks())
+    stream_grading_report("gpt-5-mini", [{"role": "user", "content": "x"}], temp_project["student_dir"])
+
+    assert seen["in_flight"] == 1
+    assert controller.in_flight == 0
+    assert controller.latencies[-1] >= 0.2
+
+# --------------------------------------------------------------------
+# LLM Backends
+# --------------------------------------------------------------------
+
+def test_fake_backend_canned_reports_and_errors():
+    backend = FakeBackend(reports=["Total: {earned}/{max_score} points"], max_score=40, seed=7)
+    resp = backend.create(model="m", messages=[{"role": "user", "content": "hi"}])
+    assert re.fullmatch(r"Total: \d+/40 points", resp.choices[0].message["content"])
+    assert resp["usage"]["total_tokens"] > 0
+
+    from openai.error import RateLimitError
+    failing = FakeBackend(error_rates={"rate_limited": 1.0})
+    with pytest.raises(RateLimitError):
+        failing.create(model="m", messages=[])
+
+
+def test_configure_backend_types():
+    assert configure_backend({}).name == "openai"
+    compatible = configure_backend({"backend": {"type": "openai-compatible", "base_url": "http://localhost:8000/v1"}})
+    assert compatible.base_url == "http://localhost:8000/v1" and not compatible.requires_api_key
+    with pytest.raises(ValueError):
+        configure_backend({"backend": {"type": "carrier-pigeon"}})
+
+
+def test_main_runs_offline_with_fake_backend(monkeypatch, temp_project):
+    import src.repo_grading_assistant.grade_assignments as grade_assignments
+    config = temp_project["config_file"]
+    data = json.loads(config.read_text())
+    data["backend"] = {"type": "fake", "latency": {"distribution": "uniform", "min": 0, "max": 0.01}, "seed": 3}
+    config.write_text(json.dumps(data))
+
+    fake_script = temp_project["root"] / "grade_assignments.py"
+    fake_script.write_text("# shim for tests\n", encoding="utf-8")
+    monkeypatch.setattr(grade_assignments, "__file__", str(fake_script))
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(sys, "argv", ["prog", "--config", str(config), "--repo-root", str(temp_project["root"])])
+    monkeypatch.chdir(temp_project["root"])
+
+    grade_assignments.main()
+
+    summary = (temp_project["student_dir"] / "grade_summary.txt").read_text(encoding="utf-8")
+    assert "/60 points" in summary
+    assert "Graded" in (temp_project["root"] / "logs" / "grading_summary.csv").read_text(encoding="utf-8")
+
+# --------------------------------------------------------------------
+# API Key Pool
+# --------------------------------------------------------------------
+
+class _StubBackend:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return {"choices": [{"message": {"content": "ok"}}], "usage": {"total_tokens": 42}}
+
+
+def test_key_pool_removes_bad_key_and_fails_over():
+    from openai.error import AuthenticationError
+    bad, good = _StubBackend(AuthenticationError("invalid api key")), _StubBackend()
+    pool = KeyPoolBackend([PooledKey("bad", bad, None), PooledKey("good", good, None)])
+
+    assert pool.create(model="m", messages=[])["usage"]["total_tokens"] == 42
+    assert pool.create(model="m", messages=[])
+    assert bad.calls == 1 and good.calls == 2
+    assert pool.keys[0].removed and pool.keys[1].tokens == 84
+
+
+def test_key_pool_dispatches_to_least_loaded_key():
+    a, b = PooledKey("a", _StubBackend(), None), PooledKey("b", _StubBackend(), None)
+    a.in_flight = 3
+    KeyPoolBackend([a, b]).create(model="m", messages=[])
+    assert (a.backend.calls, b.backend.calls) == (0, 1)
+
+
+def test_build_key_pool_skips_missing_env(monkeypatch):
+    monkeypatch.setenv("POOL_KEY_A", "sk-a")
+    monkeypatch.delenv("POOL_KEY_B", raising=False)
+    pool = build_key_pool([
+        {"name": "a", "api_key_env": "POOL_KEY_A", "requests_per_minute": 60},
+        {"name": "b", "api_key_env": "POOL_KEY_B"},
+    ])
+    assert [k.name for k in pool.keys] == ["a"]
+    assert pool.keys[0].limiter is not None
+
+# --------------------------------------------------------------------
+# Cross-Process Rate Ledger
+# --------------------------------------------------------------------
+
+def test_shared_ledger_splits_capacity_between_runs(tmp_path):
+    first = SharedRateLedger(tmp_path, "key-gpt", requests_per_minute=4, tokens_per_minute=None)
+    second = SharedRateLedger(tmp_path, "key-gpt", requests_per_minute=4, tokens_per_minute=None)
+    second.run_id = "other-run"
+
+    assert first.try_reserve(10) == 0          # alone: the whole limit
+    assert second.try_reserve(10) == 0         # two runs now: 2 requests/min each
+    assert first.try_reserve(10) == 0
+    assert first.try_reserve(10) > 0           # first run used its share
+    assert second.try_reserve(10) == 0
+
+    second.close()
+    state = json.loads((tmp_path / "key-gpt.json").read_text())
+    assert list(state["runs"]) == [first.run_id]
+
+
+def test_shared_ledger_tracks_tokens_and_settles(tmp_path):
+    ledger = SharedRateLedger(tmp_path, "key-gpt", requests_per_minute=None, tokens_per_minute=1000)
+    assert ledger.try_reserve(600) == 0
+    assert ledger.try_reserve(600) > 0
+    ledger.settle(600, 100)                     # real usage was much lower
+    assert ledger.try_reserve(600) == 0
+
+# --------------------------------------------------------------------
+# Model Routing
+# --------------------------------------------------------------------
+
+ROUTES = {"model_routing": [
+    {"max_tokens": 1000, "model": "gpt-5-nano"},
+    {"max_tokens": 50000, "model": "gpt-5-mini"},
+]}
+
+
+def test_route_model_by_prompt_size():
+    assert route_model(ROUTES, 400, "gpt-5") == "gpt-5-nano"
+    assert route_model(ROUTES, 1001, "gpt-5") == "gpt-5-mini"
+    assert route_model(ROUTES, 90000, "gpt-5") == "gpt-5"          # larger than every rule
+    assert route_model({"model_routing": [{"model": "gpt-4.1"}]}, 90000, "gpt-5") == "gpt-4.1"
+    assert route_model({}, 10, "gpt-5") == "gpt-5"
+
+
+def test_grade_student_routes_and_records_model(temp_project, fake_env, monkeypatch, tmp_path):
+    used = []
+
+    class FakeResponse:
+        choices = [type("obj", (), {"message": {"content": "Total: 50/60 points"}})]
+
+    def fake_create(**kwargs):
+        used.append(kwargs["model"])
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    csv_path = tmp_path / "grading_summary.csv"
+    status = grade_student(
+        temp_project["student_dir"], csv_path, temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5", 60, [], SYSTEM_PROMPT, ROUTES,
+    )
+
+    assert status == "Graded"
+    assert used == ["gpt-5-nano"]
+    rows = list(csv.reader(open(csv_path, encoding="utf-8")))
+    assert rows[0][-1] == "Model" and rows[1][-1] == "gpt-5-nano"
+
+# --------------------------------------------------------------------
+# Model Cascade
+# --------------------------------------------------------------------
+
+GOOD_REPORT = """1. **Deductions**
+- Missing docstrings (-5)
+
+2. **Bonus Credit (if any)**
+None
+
+3. **Strengths**
+Clear code. Good names.
+
+4. **Areas for Improvement**
+Add tests. Add comments.
+
+5. **Score Summary**
+Total: 55/60 points
+
+6. **Supportive Closing**
+Nice work!"""
+
+
+def test_report_problems_detects_structural_failures():
+    assert report_problems(GOOD_REPORT, 60) == []
+    assert "no parseable Total line" in report_problems(GOOD_REPORT.replace("Total: 55/60", "Score fifty-five"), 60)
+    assert any("Strengths" in p for p in report_problems(GOOD_REPORT.replace("**Strengths**", "Strengths"), 60))
+    assert any("outside" in p for p in report_problems(GOOD_REPORT.replace("55/60", "75/60"), 60))
+    with_bonus = GOOD_REPORT.replace("None\n\n3.", "- Added search feature\n\n3.")
+    assert "bonus listed but not included in Total" in report_problems(with_bonus, 60)
+    assert report_problems(with_bonus.replace("55/60 points", "65/60 points (includes 10 bonus)"), 60) == []
+
+
+def test_grade_submission_cascade_escalates_on_bad_report(temp_project, fake_env, monkeypatch):
+    used = []
+
+    def fake_create(**kwargs):
+        used.append(kwargs["model"])
+        content = "Looks fine overall." if kwargs["model"] == "gpt-5-nano" else GOOD_REPORT
+
+        class FakeResponse:
+            choices = [type("obj", (), {"message": {"content": content}})]
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    CASCADE_COUNTS.clear()
+    result = grade_submission(
+        temp_project["student_dir"], temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5", 60, [], SYSTEM_PROMPT, {"cascade": {"tiers": ["gpt-5-nano", "gpt-5-mini"]}},
+    )
+
+    assert used == ["gpt-5-nano", "gpt-5-mini"]
+    assert "Total: 55/60 points" in result
+    assert CASCADE_COUNTS == {"gpt-5-mini": 1}
+
+
+def test_cascade_does_not_escalate_on_failed_request(temp_project, monkeypatch):
+    from src.repo_grading_assistant import grade_assignments as ga
+    used = []
+
+    def failed_request(model, messages, student_name, **params):
+        used.append(model)
+        return None
+
+    monkeypatch.setattr(ga, "request_completion", failed_request)
+    CASCADE_COUNTS.clear()
+    report = ga.cascade_grade([], ["gpt-5-nano", "gpt-5-mini"], 60, temp_project["student_dir"])
+
+    assert report is None
+    assert used == ["gpt-5-nano"]
+    assert CASCADE_COUNTS == {}
+
+# Report Repair Tests
+
+def test_merge_score_summary_replaces_or_inserts_section():
+    broken = GOOD_REPORT.replace("Total: 55/60 points", "Score: about fifty-five")
+    merged = merge_score_summary(broken, "5. **Score Summary**\nTotal: 55/60 points")
+    assert "Total: 55/60 points" in merged
+    assert "fifty-five" not in merged
+    assert merged.index("**Score Summary**") < merged.index("**Supportive Closing**")
+
+    no_summary = re.sub(r"5\. \*\*Score Summary\*\*\n.*?\n\n", "", GOOD_REPORT, flags=re.DOTALL)
+    merged = merge_score_summary(no_summary, "Total: 50/60 points")
+    assert "5. **Score Summary**\nTotal: 50/60 points" in merged
+    assert merged.index("**Score Summary**") < merged.index("**Supportive Closing**")
+
+
+def test_grade_submission_repairs_malformed_total(temp_project, fake_env, monkeypatch):
+    prompts = []
+
+    def fake_create(**kwargs):
+        prompts.append(kwargs["messages"])
+        if len(prompts) == 1:
+            content = GOOD_REPORT.replace("Total: 55/60 points", "Total: fifty-five of sixty")
+        else:
+            content = "5. **Score Summary**\nTotal: 55/60 points"
+
+        class FakeResponse:
+            choices = [type("obj", (), {"message": {"content": content}})]
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    result = grade_submission(
+        temp_project["student_dir"], temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5-mini", 60, [], SYSTEM_PROMPT, {},
+    )
+
+    assert len(prompts) == 2
+    # The follow-up carries only the model's own report, not the key or submission
+    assert len(prompts[1]) == 1
+    assert "fifty-five of sixty" in prompts[1][0]["content"]
+    assert "Answer Key" not in prompts[1][0]["content"]
+    assert "Total: 55/60 points" in result
+    assert "fifty-five" not in result
+
+
+def test_repair_report_skips_when_disabled_or_sections_missing(monkeypatch):
+    def fail_create(**kwargs):
+        raise AssertionError("repair should not call the model")
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fail_create)
+    broken = GOOD_REPORT.replace("Total: 55/60 points", "Total: n/a")
+    assert repair_report(broken, "gpt-5-mini", 60, "alice", {"repair": False}) == broken
+    assert repair_report("Looks fine overall.", "gpt-5-mini", 60, "alice", {}) == "Looks fine overall."
+    assert repair_report(GOOD_REPORT, "gpt-5-mini", 60, "alice", {}) == GOOD_REPORT
+
+# Structured Output Tests
+
+STRUCTURED_REPLY = {
+    "deductions": [{"reason": "Missing input validation", "points": 5}],
+    "bonuses": [{"reason": "Added a search feature", "points": 10}],
+    "strengths": ["Clear code.", "Good names."],
+    "improvements": ["Add tests.", "Add comments."],
+    "earned": 55,
+    "closing": "Nice work!",
+}
+
+
+def test_parse_and_render_structured_report():
+    fields = parse_structured_report(json.dumps(STRUCTURED_REPLY), 60)
+    assert (fields["bonus"], fields["total"], fields["max_score"]) == (10, 65, 60)
+
+    text = render_structured_report(fields)
+    assert report_problems(text, 60) == []
+    assert "- Missing input validation (-5 points)" in text
+    assert "Total: 65/60 points (includes 10 bonus)" in text
+
+    inconsistent = {**STRUCTURED_REPLY, "deductions": [{"reason": "Broken build", "points": 50}], "earned": 60}
+    fields = parse_structured_report(json.dumps(inconsistent), 60)
+    assert (fields["earned"], fields["total"]) == (10, 20)
+
+    for bad in (
+        "not json",
+        json.dumps({**STRUCTURED_REPLY, "earned": 75}),
+        json.dumps({**STRUCTURED_REPLY, "deductions": [{"reason": "x", "points": -3}]}),
+        json.dumps({k: v for k, v in STRUCTURED_REPLY.items() if k != "closing"}),
+    ):
+        with pytest.raises(ValueError):
+            parse_structured_report(bad, 60)
+
+
+def test_append_csv_row_uses_structured_fields(tmp_path):
+    csv_file = tmp_path / "summary.csv"
+    fields = parse_structured_report(json.dumps(STRUCTURED_REPLY), 60)
+    append_csv_row(csv_file, "student1", "Score: 1/2 in free text", "Graded", "gpt-5-mini", fields)
+
+    with csv_file.open() as f:
+        row = list(csv.reader(f))[1]
+    assert row[4:7] == ["65", "60", "Missing input validation (-5 points)"]
+
+
+def test_grade_student_structured_output_mode(temp_project, fake_env, monkeypatch):
+    seen = {}
+
+    def fake_create(**kwargs):
+        seen.update(kwargs)
+
+        class FakeResponse:
+            choices = [type("obj", (), {"message": {"content": json.dumps(STRUCTURED_REPLY)}})]
+        return FakeResponse()
+
+    monkeypatch.setattr("openai.ChatCompletion.create", fake_create)
+    csv_path = temp_project["root"] / "summary.csv"
+    status = grade_student(
+        temp_project["student_dir"], csv_path, temp_project["grading_key_file"], ["main.py", "readme.txt"],
+        "gpt-5-mini", 60, [], SYSTEM_PROMPT, {"structured_output": True},
+    )
+
+    assert status == "Graded"
+    assert seen["response_format"] == STRUCTURED_RESPONSE_FORMAT
+    assert "JSON object" in seen["messages"][0]["content"]
+    summary = (temp_project["student_dir"] / "grade_summary.txt").read_text()
+    assert "Total: 65/60 points (includes 10 bonus)" in summary
+    with csv_path.open() as f:
+        row = list(csv.reader(f))[1]
+    assert row[4:6] == ["65", "60"]
+
 # --------------------------------------------------------------------
 # OpenAI API Validation Tests
 # These tests call the actual OpenAI API to validate configuration